@@ -0,0 +1,364 @@
+#
+# Copyright (C) 2016 by frePPLe bvba
+#
+# All information contained herein is, and remains the property of frePPLe.
+# You are allowed to use and modify the source code, as long as the software is used
+# within your company.
+# You are not allowed to distribute the software, either in the form of source code
+# or in the form of compiled binaries.
+#
+
+r'''
+High-throughput write path for the list API views.
+
+The standard bulk API validates and saves every record on its own, which
+requires a couple of database queries per record. The BulkWriter class
+processes a list of records with a fixed number of queries per batch:
+  - The records are validated in batches. The foreign keys of a batch are
+    resolved with a single query per related model.
+  - Existing records are updated with a single statement per batch, and new
+    records are inserted with a bulk insert.
+  - All changes are made in a single transaction: a request is either
+    processed completely or not at all.
+  - The response is streamed back to the client, as a JSON list or as
+    newline-delimited JSON.
+
+Records are matched on their primary key: existing records are updated with
+the fields in the request, other records are created. The keys of new
+records without a key are allocated from the sequence of the table, with a
+single query per batch.
+
+The writer can't be used for models with a custom save method, because that
+method isn't called. The method BulkWriter.supports checks this.
+'''
+
+import json
+from datetime import datetime
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, models, transaction
+from django.http import StreamingHttpResponse
+from django.utils.encoding import smart_text
+
+from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from rest_framework.relations import PrimaryKeyRelatedField
+from rest_framework.response import Response
+from rest_framework.validators import UniqueValidator, UniqueTogetherValidator
+
+from freppledb.common.models import AuditModel, HierarchyModel
+
+
+def getCastType(field, connection):
+  '''
+  Returns the type of a field, to be used in a type cast.
+  '''
+  if isinstance(field, models.AutoField):
+    return models.IntegerField().db_type(connection)
+  return field.db_type(connection)
+
+
+class BatchRelatedField(PrimaryKeyRelatedField):
+  '''
+  A related field that looks up the related objects in a cache, which is
+  filled with a single query per batch of records.
+  '''
+  def __init__(self, **kwargs):
+    self.cache = {}
+    self.pending = set()
+    super(BatchRelatedField, self).__init__(**kwargs)
+
+  def to_key(self, data):
+    try:
+      return self.get_queryset().model._meta.pk.to_python(data)
+    except (DjangoValidationError, TypeError, ValueError):
+      return None
+
+  def to_internal_value(self, data):
+    key = self.to_key(data)
+    if key is None:
+      self.fail('incorrect_type', data_type=type(data).__name__)
+    if key in self.cache:
+      return self.cache[key]
+    if key in self.pending:
+      # Refers to a record created in the same request
+      return self.get_queryset().model(pk=key)
+    self.fail('does_not_exist', pk_value=data)
+
+
+class BulkWriter:
+
+  # Number of records processed at once
+  batchsize = 1000
+
+  # Media type for newline-delimited JSON
+  ndjson = 'application/x-ndjson'
+
+  def __init__(self, view):
+    self.view = view
+    self.database = view.request.database
+    self.model = view.get_serializer_class().Meta.model
+
+
+  @classmethod
+  def supports(cls, view):
+    '''
+    Returns true when the model of the view can be written in bulk.
+    '''
+    meta = view.get_serializer_class().Meta
+    if getattr(meta, 'update_lookup_field', 'id') != meta.model._meta.pk.name:
+      return False
+    for c in meta.model.__mro__:
+      if 'save' in c.__dict__ and c not in (models.Model, AuditModel, HierarchyModel):
+        return False
+    return True
+
+
+  def getSerializer(self, partial):
+    '''
+    Returns a serializer to validate a single record, without any database
+    queries.
+    '''
+    serializer = self.view.get_serializer_class()(
+      context=self.view.get_serializer_context(), partial=partial
+      )
+    for name, field in list(serializer.fields.items()):
+      if isinstance(field, PrimaryKeyRelatedField) and not field.read_only:
+        related = BatchRelatedField(**field._kwargs)
+        related.cache = self.related[name].cache
+        related.pending = self.related[name].pending
+        serializer.fields[name] = related
+      else:
+        # Uniqueness is guaranteed by the upsert
+        field.validators = [ v for v in field.validators if not isinstance(v, UniqueValidator) ]
+    serializer.validators = [ v for v in serializer.validators if not isinstance(v, UniqueTogetherValidator) ]
+    return serializer
+
+
+  def validate(self, data):
+    '''
+    Validates all records. Returns a list with the primary key, a flag
+    whether it's a new record and the validated data of every record.
+    Raises a ValidationError listing the errors per record.
+    '''
+    pk = self.model._meta.pk
+    fields = self.view.get_serializer().fields
+    self.related = {
+      name: BatchRelatedField(queryset=field.queryset)
+      for name, field in fields.items()
+      if isinstance(field, PrimaryKeyRelatedField) and not field.read_only
+      }
+    full = self.getSerializer(False)
+    partial = self.getSerializer(True)
+
+    # Keys of the records in the request
+    keys = []
+    for rec in data:
+      try:
+        keys.append(pk.to_python(rec.get(pk.name, None)) if isinstance(rec, dict) else None)
+      except DjangoValidationError:
+        keys.append(None)
+
+    # Records can refer to other records created in the same request
+    for field in self.related.values():
+      if field.queryset.model == self.model:
+        field.pending.update(k for k in keys if k is not None)
+
+    result = []
+    errors = []
+    created = set()
+    for start in range(0, len(data), self.batchsize):
+      batch = data[start:start + self.batchsize]
+      batchkeys = [ k for k in keys[start:start + self.batchsize] if k is not None ]
+
+      # Find the existing records with a single query
+      existing = set(
+        self.model.objects.using(self.database).filter(pk__in=batchkeys).values_list('pk', flat=True)
+        )
+
+      # Resolve the foreign keys with a single query per related model
+      for name, field in self.related.items():
+        field.cache.clear()
+        values = set(
+          field.to_key(rec[name]) for rec in batch
+          if isinstance(rec, dict) and rec.get(name, None) is not None
+          )
+        values.discard(None)
+        if values:
+          field.cache.update(
+            field.queryset.model.objects.using(self.database).in_bulk(list(values))
+            )
+
+      for key, rec in zip(keys[start:start + self.batchsize], batch):
+        isnew = key is None or (key not in existing and key not in created)
+        serializer = full if isnew else partial
+        try:
+          if not isinstance(rec, dict):
+            raise ValidationError({'non_field_errors': ['Expected a dictionary of items']})
+          validated = serializer.run_validation(rec)
+          errors.append({})
+          if isnew and key is not None:
+            created.add(key)
+          result.append((key, isnew, validated))
+        except ValidationError as e:
+          errors.append(e.detail)
+    if any(errors):
+      raise ValidationError(errors)
+    return result
+
+
+  def write(self, records):
+    '''
+    Writes the validated records to the database. Returns the list of
+    primary keys.
+    '''
+    connection = connections[self.database]
+    opts = self.model._meta
+    pk = opts.pk
+    table = connection.ops.quote_name(opts.db_table)
+    now = datetime.now()
+    audit = issubclass(self.model, AuditModel)
+    hierarchy = issubclass(self.model, HierarchyModel)
+    keys = []
+    placed = []
+    cursor = connection.cursor()
+    for start in range(0, len(records), self.batchsize):
+      inserts = {}
+      autoinserts = []
+      updates = {}
+      for key, isnew, validated in records[start:start + self.batchsize]:
+        if isnew:
+          obj = self.model(**validated)
+          if audit:
+            obj.lastmodified = now
+          if key is None:
+            # Remember the position of the record, to fill in its key later
+            autoinserts.append((len(keys), obj))
+          else:
+            inserts[key] = obj
+        elif key in inserts:
+          # Repeated record in the same batch
+          for f, v in validated.items():
+            setattr(inserts[key], f, v)
+        else:
+          updates.setdefault(key, {}).update(validated)
+        keys.append(key)
+
+      # Allocate the keys of the records without key with a single query
+      if autoinserts:
+        cursor.execute(
+          "select nextval(pg_get_serial_sequence(%s, %s)) from generate_series(1, %s)",
+          (opts.db_table, pk.column, len(autoinserts))
+          )
+        for (position, obj), (key,) in zip(autoinserts, cursor.fetchall()):
+          obj.pk = key
+          keys[position] = key
+
+      # New nodes and nodes moving to another owner will be positioned
+      # in the hierarchy
+      if hierarchy:
+        placed.extend(inserts.keys())
+        moves = { key: validated['owner'] for key, validated in updates.items() if 'owner' in validated }
+        if moves:
+          for key, owner in self.model.objects.using(self.database).filter(pk__in=moves.keys()).values_list('pk', 'owner'):
+            newowner = moves[key].pk if isinstance(moves[key], models.Model) else moves[key]
+            if owner != newowner:
+              placed.append(key)
+
+      # Insert new records
+      if inserts or autoinserts:
+        self.model.objects.using(self.database).bulk_create(
+          list(inserts.values()) + [ obj for position, obj in autoinserts ]
+          )
+
+      # Update existing records, with a single statement per set of fields
+      groups = {}
+      for key, validated in updates.items():
+        groups.setdefault(tuple(sorted(validated)), []).append((key, validated))
+      for fieldnames, rows in groups.items():
+        fields = [ pk ] + [ opts.get_field(f) for f in fieldnames if f != pk.name ]
+        if audit:
+          fields.append(opts.get_field('lastmodified'))
+        if len(fields) < 2:
+          # Nothing to update
+          continue
+        values = []
+        params = []
+        for key, validated in rows:
+          obj = self.model(**validated)
+          obj.pk = key
+          if audit:
+            obj.lastmodified = now
+          values.append('(%s)' % ','.join(
+            '%%s::%s' % getCastType(f, connection) for f in fields
+            ))
+          params.extend(f.get_db_prep_save(getattr(obj, f.attname), connection) for f in fields)
+        assignments = [
+          '%s = v.%s' % (connection.ops.quote_name(f.column), connection.ops.quote_name(f.column))
+          for f in fields[1:]
+          ]
+        cursor.execute(
+          'update %s set %s from (values %s) as v(%s) where %s.%s = v.%s' % (
+            table, ', '.join(assignments), ', '.join(values),
+            ', '.join(connection.ops.quote_name(f.column) for f in fields),
+            table, connection.ops.quote_name(pk.column), connection.ops.quote_name(pk.column)
+            ),
+          params
+          )
+
+    # Position the new and moved nodes in the hierarchy
+    if placed:
+      self.model.placeNodes(placed, database=self.database)
+    return keys
+
+
+  def stream(self, keys, ndjson=False):
+    '''
+    Generator that returns the records as JSON, reading them from the
+    database batch per batch.
+    '''
+    serializer = self.view.get_serializer()
+    if not ndjson:
+      yield '['
+    first = True
+    for start in range(0, len(keys), self.batchsize):
+      batch = keys[start:start + self.batchsize]
+      objs = self.model.objects.using(self.database).in_bulk(batch)
+      for key in batch:
+        data = json.dumps(serializer.to_representation(objs[key]), cls=DjangoJSONEncoder)
+        if ndjson:
+          yield data + '\n'
+        elif first:
+          yield data
+          first = False
+        else:
+          yield ',' + data
+    if not ndjson:
+      yield ']'
+
+
+  def process(self, data, status_code=status.HTTP_200_OK):
+    '''
+    Validates and writes a list of records, and returns a streaming response
+    with the saved records.
+    '''
+    if isinstance(data, dict):
+      data = [ data ]
+    elif not isinstance(data, list):
+      return Response(
+        {'non_field_errors': ['Expected a list of items']},
+        status=status.HTTP_400_BAD_REQUEST
+        )
+    try:
+      with transaction.atomic(using=self.database):
+        keys = self.write(self.validate(data))
+    except ValidationError as e:
+      return Response(e.detail, status=status.HTTP_400_BAD_REQUEST)
+    ndjson = self.ndjson in smart_text(self.view.request.META.get('HTTP_ACCEPT', '')) \
+      or self.view.request.content_type.startswith(self.ndjson)
+    return StreamingHttpResponse(
+      self.stream(keys, ndjson),
+      status=status_code,
+      content_type=self.ndjson if ndjson else 'application/json'
+      )
@@ -0,0 +1,39 @@
+#
+# Copyright (C) 2016 by frePPLe bvba
+#
+# All information contained herein is, and remains the property of frePPLe.
+# You are allowed to use and modify the source code, as long as the software is used
+# within your company.
+# You are not allowed to distribute the software, either in the form of source code
+# or in the form of compiled binaries.
+#
+
+import json
+
+from django.conf import settings
+
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+
+class NDJSONParser(BaseParser):
+  '''
+  Parses newline-delimited JSON: every line holds a single record.
+  The result is a list of all records. The bulk API validates all records
+  before saving any of them, so the complete body is held in memory anyway.
+  '''
+  media_type = 'application/x-ndjson'
+
+  def parse(self, stream, media_type=None, parser_context=None):
+    parser_context = parser_context or {}
+    encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+    data = []
+    for number, line in enumerate(stream, start=1):
+      line = line.strip()
+      if not line:
+        continue
+      try:
+        data.append(json.loads(line.decode(encoding)))
+      except ValueError as e:
+        raise ParseError('NDJSON parse error on line %d - %s' % (number, e))
+    return data
@@ -15,10 +15,14 @@ from django.template import RequestContext
 from django.utils.translation import ugettext_lazy as _
 from django.views.decorators.csrf import csrf_protect
 
-from rest_framework import generics
+from rest_framework import generics, status
+from rest_framework.settings import api_settings
 from rest_framework_bulk import ListBulkCreateUpdateDestroyAPIView, ListBulkCreateAPIView
 from rest_framework import filters
 
+from freppledb.common.api.bulk import BulkWriter
+from freppledb.common.api.parsers import NDJSONParser
+
 @staff_member_required
 @csrf_protect
 def APIIndexView(request):
@@ -33,22 +37,39 @@ class frePPleListCreateAPIView(ListBulkCreateUpdateDestroyAPIView):
   Customized API view for the REST framework.:
      - support for request-specific scenario database
      - add 'title' to the context of the html view
+     - a high-throughput mode for bulk creates and updates, see the module
+       freppledb.common.api.bulk. It is used for newline-delimited JSON
+       input, and for requests with the argument mode=bulk.
   '''
   filter_backends = (filters.DjangoFilterBackend,)
+  parser_classes = tuple(api_settings.DEFAULT_PARSER_CLASSES) + (NDJSONParser,)
 
   def get_queryset(self):
 
       return super(frePPleListCreateAPIView, self).get_queryset().using(self.request.database)
 
-  def allow_bulk_destroy(self, qs, filtered):
-    # Safety check to prevent deleting all records in the database table
-    if qs.count() > filtered.count():
-      return True
-    # default checks if the qs was filtered
-    # qs comes from self.get_queryset()
-    # filtered comes from self.filter_queryset(qs)
+  def useBulkWriter(self, request):
+    if request.content_type.startswith(NDJSONParser.media_type) or request.query_params.get('mode', None) == 'bulk':
+      return BulkWriter.supports(self)
     return False
 
+  def create(self, request, *args, **kwargs):
+    if self.useBulkWriter(request):
+      return BulkWriter(self).process(request.data, status.HTTP_201_CREATED)
+    return super(frePPleListCreateAPIView, self).create(request, *args, **kwargs)
+
+  def bulk_update(self, request, *args, **kwargs):
+    if self.useBulkWriter(request):
+      return BulkWriter(self).process(request.data, status.HTTP_200_OK)
+    return super(frePPleListCreateAPIView, self).bulk_update(request, *args, **kwargs)
+
+  def allow_bulk_destroy(self, qs, filtered):
+    # Safety check to prevent deleting all records in the database table.
+    # The filtered queryset comes from self.filter_queryset(qs). We check
+    # whether it leaves out any record, which stops at the first one
+    # rather than counting both querysets.
+    return qs.exclude(pk__in=filtered.values('pk')).exists()
+
 class frePPleRetrieveUpdateDestroyAPIView(generics.RetrieveUpdateDestroyAPIView):
   '''
   Customized API view for the REST framework.
@@ -108,14 +108,14 @@ class MultiDBBackend(ModelBackend):
       user.scenarios = {}
       if user.is_active:
         user.scenarios[DEFAULT_DB_ALIAS] = user.is_superuser
-      for db in Scenario.objects.filter(status='In use').values('name'):
-        if db['name'] == DEFAULT_DB_ALIAS:
-          # Already populated above
+      for db, status in Scenario.getScenarios().items():
+        if db == DEFAULT_DB_ALIAS or status != 'In use':
+          # Default database is already populated above
           continue
         try:
-          user2 = User.objects.using(db['name']).get(username=user.username)
+          user2 = User.objects.using(db).get(username=user.username)
           if user2.is_active:
-            user.scenarios[db['name']] = user2.is_superuser
+            user.scenarios[db] = user2.is_superuser
         except:
           # Silently ignore errors. Eg user doesn't exist in scenario
           pass
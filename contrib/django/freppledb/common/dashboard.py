@@ -15,12 +15,23 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from datetime import datetime
+from hashlib import md5
 from importlib import import_module
+import logging
 
 from django.conf import settings
 from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.http import HttpRequest, HttpResponse, QueryDict
 from django.http import HttpResponseNotAllowed, HttpResponseForbidden, HttpResponseServerError
+from django.utils import translation
+
+from freppledb.common.middleware import _thread_locals
+from freppledb.common.models import Parameter, User, WidgetCache
+
+logger = logging.getLogger(__name__)
 
 
 class Dashboard:
@@ -43,6 +54,16 @@ class Dashboard:
       client browser.
       It should return HTML content for synchronous widgets.
       It should return a Django response object for asynchronous widgets.
+
+  Asynchronous widgets with the class attribute 'cacheable' set to true
+  are cached in the table common_widgetcache. The cache key includes the
+  widget arguments, the language, the scenario and the horizon preferences
+  of the user. An entry is only valid for the plan version it was rendered
+  for. Each plan export publishes a new version with bumpPlanVersion, and
+  uploads and edits in the grids clear the cache with clearCache.
+  Widgets also reading input tables list them in the attribute 'inputtables'.
+  The last modification of these tables is then part of the version, and
+  changes made by other means (eg the REST API) also invalidate the entry.
   '''
 
   __registry__ = {}
@@ -84,7 +105,9 @@ class Dashboard:
         return HttpResponseServerError("This widget is synchronous")
       if not w.has_permission(request.user):
         return HttpResponseForbidden()
-      return w.render(request)
+      if not w.cacheable:
+        return w.render(request)
+      return cls.renderCached(w, request)
     except Exception as e:
       if settings.DEBUG:
         return HttpResponseServerError("Server error: %s" % e)
@@ -92,6 +115,143 @@ class Dashboard:
         return HttpResponseServerError("Server error")
 
 
+  @staticmethod
+  def getLanguage(language):
+    '''
+    Normalizes a language code to the variant activated by the middleware,
+    eg 'en-us' becomes 'en' when only the generic language is available.
+    '''
+    try:
+      return translation.get_supported_language_variant(language)
+    except LookupError:
+      return language
+
+
+  @staticmethod
+  def getCacheKey(w, request):
+    user = request.user
+    return md5(repr((
+      w.name,
+      sorted(request.GET.items()),
+      Dashboard.getLanguage(getattr(request, 'LANGUAGE_CODE', settings.LANGUAGE_CODE)),
+      getattr(request, 'prefix', ''),
+      getattr(user, 'horizonbuckets', None),
+      getattr(user, 'horizonstart', None),
+      getattr(user, 'horizonend', None),
+      getattr(user, 'horizontype', None),
+      getattr(user, 'horizonlength', None),
+      getattr(user, 'horizonunit', None)
+      )).encode('utf-8')).hexdigest()
+
+
+  @classmethod
+  def renderCached(cls, w, request):
+    '''
+    Returns the widget content from the cache. If the cache doesn't have a
+    valid entry, the widget is rendered and stored in the cache.
+    The lookup of the version and the cache entry is a single query.
+    '''
+    database = getattr(request, 'database', DEFAULT_DB_ALIAS)
+    key = cls.getCacheKey(w, request)
+    cursor = connections[database].cursor()
+    version = "coalesce(max(value), '')"
+    if w.inputtables:
+      # Add the number of records and the last modification of the input
+      # tables, hashed to fit in the version field. The count detects
+      # deleted records.
+      version = "md5(%s%s)" % (version, ''.join([
+        " || '/' || (select count(*) || '/' || coalesce(max(lastmodified)::text, '') from %s)" % connections[database].ops.quote_name(t)
+        for t in w.inputtables
+        ]))
+    cursor.execute('''
+      select version.value, common_widgetcache.content
+      from (
+        select %s as value
+        from common_parameter
+        where name = 'plan.version'
+        ) version
+      left outer join common_widgetcache
+        on common_widgetcache.cachekey = %%s
+        and common_widgetcache.version = version.value
+      ''' % version, (key,))
+    version, content = cursor.fetchone()
+    if content is not None:
+      return HttpResponse(content)
+    response = w.render(request)
+    if response.status_code == 200 and not response.streaming:
+      try:
+        with transaction.atomic(using=database):
+          WidgetCache.objects.using(database).filter(cachekey=key).delete()
+          WidgetCache(
+            cachekey=key, widget=w.name, version=version,
+            content=response.content.decode(response.charset)
+            ).save(using=database)
+      except Exception as e:
+        # Another request may have stored the same entry
+        logger.warning("Can't cache widget %s: %s" % (w.name, e))
+    return response
+
+
+  @staticmethod
+  def clearCache(database=DEFAULT_DB_ALIAS):
+    WidgetCache.objects.using(database).all().delete()
+
+
+  @classmethod
+  def bumpPlanVersion(cls, database=DEFAULT_DB_ALIAS):
+    '''
+    Publishes a new plan version, which invalidates all cached widgets.
+    '''
+    param = Parameter.objects.using(database).get_or_create(name='plan.version')[0]
+    param.value = str(datetime.now())
+    param.description = 'Version of the plan, updated by each plan export'
+    param.save(using=database)
+    cls.clearCache(database)
+
+
+  @classmethod
+  def prewarm(cls, database=DEFAULT_DB_ALIAS):
+    '''
+    Renders all cacheable widgets with their default arguments, for each
+    combination of language and horizon preferences of the active users.
+    Returns the number of widgets rendered.
+    '''
+    profiles = {}
+    for user in User.objects.using(database).filter(is_active=True):
+      language = cls.getLanguage(user.language if user.language != 'auto' else settings.LANGUAGE_CODE)
+      profiles.setdefault((
+        language, user.horizonbuckets, user.horizonstart, user.horizonend,
+        user.horizontype, user.horizonlength, user.horizonunit
+        ), user)
+    count = 0
+    for profile, user in profiles.items():
+      language = profile[0]
+      for w in cls.buildList().values():
+        if not w.asynchronous or not w.cacheable:
+          continue
+        args = w().args
+        if callable(args):
+          args = args()
+        request = HttpRequest()
+        request.method = 'GET'
+        request.path = request.path_info = '/widget/%s/' % w.name
+        request.GET = QueryDict(args.lstrip('?'))
+        request.user = user
+        request.database = database
+        request.prefix = '' if database == DEFAULT_DB_ALIAS else '/%s' % database
+        request.LANGUAGE_CODE = language
+        _thread_locals.request = request
+        try:
+          with translation.override(language):
+            cls.renderCached(w, request)
+          count += 1
+        except Exception as e:
+          logger.error("Error prewarming widget %s: %s" % (w.name, e))
+        finally:
+          _thread_locals.request = None
+    return count
+
+
   @classmethod
   def createWidgetPermissions(cls, app):
     # Registered all permissions defined by dashboard widgets
@@ -133,11 +293,17 @@ class Widget:
       It returns a HTTPResponse object for asynchronous widgets.
     - Class attribute 'url' optionally defines a url to a report with a more
       complete content than can be displayed in the dashboard widget.
+    - Class attribute 'cacheable' can be set to true for asynchronous widgets
+      whose content only changes when a new plan is exported.
+    - Class attribute 'inputtables' lists the input tables read by a cacheable
+      widget. The cached content is refreshed when any of them changes.
   '''
   name = "Undefined"
   title = "Undefined"
   permissions = ()
   asynchronous = False  # Asynchroneous widget
+  cacheable = False     # Cache the content until the next plan export
+  inputtables = ()      # Input tables read by a cacheable widget
   url = None            # URL opened when the header is clicked
   exporturl = False     # Enable or disable a download icon
   args = ''             # Arguments passed in the url for asynchronous widgets
@@ -80,6 +80,10 @@ class MultiDBMiddleware(object):
   database. Extra fields are set on the request to set the selected database.
   This prefix is then stripped from the path while processing the view.
 
+  The list of scenarios is read from a process-wide cache. The routing only
+  queries the version of the scenario list in the database, and at most once
+  every few seconds.
+
   If the request has a user, the database of that user is also updated to
   point to the selected database.
   We update the fields:
@@ -89,19 +93,23 @@ class MultiDBMiddleware(object):
   """
   def process_request(self, request):
     request.user = auth.get_user(request)
-    for i in Scenario.objects.all().only('name', 'status'):
+    for name, status in Scenario.getScenarios().items():
       try:
-        if settings.DATABASES[i.name]['regexp'].match(request.path) and i.name != DEFAULT_DB_ALIAS:
-          if i.status != 'In use':
-            raise Http404('Scenario not in use')
-          request.prefix = '/%s' % i.name
+        if settings.DATABASES[name]['regexp'].match(request.path) and name != DEFAULT_DB_ALIAS:
+          if status != 'In use':
+            # Another process may have activated the scenario since the
+            # version was last checked.
+            status = Scenario.getScenarios(refresh=True).get(name, None)
+            if status != 'In use':
+              raise Http404('Scenario not in use')
+          request.prefix = '/%s' % name
           request.path_info = request.path_info[len(request.prefix):]
           request.path = request.path[len(request.prefix):]
-          request.database = i.name
+          request.database = name
           if request.user and not request.user.is_anonymous():
-            superuser = request.user.scenarios.get(i.name)
+            superuser = request.user.scenarios.get(name)
             if superuser != None:
-              request.user._state.db = i.name
+              request.user._state.db = name
               request.user.is_superuser = superuser
             else:
               raise Http404('Access to this scenario is not allowed')
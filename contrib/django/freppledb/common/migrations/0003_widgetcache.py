@@ -0,0 +1,44 @@
+#
+# Copyright (C) 2016 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+  dependencies = [
+    ('common', '0002_defaultuser'),
+  ]
+
+  operations = [
+    migrations.CreateModel(
+      name='WidgetCache',
+      fields=[
+        ('cachekey', models.CharField(primary_key=True, verbose_name='key', serialize=False, max_length=32)),
+        ('widget', models.CharField(verbose_name='widget', db_index=True, max_length=300)),
+        ('version', models.CharField(verbose_name='version', max_length=60)),
+        ('content', models.TextField(verbose_name='content')),
+        ('lastmodified', models.DateTimeField(editable=False, verbose_name='last modified', default=django.utils.timezone.now)),
+      ],
+      options={
+        'db_table': 'common_widgetcache',
+        'verbose_name_plural': 'widget cache',
+        'verbose_name': 'widget cache',
+      },
+    ),
+  ]
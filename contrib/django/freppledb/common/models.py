@@ -16,6 +16,7 @@
 #
 from datetime import datetime
 import logging
+from time import time
 
 from django.conf import settings
 from django.contrib.admin.utils import quote
@@ -24,7 +25,7 @@ from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import NoReverseMatch, reverse
-from django.db import models, DEFAULT_DB_ALIAS, connections, transaction
+from django.db import models, router, DEFAULT_DB_ALIAS, connections, transaction
 from django.db.models.signals import pre_delete
 from django.dispatch.dispatcher import receiver
 from django.utils import timezone
@@ -37,8 +38,25 @@ logger = logging.getLogger(__name__)
 
 
 class HierarchyModel(models.Model):
+  '''
+  This is an abstract base model for a hierarchy of records.
+  The hierarchy is stored as nested sets: the interval lft-rght of a node
+  contains the intervals of all its children.
+
+  The intervals are maintained incrementally when a node is added or moved.
+  Each interval reserves some free numbers at its end, so children can be
+  added without renumbering the tree. Only when a node can't be positioned
+  incrementally, its lft field is cleared and the method rebuildHierarchy
+  renumbers the complete hierarchy.
+  '''
+  # Number of free numbers reserved in the interval of each node
+  hierarchyGap = 20
+
+  # Maximum number of nodes positioned one by one by placeNodes
+  maxPlaceNodes = 100
+
   lft = models.PositiveIntegerField(db_index=True, editable=False, null=True, blank=True)
-  rght = models.PositiveIntegerField(null=True, editable=False, blank=True)
+  rght = models.PositiveIntegerField(db_index=True, null=True, editable=False, blank=True)
   lvl = models.PositiveIntegerField(null=True, editable=False, blank=True)
   # Translators: Translation included with Django
   name = models.CharField(_('name'), max_length=300, primary_key=True,
@@ -47,17 +65,150 @@ class HierarchyModel(models.Model):
                             related_name='xchildren', help_text=_('Hierarchical parent'))
 
   def save(self, *args, **kwargs):
-    # Trigger recalculation of the hieracrhy
-    self.lft = None
-    self.rght = None
-    self.lvl = None
+    database = kwargs.get('using', None) or router.db_for_write(self.__class__, instance=self)
+    with transaction.atomic(using=database):
+      old = self.__class__.objects.using(database).filter(pk=self.name).values_list('owner', 'lft', 'rght', 'lvl')
+      old = old[0] if old else None
+      if old and old[1] is not None:
+        # Keep the position of an existing node
+        self.lft, self.rght, self.lvl = old[1:]
+      else:
+        self.lft = None
+        self.rght = None
+        self.lvl = None
 
-    # Call the real save() method
-    super(HierarchyModel, self).save(*args, **kwargs)
+      # Call the real save() method
+      super(HierarchyModel, self).save(*args, **kwargs)
+
+      # Position a new or moved node in the hierarchy
+      if not old:
+        self.lft, self.rght, self.lvl = self.__class__.placeNode(self.name, self.owner_id, None, database)
+      elif old[0] != self.owner_id and self.lft is not None:
+        self.lft, self.rght, self.lvl = self.__class__.placeNode(
+          self.name, self.owner_id, (self.lft, self.rght, self.lvl), database
+          )
 
   class Meta:
     abstract = True
 
+  @classmethod
+  def placeNode(cls, name, owner, interval=None, database=DEFAULT_DB_ALIAS):
+    '''
+    Positions a new node, or moves a node with all its children, below a new
+    owner. The argument interval is the current lft, rght and lvl of a node
+    being moved. The position is read again after locking the hierarchy.
+    Returns the new lft, rght and lvl of the node. They are None when the
+    node can't be positioned incrementally, and the complete hierarchy needs
+    to be rebuilt.
+    '''
+    quote = connections[database].ops.quote_name
+    table = quote(cls._meta.db_table)
+    owner_col = quote(cls._meta.get_field('owner').column)
+    cursor = connections[database].cursor()
+
+    # Changes of the hierarchy are serialized with an advisory lock, which
+    # doesn't block other updates of the table. Adding a child only needs
+    # a shared lock and a lock on the owner record: children of different
+    # owners get numbers from disjoint intervals. Top-level nodes and moves
+    # take the lock exclusively.
+    exclusive = interval is not None or not owner
+    cursor.execute(
+      "select pg_advisory_xact_lock%s(hashtext(%%s))" % ('' if exclusive else '_shared'),
+      (cls._meta.db_table,)
+      )
+    if interval:
+      # Another process can have shifted the node before we got the lock
+      cursor.execute("select lft, rght, lvl from %s where name = %%s" % table, (name,))
+      interval = cursor.fetchone()
+    # A node without position waits for the hierarchy to be rebuilt
+    fallback = interval is not None and interval[0] is None
+
+    if not fallback and owner:
+      cursor.execute("select lft, rght, lvl from %s where name = %%s for update" % table, (owner,))
+      lft, limit, level = cursor.fetchone()
+      # The owner must have a position, and can't be a child of the node
+      fallback = lft is None or (interval and interval[0] <= lft <= interval[1])
+      if not fallback:
+        level += 1
+        cursor.execute(
+          "select max(rght) from %s where %s = %%s and name <> %%s" % (table, owner_col),
+          (owner, name)
+          )
+        last = cursor.fetchone()[0] or lft
+    elif not fallback:
+      level = 0
+      limit = None
+      cursor.execute("select max(rght) from %s" % table)
+      last = cursor.fetchone()[0] or 0
+
+    if not fallback:
+      start = last + 1
+      size = interval[1] - interval[0] + 1 if interval else cls.hierarchyGap + 2
+    if not fallback and limit is not None and start + size > limit and not exclusive:
+      # Shifting the numbers of other nodes needs the exclusive lock. When
+      # another process is changing the hierarchy as well, we give up.
+      cursor.execute("select pg_try_advisory_xact_lock(hashtext(%s))", (cls._meta.db_table,))
+      fallback = not cursor.fetchone()[0]
+    if fallback:
+      cursor.execute(
+        "update %s set lft = null, rght = null, lvl = null where name = %%s" % table,
+        (name,)
+        )
+      return None, None, None
+
+    if limit is not None and start + size > limit:
+      # Not enough free numbers in the owner: shift everything on its right
+      shift = start + size - limit + cls.hierarchyGap
+      cursor.execute("update %s set rght = rght + %%s where rght >= %%s" % table, (shift, limit))
+      cursor.execute("update %s set lft = lft + %%s where lft > %%s" % table, (shift, limit))
+      if interval and interval[0] > limit:
+        interval = (interval[0] + shift, interval[1] + shift, interval[2])
+
+    if interval:
+      cursor.execute(
+        "update %s set lft = lft + %%s, rght = rght + %%s, lvl = lvl + %%s where lft between %%s and %%s" % table,
+        (start - interval[0], start - interval[0], level - interval[2], interval[0], interval[1])
+        )
+    else:
+      cursor.execute(
+        "update %s set lft = %%s, rght = %%s, lvl = %%s where name = %%s" % table,
+        (start, start + size - 1, level, name)
+        )
+    return start, start + size - 1, level
+
+  @classmethod
+  def placeNodes(cls, names, database=DEFAULT_DB_ALIAS):
+    '''
+    Positions a list of nodes that were added or moved with a bulk operation.
+    A node without lft is positioned as a new node, other nodes are moved
+    with their children below their current owner. Owners are positioned
+    before their children.
+    Beyond maxPlaceNodes nodes the complete hierarchy is rebuilt instead.
+    '''
+    names = set(names)
+    if not names:
+      return
+    if len(names) > cls.maxPlaceNodes:
+      cls.objects.using(database).filter(name__in=names).update(lft=None, rght=None, lvl=None)
+      cls.rebuildHierarchy(database=database)
+      return
+    nodes = {
+      i[0]: i[1:]
+      for i in cls.objects.using(database).filter(name__in=names).values_list('name', 'owner', 'lft')
+      }
+    while nodes:
+      ready = [ i for i, j in nodes.items() if j[0] not in nodes ]
+      if not ready:
+        # Loop in the hierarchy
+        break
+      for name in sorted(ready):
+        owner, lft = nodes.pop(name)
+        with transaction.atomic(using=database):
+          cls.placeNode(name, owner, (lft, None, None) if lft is not None else None, database)
+    if nodes:
+      cls.objects.using(database).filter(name__in=nodes.keys()).update(lft=None, rght=None, lvl=None)
+    cls.rebuildHierarchy(database=database)
+
   @classmethod
   def rebuildHierarchy(cls, database=DEFAULT_DB_ALIAS):
 
@@ -77,6 +228,9 @@ class HierarchyModel(models.Model):
         # Recursive execution of this function for each child of this node
         right = tagChildren(i, right, level + 1)
 
+      # Reserve some free numbers for new children
+      right += cls.hierarchyGap
+
       # After processing the children of this node now know its left and right values
       updates.append( (left, right, level, me) )
 
@@ -216,9 +370,72 @@ class Scenario(models.Model):
     )
   lastrefresh = models.DateTimeField(_('last refreshed'), null=True, editable=False)
 
+  # Process-wide cache with the status of all scenarios.
+  # The cache is valid as long as the version of the scenario list, stored
+  # in the parameter 'scenario.version' of the default database, doesn't
+  # change. Each change to a scenario publishes a new version, and all
+  # processes (eg the web server and the worker) then refresh their cache.
+  # The version is checked at most once every checkInterval seconds.
+  _cache = None
+  _version = None
+  _checked = 0
+  checkInterval = 5
+  cacheHits = 0
+  cacheMisses = 0
+
   def __str__(self):
     return self.name
 
+  def save(self, *args, **kwargs):
+    super(Scenario, self).save(*args, **kwargs)
+    Scenario.bumpVersion()
+
+  def delete(self, *args, **kwargs):
+    super(Scenario, self).delete(*args, **kwargs)
+    Scenario.bumpVersion()
+
+  @classmethod
+  def invalidateCache(cls):
+    cls._cache = None
+    cls._checked = 0
+
+  @classmethod
+  def bumpVersion(cls):
+    '''
+    Publishes a new version of the scenario list, which invalidates the
+    cache of all processes.
+    '''
+    param = Parameter.objects.using(DEFAULT_DB_ALIAS).get_or_create(name='scenario.version')[0]
+    param.value = str(datetime.now())
+    param.description = 'Version of the scenario list, updated by each change to a scenario'
+    param.save(using=DEFAULT_DB_ALIAS)
+    cls.invalidateCache()
+
+  @classmethod
+  def getScenarios(cls, refresh=False):
+    '''
+    Returns a dictionary with the status of all scenarios, read from the
+    cache when its version is still current.
+    '''
+    scenarios = cls._cache
+    now = time()
+    if scenarios is not None and not refresh and now - cls._checked < cls.checkInterval:
+      cls.cacheHits += 1
+      return scenarios
+    version = Parameter.getValue('scenario.version', DEFAULT_DB_ALIAS)
+    cls._checked = now
+    if scenarios is None or refresh or version != cls._version:
+      scenarios = {
+        i.name: i.status
+        for i in Scenario.objects.using(DEFAULT_DB_ALIAS).only('name', 'status')
+        }
+      cls._cache = scenarios
+      cls._version = version
+      cls.cacheMisses += 1
+    else:
+      cls.cacheHits += 1
+    return scenarios
+
   @staticmethod
   def syncWithSettings():
     try:
@@ -470,3 +687,25 @@ class BucketDetail(AuditModel):
     db_table = 'common_bucketdetail'
     unique_together = (('bucket', 'startdate'),)
     ordering = ['bucket', 'startdate']
+
+
+class WidgetCache(models.Model):
+  '''
+  Rendered content of dashboard widgets.
+  An entry is only valid for the plan version it was rendered for.
+  See the class freppledb.common.dashboard.Dashboard.
+  '''
+  # Database fields
+  cachekey = models.CharField(_('key'), max_length=32, primary_key=True)
+  widget = models.CharField(_('widget'), max_length=300, db_index=True)
+  version = models.CharField(_('version'), max_length=60)
+  content = models.TextField(_('content'))
+  lastmodified = models.DateTimeField(_('last modified'), default=timezone.now, editable=False)
+
+  def __str__(self):
+    return "%s %s" % (self.widget, self.cachekey)
+
+  class Meta:
+    db_table = 'common_widgetcache'
+    verbose_name = _('widget cache')
+    verbose_name_plural = _('widget cache')
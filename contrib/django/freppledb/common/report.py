@@ -30,6 +30,7 @@ It provides the following functionality:
 
 import codecs
 import collections
+from copy import copy
 import csv
 from datetime import datetime, timedelta
 from decimal import Decimal
@@ -37,8 +38,11 @@ import functools
 import math
 import operator
 import json
-from io import StringIO, BytesIO
+from io import StringIO
+from itertools import count
 from openpyxl import load_workbook, Workbook
+from tempfile import TemporaryFile
+from time import time
 
 from django.apps import apps
 from django.contrib.auth.models import Group
@@ -48,11 +52,12 @@ from django.views.decorators.csrf import csrf_protect
 from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.admin.utils import unquote, quote
-from django.core.exceptions import ValidationError
+from django.core.exceptions import ValidationError, NON_FIELD_ERRORS
 from django.core.management.color import no_style
 from django.db import connections, transaction, models
 from django.db.models.fields import Field, CharField, IntegerField, AutoField
 from django.db.models.fields.related import RelatedField
+from django.forms import ModelForm, ModelChoiceField
 from django.forms.models import modelform_factory
 from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.http import HttpResponseForbidden, HttpResponseNotAllowed
@@ -71,7 +76,8 @@ from django.contrib.contenttypes.models import ContentType
 from django.views.generic.base import View
 
 from freppledb.boot import getAttributes
-from freppledb.common.models import User, Comment, Parameter, BucketDetail, Bucket, HierarchyModel
+from freppledb.common.dashboard import Dashboard
+from freppledb.common.models import User, Comment, Parameter, BucketDetail, Bucket, HierarchyModel, AuditModel
 
 
 import logging
@@ -277,6 +283,318 @@ class EncodedCSVReader:
     return self
 
 
+class CachedModelChoiceField(ModelChoiceField):
+  '''
+  A form field for a foreign key that remembers the records it looked up.
+  All copies of the field, one for each form instance, share the cache.
+  '''
+  def __init__(self, *args, **kwargs):
+    super(CachedModelChoiceField, self).__init__(*args, **kwargs)
+    self.cache = {}
+
+  def prefetch(self, values):
+    '''
+    Reads all records referred to by a list of values with a single query.
+    '''
+    key = self.to_field_name or 'pk'
+    values = set([ force_text(v) for v in values if v not in self.empty_values ]) - set(self.cache)
+    if not values:
+      return
+    try:
+      for obj in self.queryset.filter(**{'%s__in' % key: list(values)}):
+        self.cache[force_text(obj.serializable_value(self.to_field_name) if self.to_field_name else obj.pk)] = obj
+    except (ValueError, TypeError):
+      pass  # Invalid values are reported during the validation
+
+  def to_python(self, value):
+    if value in self.empty_values:
+      return None
+    try:
+      return self.cache[force_text(value)]
+    except KeyError:
+      obj = super(CachedModelChoiceField, self).to_python(value)
+      self.cache[force_text(value)] = obj
+      return obj
+
+
+class BulkUploadForm(ModelForm):
+  '''
+  Base class for the forms validating the uploaded data.
+  The unique constraints aren't validated for every row: the database
+  verifies them when a batch of records is saved. When a batch fails, the
+  rows violating a constraint are reported with the messages of the model
+  validation (see BulkUpload.getErrors).
+  '''
+  def validate_unique(self):
+    pass
+
+
+class BulkUpload(object):
+  '''
+  Validates and saves the records of an upload in batches.
+
+  The existing records and the referenced records of a batch are read with
+  a single query. New records are inserted with bulk_create, and changed
+  records are updated with a single statement. One log entry records the
+  complete upload.
+  When saving a batch fails, its records are saved one by one to report the
+  failing rows. Models with a custom save method are always saved one by one.
+  '''
+  batchsize = 1000
+
+  def __init__(self, request, model, form, has_pk_field):
+    self.request = request
+    self.database = request.database
+    self.model = model
+    self.form = form
+    self.has_pk_field = has_pk_field
+    self.changed = 0
+    self.added = 0
+    self.rows = []
+    self.keys = set()
+    self.existing = {}
+    self.pending = collections.OrderedDict()
+    self.bulk = not BulkUpload.hasCustomSave(model)
+
+  @staticmethod
+  def hasCustomSave(model):
+    for cls in model.__mro__:
+      if cls in (AuditModel, HierarchyModel, models.Model):
+        return False
+      if 'save' in cls.__dict__:
+        return True
+    return False
+
+  def getKey(self, rownumber, data):
+    if self.has_pk_field:
+      try:
+        key = self.model._meta.pk.to_python(data.get(self.model._meta.pk.name, None))
+        if key is not None and key != '':
+          return key
+      except ValidationError:
+        pass
+    return ('row', rownumber)
+
+  def add(self, rownumber, data):
+    '''
+    Adds a data row to the upload. Returns a generator with error messages.
+    '''
+    key = self.getKey(rownumber, data)
+    if key in self.keys:
+      # The same record appears twice in the batch
+      for msg in self.process():
+        yield msg
+    self.rows.append( (rownumber, key, data) )
+    self.keys.add(key)
+    if len(self.rows) >= self.batchsize:
+      for msg in self.process():
+        yield msg
+
+  def finish(self):
+    '''
+    Saves the remaining records and logs the upload.
+    '''
+    for msg in self.process():
+      yield msg
+    for msg in self.save():
+      yield msg
+    if self.changed or self.added:
+      LogEntry(
+        user_id=self.request.user.pk,
+        content_type_id=ContentType.objects.get_for_model(self.model).pk,
+        object_repr=force_text(self.model._meta.verbose_name_plural),
+        action_flag=self.added and ADDITION or CHANGE,
+        change_message=_('Uploaded data successfully: changed %(changed)d and added %(added)d records') % {'changed': self.changed, 'added': self.added}
+        ).save(using=self.database)
+
+  def process(self):
+    '''
+    Validates a batch of rows.
+    '''
+    rows = self.rows
+    self.rows = []
+    self.keys = set()
+    if not rows:
+      return
+
+    # Read the existing records and referenced records
+    if self.has_pk_field:
+      keys = [ key for rownumber, key, data in rows if not isinstance(key, tuple) and key not in self.existing ]
+      if keys:
+        self.existing.update(self.model.objects.using(self.database).in_bulk(keys))
+    for name, field in self.form.base_fields.items():
+      if isinstance(field, CachedModelChoiceField):
+        field.prefetch([ data.get(name, None) for rownumber, key, data in rows ])
+
+    for rownumber, key, data in rows:
+      form = self.getForm(key, data)
+      if not form.has_changed():
+        continue
+      if not form.is_valid() and self.pending:
+        # The row can refer to a record saved in the same batch
+        for msg in self.save():
+          yield msg
+        form = self.getForm(key, data)
+      if form.is_valid():
+        self.pending[key] = (rownumber, form.save(commit=False), key not in self.existing)
+      else:
+        for error in form.non_field_errors():
+          yield force_text(
+            _('Row %(rownum)s: %(message)s') % {
+              'rownum': rownumber, 'message': error
+            }) + '\n '
+        for field in form:
+          for error in field.errors:
+            yield force_text(
+              _('Row %(rownum)s field %(field)s: %(data)s: %(message)s') % {
+                'rownum': rownumber, 'data': data[field.name],
+                'field': field.name, 'message': error
+              }) + '\n '
+
+  def getForm(self, key, data):
+    # Forms update the instance, also when the data is invalid. We give them a copy.
+    if key in self.pending:
+      instance = copy(self.pending[key][1])
+    elif key in self.existing:
+      instance = copy(self.existing[key])
+    else:
+      instance = None
+    return self.form(data, instance=instance)
+
+  def save(self):
+    '''
+    Saves the pending records.
+    '''
+    pending = self.pending
+    self.pending = collections.OrderedDict()
+    if not pending:
+      return
+    placed = []
+    for key, (rownumber, obj, new) in pending.items():
+      if isinstance(obj, AuditModel):
+        obj.lastmodified = datetime.now()
+      if isinstance(obj, HierarchyModel):
+        # New and moved nodes are positioned after saving them
+        if new:
+          obj.lft = None
+          obj.rght = None
+          obj.lvl = None
+          placed.append(obj.pk)
+        elif self.existing[key].owner_id != obj.owner_id:
+          placed.append(obj.pk)
+    ok = False
+    if self.bulk:
+      try:
+        with transaction.atomic(using=self.database):
+          added = [ obj for rownumber, obj, new in pending.values() if new ]
+          changed = [ obj for rownumber, obj, new in pending.values() if not new ]
+          self.model.objects.using(self.database).bulk_create(added)
+          _bulkUpdate(self.model, changed, self.database)
+          if placed:
+            self.model.placeNodes(placed, self.database)
+          self.added += len(added)
+          self.changed += len(changed)
+          ok = True
+      except Exception:
+        pass  # Retry the rows one by one to find the failing rows
+    if not ok:
+      for key, (rownumber, obj, new) in list(pending.items()):
+        try:
+          with transaction.atomic(using=self.database):
+            obj.save(using=self.database)
+          if new:
+            self.added += 1
+          else:
+            self.changed += 1
+        except Exception as e:
+          del pending[key]
+          for msg in self.getErrors(rownumber, obj, e):
+            yield msg
+    for key, (rownumber, obj, new) in pending.items():
+      obj._state.adding = False
+      obj._state.db = self.database
+      if not isinstance(key, tuple):
+        self.existing[key] = obj
+
+
+  def getErrors(self, rownumber, obj, exception):
+    '''
+    Returns the messages for a record that couldn't be saved.
+    Violations of a unique constraint are reported with the same messages
+    as the validation of a form.
+    '''
+    try:
+      obj.validate_unique()
+    except ValidationError as e:
+      for field, errors in e.message_dict.items():
+        for error in errors:
+          if field == NON_FIELD_ERRORS:
+            yield force_text(
+              _('Row %(rownum)s: %(message)s') % {
+                'rownum': rownumber, 'message': error
+              }) + '\n '
+          else:
+            yield force_text(
+              _('Row %(rownum)s field %(field)s: %(data)s: %(message)s') % {
+                'rownum': rownumber, 'data': getattr(obj, field, ''),
+                'field': field, 'message': error
+              }) + '\n '
+      return
+    except Exception:
+      pass
+    yield force_text(
+      _('Row %(rownum)s: %(message)s') % {
+        'rownum': rownumber, 'message': exception
+      }) + '\n '
+
+
+class ReportCache(object):
+  '''
+  A cache, shared by all reports of this process, to remember the record
+  count and the page boundaries of a report query.
+
+  The entries expire after 'timeout' seconds. They are only valid for the
+  plan version they were created for: every plan export, every finished task
+  and every upload publish a new version in the parameter plan.version.
+  All processes see this version, and an upload also clears the cached
+  dashboard widgets of the database.
+  '''
+  timeout = 300
+
+  # Maximum number of entries
+  maxsize = 1000
+
+  _entries = {}
+
+  @classmethod
+  def _version(cls, database):
+    cursor = connections[database].cursor()
+    cursor.execute("select value from common_parameter where name = 'plan.version'")
+    row = cursor.fetchone()
+    return row and row[0]
+
+  @classmethod
+  def get(cls, database, key):
+    '''
+    Returns a dictionary to store information about a report query.
+    An empty dictionary is returned when the entry is expired or invalidated.
+    '''
+    version = cls._version(database)
+    now = time()
+    entry = cls._entries.get((database, key), None)
+    if entry and entry[0] == version and entry[1] > now:
+      return entry[2]
+    if len(cls._entries) >= cls.maxsize:
+      cls._entries.clear()
+    data = {}
+    cls._entries[(database, key)] = (version, now + cls.timeout, data)
+    return data
+
+  @classmethod
+  def invalidate(cls, database):
+    Dashboard.bumpPlanVersion(database)
+
+
 class GridReport(View):
   '''
   The base class for all jqgrid views.
@@ -541,22 +859,14 @@ class GridReport(View):
       query = reportclass._apply_sort(request, reportclass.filter_items(request, reportclass.basequeryset(request, args, kwargs), False).using(request.database))
     else:
       query = reportclass._apply_sort(request, reportclass.filter_items(request, reportclass.basequeryset).using(request.database))
-    for row in hasattr(reportclass, 'query') and reportclass.query(request, query) or query.values(*fields):
+    for row in hasattr(reportclass, 'query') and reportclass.query(request, query) or _iterateQueryset(query, fields):
       if hasattr(row, "__getitem__"):
         ws.append([ _getCellValue(row[f]) for f in fields ])
       else:
         ws.append([ _getCellValue(getattr(row, f)) for f in fields ])
 
-    # Write the spreadsheet from memory to a string and then to a HTTP response
-    output = BytesIO()
-    wb.save(output)
-    response = HttpResponse(
-      content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-      content=output.getvalue()
-      )
-    response['Content-Disposition'] = 'attachment; filename=%s.xlsx' % title
-    response['Cache-Control'] = "no-cache, no-store"
-    return response
+    # Stream the spreadsheet to the HTTP response
+    return _streamWorkbook(wb, title)
 
 
   @classmethod
@@ -594,10 +904,9 @@ class GridReport(View):
       query = reportclass._apply_sort(request, reportclass.filter_items(request, reportclass.basequeryset(request, args, kwargs), False).using(request.database))
     else:
       query = reportclass._apply_sort(request, reportclass.filter_items(request, reportclass.basequeryset).using(request.database))
-    for row in hasattr(reportclass, 'query') and reportclass.query(request, query) or query.values(*fields):
-      # Clear the return string buffer
-      sf.seek(0)
-      sf.truncate(0)
+    sf.seek(0)
+    sf.truncate(0)
+    for row in hasattr(reportclass, 'query') and reportclass.query(request, query) or _iterateQueryset(query, fields):
       # Build the return value, encoding all output
       if hasattr(row, "__getitem__"):
         writer.writerow([
@@ -609,8 +918,12 @@ class GridReport(View):
           force_text(_localize(getattr(row, f), decimal_separator), encoding=encoding, errors='ignore') if getattr(row, f) is not None else ''
           for f in fields
           ])
-      # Return string
-      yield sf.getvalue()
+      # Return the string when the buffer is full
+      if sf.tell() >= CSV_CHUNK_SIZE:
+        yield sf.getvalue()
+        sf.seek(0)
+        sf.truncate(0)
+    yield sf.getvalue()
 
 
   @classmethod
@@ -663,6 +976,81 @@ class GridReport(View):
       return "%s asc" % sort
 
 
+  @classmethod
+  def _cache_key(reportclass, args, request, *exclude):
+    '''
+    Returns a key identifying the report query of a request.
+    '''
+    return (
+      reportclass.getKey(), tuple(args),
+      tuple(sorted([ (k, v) for k, v in request.GET.items() if k not in exclude ]))
+      )
+
+
+  @classmethod
+  def _get_count(reportclass, request, args, query):
+    '''
+    Returns the number of records of a query. The count is only cached for
+    the output tables, which aren't changed between the tasks. Input tables
+    can also be edited with the REST API and the admin, which doesn't
+    invalidate the cache.
+    '''
+    if query.model._meta.app_label != 'output':
+      return query.count()
+    counts = ReportCache.get(request.database, reportclass._cache_key(args, request, 'page', 'rows', 'nd', 'sidx', 'sord'))
+    if 'count' not in counts:
+      counts['count'] = query.count()
+    return counts['count']
+
+
+  @classmethod
+  def _get_page(reportclass, request, args, query, page):
+    '''
+    Returns a sorted queryset with the records of a page.
+
+    The sort value and primary key of the last record on each page are
+    remembered. When the previous page is known, the page is retrieved
+    with a keyset condition instead of an offset. The time to retrieve a
+    page is then independent of its position in the report.
+    Queries without a sort on a single field use an offset.
+    '''
+    cnt = (page - 1) * request.pagesize + 1
+
+    # Find the sort field, which defaults to the ordering of the model
+    order = query.query.order_by
+    if not order and query.query.default_ordering:
+      order = query.model._meta.ordering
+    if len(order) != 1 or not isinstance(order[0], str) or order[0] == '?':
+      return query[cnt - 1:cnt + request.pagesize]
+    desc = order[0].startswith('-')
+    sortfield = order[0].lstrip('-')
+    if sortfield in query.query.extra_select or sortfield in query.query.annotations:
+      # Can't filter on this field
+      return query[cnt - 1:cnt + request.pagesize]
+    if sortfield == 'pk' or sortfield == query.model._meta.pk.name:
+      sortfield = None
+    if sortfield:
+      query = query.order_by(order[0], desc and '-pk' or 'pk')
+      keyfields = ('pk', sortfield)
+    else:
+      query = query.order_by(desc and '-pk' or 'pk')
+      keyfields = ('pk',)
+
+    # Retrieve the keys of the records on the page
+    pages = ReportCache.get(
+      request.database,
+      reportclass._cache_key(args, request, 'page', 'nd') + (request.pagesize,)
+      )
+    boundary = pages.get(page - 1, None)
+    if boundary:
+      keys = list(query.filter(_seekFilter(sortfield or 'pk', desc, boundary[-1], boundary[0])).values_list(*keyfields)[:request.pagesize + 1])
+    else:
+      keys = list(query.values_list(*keyfields)[cnt - 1:cnt + request.pagesize])
+    if len(keys) >= request.pagesize:
+      pages[page] = keys[request.pagesize - 1]
+    return query.filter(pk__in=[ k[0] for k in keys ])
+
+
   @classmethod
   def _generate_json_data(reportclass, request, *args, **kwargs):
     page = 'page' in request.GET and int(request.GET['page']) or 1
@@ -670,24 +1058,23 @@ class GridReport(View):
       query = reportclass.filter_items(request, reportclass.basequeryset(request, args, kwargs), False).using(request.database)
     else:
       query = reportclass.filter_items(request, reportclass.basequeryset).using(request.database)
-    recs = query.count()
+    recs = reportclass._get_count(request, args, query)
     total_pages = math.ceil(float(recs) / request.pagesize)
     if page > total_pages:
       page = total_pages
     if page < 1:
       page = 1
-    query = reportclass._apply_sort(request, query)
+    query = reportclass._get_page(request, args, reportclass._apply_sort(request, query), page)
 
     yield '{"total":%d,\n' % total_pages
     yield '"page":%d,\n' % page
     yield '"records":%d,\n' % recs
     yield '"rows":[\n'
-    cnt = (page - 1) * request.pagesize + 1
     first = True
 
     # GridReport
     fields = [ i.field_name for i in reportclass.rows if i.field_name ]
-    for i in hasattr(reportclass, 'query') and reportclass.query(request, query[cnt - 1:cnt + request.pagesize]) or query[cnt - 1:cnt + request.pagesize].values(*fields):
+    for i in hasattr(reportclass, 'query') and reportclass.query(request, query) or query.values(*fields):
       if first:
         r = [ '{' ]
         first = False
@@ -920,6 +1307,7 @@ class GridReport(View):
             ok = False
             resp.write(escape(e))
             resp.write('<br/>')
+    ReportCache.invalidate(request.database)
     if ok:
       resp.write("OK")
     resp.status_code = ok and 200 or 500
@@ -965,6 +1353,7 @@ class GridReport(View):
           )
 
     # Finished successfully
+    ReportCache.invalidate(request.database)
     return None
 
 
@@ -995,9 +1384,7 @@ class GridReport(View):
       # Init
       headers = []
       rownumber = 0
-      changed = 0
-      added = 0
-      content_type_id = ContentType.objects.get_for_model(reportclass.model).pk
+      uploader = None
 
       # Handle the complete upload as a single database transaction
       with transaction.atomic(using=request.database):
@@ -1050,9 +1437,11 @@ class GridReport(View):
             # Create a form class that will be used to validate the data
             UploadForm = modelform_factory(
               reportclass.model,
+              form=BulkUploadForm,
               fields=tuple([i.name for i in headers if isinstance(i, Field)]),
-              formfield_callback=lambda f: (isinstance(f, RelatedField) and f.formfield(using=request.database, localize=True)) or f.formfield(localize=True)
+              formfield_callback=lambda f: (isinstance(f, RelatedField) and f.formfield(using=request.database, localize=True, form_class=CachedModelChoiceField)) or f.formfield(localize=True)
               )
+            uploader = BulkUpload(request, reportclass.model, UploadForm, has_pk_field)
 
           ### Case 2: Skip empty rows and comments rows
           elif len(row) == 0 or row[0].startswith('#'):
@@ -1072,61 +1461,24 @@ class GridReport(View):
                   d[headers[colnum].name] = col
                 colnum += 1
 
-              # Step 2: Fill the form with data, either updating an existing
-              # instance or creating a new one.
-              if has_pk_field:
-                # A primary key is part of the input fields
-                try:
-                  # Try to find an existing record with the same primary key
-                  it = reportclass.model.objects.using(request.database).get(pk=d[reportclass.model._meta.pk.name])
-                  form = UploadForm(d, instance=it)
-                except reportclass.model.DoesNotExist:
-                  form = UploadForm(d)
-                  it = None
-              else:
-                # No primary key required for this model
-                form = UploadForm(d)
-                it = None
-
-              # Step 3: Validate the data and save to the database
-              if form.has_changed():
-                try:
-                  with transaction.atomic(using=request.database):
-                    obj = form.save(commit=False)
-                    obj.save(using=request.database)
-                    LogEntry(
-                      user_id=request.user.pk,
-                      content_type_id=content_type_id,
-                      object_id=obj.pk,
-                      object_repr=force_text(obj),
-                      action_flag=it and CHANGE or ADDITION,
-                      #. Translators: Translation included with Django
-                      change_message=_('Changed %s.') % get_text_list(form.changed_data, _('and'))
-                    ).save(using=request.database)
-                    if it:
-                      changed += 1
-                    else:
-                      added += 1
-                except Exception as e:
-                  # Validation fails
-                  for error in form.non_field_errors():
-                    yield force_text(
-                      _('Row %(rownum)s: %(message)s') % {
-                        'rownum': rownumber, 'message': error
-                      }) + '\n '
-                  for field in form:
-                    for error in field.errors:
-                      yield force_text(
-                        _('Row %(rownum)s field %(field)s: %(data)s: %(message)s') % {
-                          'rownum': rownumber, 'data': d[field.name],
-                          'field': field.name, 'message': error
-                        }) + '\n '
+              # Step 2: Validate the data and save it to the database in batches
+              for error in uploader.add(rownumber, d):
+                yield error
             except Exception as e:
               yield force_text(_("Exception during upload: %(message)s") % {'message': e}) + '\n '
 
+        # Save the remaining records
+        if uploader:
+          for error in uploader.finish():
+            yield error
+
       # Report all failed records
+      ReportCache.invalidate(request.database)
       yield force_text(
-          _('Uploaded data successfully: changed %(changed)d and added %(added)d records') % {'changed': changed, 'added': added}
+          _('Uploaded data successfully: changed %(changed)d and added %(added)d records') % {
+          'changed': uploader.changed if uploader else 0,
+          'added': uploader.added if uploader else 0
+          }
           ) + '\n '
 
 
@@ -1157,9 +1509,7 @@ class GridReport(View):
     # Init
     headers = []
     rownumber = 0
-    changed = 0
-    added = 0
-    content_type_id = ContentType.objects.get_for_model(reportclass.model).pk
+    uploader = None
 
     # Handle the complete upload as a single database transaction
     with transaction.atomic(using=request.database):
@@ -1213,9 +1563,11 @@ class GridReport(View):
           # Create a form class that will be used to validate the data
           UploadForm = modelform_factory(
             reportclass.model,
+            form=BulkUploadForm,
             fields=tuple([i.name for i in headers if isinstance(i, Field)]),
-            formfield_callback=lambda f: (isinstance(f, RelatedField) and f.formfield(using=request.database, localize=True)) or f.formfield(localize=True)
+            formfield_callback=lambda f: (isinstance(f, RelatedField) and f.formfield(using=request.database, localize=True, form_class=CachedModelChoiceField)) or f.formfield(localize=True)
             )
+          uploader = BulkUpload(request, reportclass.model, UploadForm, has_pk_field)
 
         ### Case 2: Skip empty rows and comments rows
         elif len(row) == 0 or (isinstance(row[0].value, six.string_types) and row[0].value.startswith('#')):
@@ -1239,61 +1591,24 @@ class GridReport(View):
                 d[headers[colnum].name] = data
               colnum += 1
 
-            # Step 2: Fill the form with data, either updating an existing
-            # instance or creating a new one.
-            if has_pk_field:
-              # A primary key is part of the input fields
-              try:
-                # Try to find an existing record with the same primary key
-                it = reportclass.model.objects.using(request.database).get(pk=d[reportclass.model._meta.pk.name])
-                form = UploadForm(d, instance=it)
-              except reportclass.model.DoesNotExist:
-                form = UploadForm(d)
-                it = None
-            else:
-              # No primary key required for this model
-              form = UploadForm(d)
-              it = None
-
-            # Step 3: Validate the data and save to the database
-            if form.has_changed():
-              try:
-                with transaction.atomic(using=request.database):
-                  obj = form.save(commit=False)
-                  obj.save(using=request.database)
-                  LogEntry(
-                    user_id=request.user.pk,
-                    content_type_id=content_type_id,
-                    object_id=obj.pk,
-                    object_repr=force_text(obj),
-                    action_flag=it and CHANGE or ADDITION,
-                    #. Translators: Translation included with Django
-                    change_message=_('Changed %s.') % get_text_list(form.changed_data, _('and'))
-                  ).save(using=request.database)
-                  if it:
-                    changed += 1
-                  else:
-                    added += 1
-              except Exception as e:
-                # Validation fails
-                for error in form.non_field_errors():
-                  yield force_text(
-                    _('Row %(rownum)s: %(message)s') % {
-                      'rownum': rownumber, 'message': error
-                    }) + '\n '
-                for field in form:
-                  for error in field.errors:
-                    yield force_text(
-                      _('Row %(rownum)s field %(field)s: %(data)s: %(message)s') % {
-                        'rownum': rownumber, 'data': d[field.name],
-                        'field': field.name, 'message': error
-                      }) + '\n '
+            # Step 2: Validate the data and save it to the database in batches
+            for error in uploader.add(rownumber, d):
+              yield error
           except Exception as e:
             yield force_text(_("Exception during upload: %(message)s") % {'message': e}) + '\n '
 
+      # Save the remaining records
+      if uploader:
+        for error in uploader.finish():
+          yield error
+
     # Report all failed records
+    ReportCache.invalidate(request.database)
     yield force_text(
-      _('Uploaded data successfully: changed %(changed)d and added %(added)d records') % {'changed': changed, 'added': added}
+      _('Uploaded data successfully: changed %(changed)d and added %(added)d records') % {
+        'changed': uploader.changed if uploader else 0,
+        'added': uploader.added if uploader else 0
+        }
       ) + '\n '
 
 
@@ -1555,27 +1870,20 @@ class GridPivot(GridReport):
     else:
       page = 'page' in request.GET and int(request.GET['page']) or 1
       if isinstance(reportclass.basequeryset, collections.Callable):
-        recs = reportclass.filter_items(request, reportclass.basequeryset(request, args, kwargs), False).using(request.database).count()
+        basequery = reportclass.filter_items(request, reportclass.basequeryset(request, args, kwargs), False).using(request.database)
       else:
-        recs = reportclass.filter_items(request, reportclass.basequeryset).using(request.database).count()
+        basequery = reportclass.filter_items(request, reportclass.basequeryset).using(request.database)
+      recs = reportclass._get_count(request, args, basequery)
       total_pages = math.ceil(float(recs) / request.pagesize)
       if page > total_pages:
         page = total_pages
       if page < 1:
         page = 1
-      cnt = (page - 1) * request.pagesize + 1
-      if isinstance(reportclass.basequeryset, collections.Callable):
-        query = reportclass.query(
-          request,
-          reportclass._apply_sort(request, reportclass.filter_items(request, reportclass.basequeryset(request, args, kwargs), False)).using(request.database)[cnt - 1:cnt + request.pagesize],
-          sortsql=reportclass._apply_sort_index(request)
-          )
-      else:
-        query = reportclass.query(
-          request,
-          reportclass._apply_sort(request, reportclass.filter_items(request, reportclass.basequeryset)).using(request.database)[cnt - 1:cnt + request.pagesize],
-          sortsql=reportclass._apply_sort_index(request)
-          )
+      query = reportclass.query(
+        request,
+        reportclass._get_page(request, args, reportclass._apply_sort(request, basequery), page),
+        sortsql=reportclass._apply_sort_index(request)
+        )
 
     # Generate header of the output
     yield '{"total":%d,\n' % total_pages
@@ -1668,11 +1976,10 @@ class GridPivot(GridReport):
     yield sf.getvalue()
 
     # Write the report content
+    sf.seek(0)
+    sf.truncate(0)
     if listformat:
       for row in query:
-        # Clear the return string buffer
-        sf.seek(0)
-        sf.truncate(0)
         # Data for rows
         if hasattr(row, "__getitem__"):
           fields = [
@@ -1696,9 +2003,12 @@ class GridPivot(GridReport):
             force_text(_localize(getattr(row, f[0]), decimal_separator), encoding=encoding, errors='ignore') if getattr(row, f[0]) is not None else ''
             for f in reportclass.crosses
             ])
-        # Return string
+        # Return the string when the buffer is full
         writer.writerow(fields)
-        yield sf.getvalue()
+        if sf.tell() >= CSV_CHUNK_SIZE:
+          yield sf.getvalue()
+          sf.seek(0)
+          sf.truncate(0)
     else:
       currentkey = None
       for row in query:
@@ -1713,9 +2023,6 @@ class GridPivot(GridReport):
           for cross in reportclass.crosses:
             if 'visible' in cross[1] and not cross[1]['visible']:
               continue
-            # Clear the return string buffer
-            sf.seek(0)
-            sf.truncate(0)
             fields = [
               force_text(row_of_buckets[0][s.name], encoding=encoding, errors='ignore')
               for s in reportclass.rows
@@ -1728,18 +2035,18 @@ class GridPivot(GridReport):
               force_text(_localize(bucket[cross[0]], decimal_separator), encoding=encoding, errors='ignore')
               for bucket in row_of_buckets
               ])
-            # Return string
             writer.writerow(fields)
+          # Return the string when the buffer is full
+          if sf.tell() >= CSV_CHUNK_SIZE:
             yield sf.getvalue()
+            sf.seek(0)
+            sf.truncate(0)
           currentkey = row[reportclass.rows[0].name]
           row_of_buckets = [row]
       # Write the last entity
       for cross in reportclass.crosses:
         if 'visible' in cross[1] and not cross[1]['visible']:
           continue
-        # Clear the return string buffer
-        sf.seek(0)
-        sf.truncate(0)
         fields = [
           force_text(row_of_buckets[0][s.name], encoding=encoding, errors='ignore')
           for s in reportclass.rows
@@ -1750,9 +2057,8 @@ class GridPivot(GridReport):
           force_text(_localize(bucket[cross[0]], decimal_separator), encoding=encoding, errors='ignore')
           for bucket in row_of_buckets
           ])
-        # Return string
         writer.writerow(fields)
-        yield sf.getvalue()
+    yield sf.getvalue()
 
 
   @classmethod
@@ -1844,20 +2150,142 @@ class GridPivot(GridReport):
           fields.extend([ _getCellValue(bucket[cross[0]]) for bucket in row_of_buckets ])
           ws.append(fields)
 
-    # Write the spreadsheet from memory to a string and then to a HTTP response
-    output = BytesIO()
-    wb.save(output)
-    response = HttpResponse(
-      content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-      content=output.getvalue()
-      )
-    response['Content-Disposition'] = 'attachment; filename=%s.xlsx' % reportclass.model._meta.model_name
-    response['Cache-Control'] = "no-cache, no-store"
-    return response
+    # Stream the spreadsheet to the HTTP response
+    return _streamWorkbook(wb, reportclass.model._meta.model_name)
 
 
 numericTypes = (Decimal, float) + six.integer_types
 
+# Size of the blocks of data sent to the browser when exporting a report
+CSV_CHUNK_SIZE = 1 << 16
+XLSX_CHUNK_SIZE = 1 << 16
+
+# Number of records retrieved at once from a server-side cursor
+CURSOR_CHUNK_SIZE = 2000
+
+_cursorcount = count(1)
+
+
+def chunkedCursor(database):
+  '''
+  Returns a cursor that leaves the result set on the database server.
+  Iterating over the cursor retrieves the records in chunks, which keeps
+  the memory usage flat for large reports.
+  The caller is responsible for closing the cursor.
+  '''
+  conn = connections[database]
+  if conn.vendor != 'postgresql':
+    return conn.cursor()
+  conn.ensure_connection()
+  cursor = conn.connection.cursor(name='report_%s' % next(_cursorcount), withhold=True)
+  cursor.itersize = CURSOR_CHUNK_SIZE
+  return cursor
+
+
+def _bulkUpdate(model, objs, database):
+  '''
+  Updates a list of model instances with a single statement per block of
+  records. Other databases than PostgreSQL save the instances one by one.
+  '''
+  if not objs:
+    return
+  connection = connections[database]
+  if connection.vendor != 'postgresql':
+    for obj in objs:
+      obj.save(using=database)
+    return
+  pk = model._meta.pk
+  fields = [pk] + [ f for f in model._meta.concrete_fields if not f.primary_key ]
+  if issubclass(model, HierarchyModel):
+    # The position in the hierarchy is maintained by the model
+    fields = [ f for f in fields if f.name not in ('lft', 'rght', 'lvl') ]
+  types = []
+  for f in fields:
+    t = f.db_type(connection)
+    types.append({'serial': 'integer', 'bigserial': 'bigint'}.get(t, t))
+  row = '(%s)' % ','.join([ 'cast(%%s as %s)' % t for t in types ])
+  cursor = connection.cursor()
+  for i in range(0, len(objs), 1000):
+    block = objs[i:i + 1000]
+    params = []
+    for obj in block:
+      params.extend([ f.get_db_prep_save(getattr(obj, f.attname), connection=connection) for f in fields ])
+    cursor.execute(
+      "update %s set %s from (values %s) as v(%s) where %s.%s = v.c0" % (
+        connection.ops.quote_name(model._meta.db_table),
+        ', '.join([ '%s = v.c%d' % (connection.ops.quote_name(f.column), j) for j, f in enumerate(fields) if j > 0 ]),
+        ','.join([ row ] * len(block)),
+        ','.join([ 'c%d' % j for j in range(len(fields)) ]),
+        connection.ops.quote_name(model._meta.db_table),
+        connection.ops.quote_name(pk.column)
+        ),
+      params
+      )
+
+
+def _seekFilter(field, desc, value, pk):
+  '''
+  Returns a condition selecting the records sorted after a given record.
+  As in PostgreSQL, null values are sorted after all other values in an
+  ascending sort, and before all other values in a descending sort.
+  '''
+  if field == 'pk':
+    return models.Q(pk__lt=pk) if desc else models.Q(pk__gt=pk)
+  if value is None:
+    if desc:
+      return models.Q(**{'%s__isnull' % field: True, 'pk__lt': pk}) | models.Q(**{'%s__isnull' % field: False})
+    else:
+      return models.Q(**{'%s__isnull' % field: True, 'pk__gt': pk})
+  if desc:
+    return models.Q(**{'%s__lt' % field: value}) | models.Q(**{field: value, 'pk__lt': pk})
+  else:
+    return models.Q(**{'%s__gt' % field: value}) | models.Q(**{field: value, 'pk__gt': pk}) | models.Q(**{'%s__isnull' % field: True})
+
+
+def _iterateQueryset(query, fields):
+  '''
+  Iterates over the values of a queryset with a server-side cursor.
+  '''
+  sql, params = query.values_list(*fields).query.sql_with_params()
+  cursor = chunkedCursor(query.db)
+  try:
+    cursor.execute(sql, params)
+    for row in cursor:
+      yield dict(zip(fields, row))
+  finally:
+    cursor.close()
+
+
+def _streamWorkbook(wb, filename):
+  '''
+  Saves a workbook in a temporary file and streams it to the browser.
+  The content length is set, so the browser can display the progress of
+  the download.
+  '''
+  output = TemporaryFile()
+  wb.save(output)
+  size = output.tell()
+  output.seek(0)
+
+  def readFile():
+    try:
+      while True:
+        data = output.read(XLSX_CHUNK_SIZE)
+        if not data:
+          break
+        yield data
+    finally:
+      output.close()
+
+  response = StreamingHttpResponse(
+    content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    streaming_content=readFile()
+    )
+  response['Content-Length'] = size
+  response['Content-Disposition'] = 'attachment; filename=%s.xlsx' % filename
+  response['Cache-Control'] = "no-cache, no-store"
+  return response
+
 
 def _localize(value, decimal_separator):
   '''
@@ -1950,16 +2378,8 @@ def exportWorkbook(request):
   if not ok:
     raise Exception(_("Nothing to export"))
 
-  # Write the excel from memory to a string and then to a HTTP response
-  output = BytesIO()
-  wb.save(output)
-  response = HttpResponse(
-    content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-    content=output.getvalue()
-    )
-  response['Content-Disposition'] = 'attachment; filename=frepple.xlsx'
-  response['Cache-Control'] = "no-cache, no-store"
-  return response
+  # Stream the spreadsheet to the HTTP response
+  return _streamWorkbook(wb, 'frepple')
 
 
 def importWorkbook(request):
@@ -2137,4 +2557,5 @@ def importWorkbook(request):
         _('%(rows)d data rows, changed %(changed)d and added %(added)d records, %(errors)d errors') %
           {'rows': rownum - 1, 'changed': changed, 'added': added, 'errors': numerrors}
         ) + '\n'
+    ReportCache.invalidate(request.database)
     yield force_text(_("Done")) + '\n'
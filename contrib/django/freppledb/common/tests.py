@@ -15,16 +15,21 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import json
 import os
 import os.path
 
 from django.conf import settings
 from django.core import management
+from django.db import DEFAULT_DB_ALIAS
 from django.http.response import StreamingHttpResponse
 from django.test import TestCase, TransactionTestCase
 from django.test.utils import override_settings
 
-from freppledb.common.models import User
+from freppledb.common.dashboard import Dashboard
+from freppledb.common.models import Parameter, Scenario, User, WidgetCache
+from freppledb.common.report import ReportCache
+from freppledb.input.models import Item
 import freppledb.common as common
 import freppledb.input as input
 
@@ -43,10 +48,72 @@ class DataLoadTest(TestCase):
     if not isinstance(response, StreamingHttpResponse):
       raise Exception("expected a streaming response")
     for i in response.streaming_content:
-      if b'"records":6,' in i:
+      if b'"records":15,' in i:
         return
     self.fail("Didn't find expected number of parameters")
 
+  def test_scenario_cache(self):
+    Scenario.invalidateCache()
+    misses = Scenario.cacheMisses
+    hits = Scenario.cacheHits
+    self.client.get('/about/')
+    response = self.client.get('/about/')
+    self.assertEqual(Scenario.cacheMisses, misses + 1)
+    self.assertGreater(Scenario.cacheHits, hits)
+    self.assertIn(b'"scenariocache"', response.content)
+    # A new version published by another process invalidates the cache
+    Parameter.objects.update_or_create(name='scenario.version', defaults={'value': 'other process'})
+    Scenario.getScenarios()
+    self.assertEqual(Scenario.cacheMisses, misses + 1)
+    Scenario._checked = 0
+    Scenario.getScenarios()
+    self.assertEqual(Scenario.cacheMisses, misses + 2)
+
+  def test_report_cache(self):
+    entry = ReportCache.get(DEFAULT_DB_ALIAS, 'test')
+    entry['count'] = 10
+    self.assertEqual(ReportCache.get(DEFAULT_DB_ALIAS, 'test'), {'count': 10})
+    # A new version published by another process invalidates the entries
+    Parameter.objects.update_or_create(name='plan.version', defaults={'value': 'other process'})
+    self.assertEqual(ReportCache.get(DEFAULT_DB_ALIAS, 'test'), {})
+    # The count of an input table isn't cached
+    response = self.client.get('/data/input/item/?format=json')
+    self.assertContains(response, '"records":%d,' % Item.objects.count())
+    Item(name='test item').save()
+    response = self.client.get('/data/input/item/?format=json')
+    self.assertContains(response, '"records":%d,' % Item.objects.count())
+
+  def test_widget_cache(self):
+    response = self.client.get('/widget/late_orders/?limit=20')
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(WidgetCache.objects.filter(widget='late_orders').count(), 1)
+    response2 = self.client.get('/widget/late_orders/?limit=20')
+    self.assertEqual(response.content, response2.content)
+    Dashboard.bumpPlanVersion()
+    self.assertEqual(WidgetCache.objects.count(), 0)
+
+  def test_widget_cache_inputs(self):
+    self.client.get('/widget/inventory_by_item/')
+    version = WidgetCache.objects.get(widget='inventory_by_item').version
+    # A change to an input table invalidates the cached content
+    Item(name='test item').save()
+    Item(name='test item 2').save()
+    self.client.get('/widget/inventory_by_item/')
+    version2 = WidgetCache.objects.get(widget='inventory_by_item').version
+    self.assertNotEqual(version2, version)
+    # Deleting a record that isn't the last modified one also invalidates it
+    Item.objects.filter(name='test item').delete()
+    self.client.get('/widget/inventory_by_item/')
+    self.assertNotEqual(WidgetCache.objects.get(widget='inventory_by_item').version, version2)
+
+  def test_widget_prewarm(self):
+    # Prewarmed widgets are found by the requests of the users
+    Dashboard.prewarm()
+    keys = set(WidgetCache.objects.values_list('cachekey', flat=True))
+    self.assertTrue(keys)
+    self.client.get('/widget/late_orders/')
+    self.assertEqual(set(WidgetCache.objects.values_list('cachekey', flat=True)), keys)
+
 
 @override_settings(INSTALLED_APPS=settings.INSTALLED_APPS + ('django.contrib.sessions',))
 class ExcelTest(TransactionTestCase):
@@ -369,6 +436,40 @@ class freppleREST(APITestCase):
     self.assertEqual(response.status_code, 204)
     self.assertEqual(input.models.Customer.objects.filter(category = 'TEST DELETE').count(), 0)
 
+  def test_api_bulk(self):
+    recordsnumber = input.models.Demand.objects.count()
+    # Create records from newline-delimited JSON
+    data = '\n'.join([
+      json.dumps({
+        "name": "Bulk order %s" % i, "item": "product", "location": None,
+        "due": "2013-12-01T00:00:00", "status": "open", "quantity": "10.0000",
+        "priority": 1
+        })
+      for i in range(50)
+      ])
+    response = self.client.post('/api/input/demand/', data, content_type='application/x-ndjson')
+    self.assertEqual(response.status_code, 201)
+    self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 50)
+    self.assertEqual(input.models.Demand.objects.count(), recordsnumber + 50)
+    # Update existing records and create a new one
+    data = [
+      {"name": "Bulk order 1", "quantity": "20.0000"},
+      {"name": "Bulk order 50", "item": "product", "due": "2013-12-01T00:00:00", "quantity": "5.0000"}
+      ]
+    response = self.client.put('/api/input/demand/?mode=bulk', data, format='json')
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(len(json.loads(b''.join(response.streaming_content).decode('utf-8'))), 2)
+    self.assertEqual(input.models.Demand.objects.count(), recordsnumber + 51)
+    self.assertEqual(input.models.Demand.objects.get(name='Bulk order 1').quantity, 20)
+    # An invalid record rejects the complete request
+    data = [
+      {"name": "Bulk order 2", "quantity": "30.0000"},
+      {"name": "Bulk order 51", "item": "unknown item", "due": "2013-12-01T00:00:00", "quantity": "5.0000"}
+      ]
+    response = self.client.put('/api/input/demand/?mode=bulk', data, format='json')
+    self.assertEqual(response.status_code, 400)
+    self.assertEqual(input.models.Demand.objects.get(name='Bulk order 2').quantity, 10)
+
   def test_api_customer(self):
     response = self.client.get('/api/input/customer/')
     self.assertEqual(response.status_code, 200)
@@ -36,7 +36,7 @@ from django.http import Http404, HttpResponseRedirect, HttpResponse, HttpRespons
 from django.views.decorators.csrf import csrf_protect
 from django.views.decorators.debug import sensitive_variables
 
-from freppledb.common.models import User, Parameter, Comment, Bucket, BucketDetail
+from freppledb.common.models import User, Parameter, Comment, Bucket, BucketDetail, Scenario
 from freppledb.common.report import GridReport, GridFieldLastModified, GridFieldText
 from freppledb.common.report import GridFieldBool, GridFieldDateTime, GridFieldInteger
 
@@ -50,7 +50,11 @@ logger = logging.getLogger(__name__)
 @staff_member_required
 def AboutView(request):
   return HttpResponse(
-     content=json.dumps({'version': VERSION, 'apps': settings.INSTALLED_APPS }),
+     content=json.dumps({
+       'version': VERSION,
+       'apps': settings.INSTALLED_APPS,
+       'scenariocache': {'hits': Scenario.cacheHits, 'misses': Scenario.cacheMisses}
+       }),
      content_type='application/json; charset=%s' % settings.DEFAULT_CHARSET
      )
 
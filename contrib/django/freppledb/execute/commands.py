@@ -22,7 +22,7 @@ from django.db import DEFAULT_DB_ALIAS
 from django.conf import settings
 
 from freppledb.common.models import Parameter
-from freppledb.execute.models import Task
+from freppledb.execute.progress import getProgress, reportProgress, checkCancel
 
 import frepple
 
@@ -46,35 +46,30 @@ def printWelcome(prefix='frepple', database=DEFAULT_DB_ALIAS):
     ))
 
 
-task = None
-
-
-def logProgress(val, database=DEFAULT_DB_ALIAS):
-  global task
-  if not task and 'FREPPLE_TASKID' in os.environ:
-    try:
-      task = Task.objects.all().using(database).get(pk=os.environ['FREPPLE_TASKID'])
-    except:
-      raise Exception("Task identifier not found")
-  if task:
-    if task.status == 'Canceling':
-      task.status = 'Cancelled'
-      task.save(using=database)
-      sys.exit(2)
-    else:
-      task.status = '%d%%' % val
-      task.save(using=database)
+def logProgress(val, database=DEFAULT_DB_ALIAS, end=None):
+  '''
+  Starts a new phase of the task, running from val percent till end percent.
+  Within the phase, the progress is reported with the function reportProgress
+  of the module freppledb.execute.progress.
+  The process exits when the user has cancelled the task.
+  '''
+  progress = getProgress(database)
+  if progress:
+    checkCancel(database)
+    progress.phase = (val, end or val)
+    progress.update(status='%d%%' % val)
+    if val >= 100:
+      progress.write()
 
 
 def logMessage(msg, status=None, database=DEFAULT_DB_ALIAS):
-  global task
-  if task:
-    task.message = msg
-    if status:
-      if status == 'Done':
-        task.finished = datetime.now()
-      task.status = status
-    task.save(using=database)
+  progress = getProgress(database)
+  if progress:
+    progress.update(
+      status=status, message=msg,
+      finished=datetime.now() if status == 'Done' else None
+      )
+    progress.write()
 
 
 def createPlan(database=DEFAULT_DB_ALIAS):
@@ -92,6 +87,10 @@ def createPlan(database=DEFAULT_DB_ALIAS):
     else:
       solver.loglevel = 0
 
+  # Report the progress as the demands get planned
+  def progressDemand(dem, mode):
+    planned[0] += 1
+    reportProgress(planned[0] / planned[1], database)
   # Create a solver where the plan type are defined by an environment variable
   try:
     plantype = int(os.environ['FREPPLE_PLANTYPE'])
@@ -113,14 +112,26 @@ def createPlan(database=DEFAULT_DB_ALIAS):
     #userexit_resource=debugResource,
     #userexit_demand=debugDemand
     )
+  if getProgress(database):
+    planned = [0, sum(1 for i in frepple.demands()) or 1]
+    solver.userexit_demand = progressDemand
   print("Plan type: ", plantype)
   print("Constraints: ", constraint)
   solver.solve()
+  # The solver can't be interrupted: an exception raised in a user exit is
+  # only logged by the engine.
+  checkCancel(database)
 
 
-def exportPlan(database=DEFAULT_DB_ALIAS):
-  from freppledb.execute.export_database_plan_postgresql import exportfrepple
-  exportfrepple()
+def exportPlan(database=DEFAULT_DB_ALIAS, stage=None):
+  from freppledb.execute.export_database_plan_postgresql import exportfrepple, DatabaseCopy, DatabaseDiffCopy, statistics
+  if Parameter.getValue('plan.differentialExport', database, 'false') == 'true':
+    exportfrepple(DatabaseDiffCopy)
+  else:
+    exportfrepple(DatabaseCopy)
+  if stage:
+    for table, (rows, seconds, dbseconds) in sorted(statistics.items()):
+      stage.add('export.%s' % table, rows=rows, walltime=seconds, dbtime=dbseconds)
 
 
 if __name__ == "__main__":
@@ -135,24 +146,33 @@ if __name__ == "__main__":
     settings.DATABASES[db]['NAME'] = settings.DATABASES[db]['TEST']['NAME']
 
   printWelcome(database=db)
-  logProgress(1, db)
+  logProgress(1, db, 33)
   frepple.printsize()
   print("\nStart loading data from the database at", datetime.now().strftime("%H:%M:%S"))
   from freppledb.execute.load import loadData
-  loadData(database=db, filter=None).run()
+  from freppledb.execute.stages import Stage
+  with Stage('load', db) as stage:
+    loader = loadData(
+      database=db, filter=None,
+      threads=int(Parameter.getValue('plan.loadThreads', db, '0'))
+      )
+    loader.run()
+    loader.recordStatistics(stage)
   frepple.printsize()
-  logProgress(33, db)
+  logProgress(33, db, 66)
   print("\nStart plan generation at", datetime.now().strftime("%H:%M:%S"))
-  createPlan(db)
+  with Stage('solve', db):
+    createPlan(db)
   frepple.printsize()
-  logProgress(66, db)
+  logProgress(66, db, 100)
 
   #print("\nStart exporting static model to the database at", datetime.now().strftime("%H:%M:%S"))
   #from freppledb.execute.export_database_static import exportStaticModel
   #exportStaticModel(database=db, source=None).run()
 
   print("\nStart exporting plan to the database at", datetime.now().strftime("%H:%M:%S"))
-  exportPlan(db)
+  with Stage('export', db) as stage:
+    exportPlan(db, stage)
 
   #print("\nStart saving the plan to flat files at", datetime.now().strftime("%H:%M:%S"))
   #from freppledb.execute.export_file_plan import exportfrepple as export_plan_to_file
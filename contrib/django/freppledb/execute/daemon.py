@@ -0,0 +1,274 @@
+#
+# Copyright (C) 2016 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+r'''
+A planning engine daemon which keeps the model in memory between runs.
+
+The code in this file is executed NOT by Django, but by the embedded Python
+interpreter from the frePPLe engine. It is started with the management
+command frepple_daemon.
+
+The daemon listens on a local socket. The port number and an access token
+are published in a file in the log directory. A client sends a single line
+with a JSON object, and receives a single line with a JSON reply.
+The following commands are supported:
+  - plan:
+    Applies the changes in the database to the model, generates a plan and
+    exports it.
+  - replan:
+    Generates a new plan without reading from the database.
+  - whatif:
+    Generates a plan with other constraints or plan type, and returns some
+    key figures of it. The plan isn't exported.
+  - export:
+    Exports the plan currently in memory.
+  - status:
+    Returns some information on the daemon.
+  - stop:
+    Shuts down the daemon.
+
+The frePPLe engine isn't thread-safe. The commands are processed one at a
+time, in the order they are received.
+'''
+import json
+import os
+import socket
+import sys
+from binascii import hexlify
+from datetime import datetime
+
+from django.db import DEFAULT_DB_ALIAS
+from django.conf import settings
+
+from freppledb.common.models import Parameter
+from freppledb.execute.commands import printWelcome, logProgress, logMessage, createPlan, exportPlan
+from freppledb.execute.load import loadData
+from freppledb.execute.management.commands.frepple_daemon import getPortFile
+from freppledb.execute.progress import stopProgress
+from freppledb.execute.stages import Stage
+
+import frepple
+
+
+class PlanningDaemon:
+
+  def __init__(self, database=DEFAULT_DB_ALIAS):
+    self.database = database
+    self.loader = None
+    self.running = False
+    self.started = datetime.now()
+    self.runs = 0
+    self.lastrun = None
+    self.token = hexlify(os.urandom(16)).decode('ascii')
+
+
+  def load(self):
+    '''
+    Brings the model in memory in line with the database.
+    '''
+    print("\nStart loading data from the database at", datetime.now().strftime("%H:%M:%S"))
+    with Stage('load', self.database) as stage:
+      if self.loader:
+        self.loader.refresh()
+      else:
+        self.loader = loadData(
+          database=self.database, filter=None, incremental=True,
+          threads=int(Parameter.getValue('plan.loadThreads', self.database, '0'))
+          )
+        self.loader.run()
+      self.loader.recordStatistics(stage)
+    frepple.printsize()
+
+
+  def startTask(self, args):
+    '''
+    Prepares the environment for a command.
+    The settings are passed to the engine scripts as environment variables,
+    in the same way as the frepple_run command does for a new process.
+    The method process restores the environment after the command.
+    '''
+    os.environ['FREPPLE_PLANTYPE'] = str(args.get('plantype', 1))
+    os.environ['FREPPLE_CONSTRAINT'] = str(args.get('constraint', 15))
+    if args.get('task'):
+      os.environ['FREPPLE_TASKID'] = str(args['task'])
+    else:
+      os.environ.pop('FREPPLE_TASKID', None)
+    if args.get('env'):
+      for i in args['env'].split(','):
+        j = i.split('=')
+        if len(j) == 1:
+          os.environ[j[0]] = '1'
+        else:
+          os.environ[j[0]] = j[1]
+    Stage.sequence = 0
+
+
+  def plan(self, args, reload=True, export=True):
+    self.startTask(args)
+    logProgress(1, self.database, 33)
+    if reload or not self.loader:
+      self.load()
+    else:
+      frepple.erase(False)
+    logProgress(33, self.database, 66)
+    print("\nStart plan generation at", datetime.now().strftime("%H:%M:%S"))
+    with Stage('solve', self.database):
+      createPlan(self.database)
+    frepple.printsize()
+    logProgress(66, self.database, 100)
+    if export:
+      self.export(args, newtask=False)
+    else:
+      logProgress(100, self.database)
+    self.runs += 1
+    self.lastrun = datetime.now()
+    print("\nFinished planning at", datetime.now().strftime("%H:%M:%S"))
+
+
+  def export(self, args, newtask=True):
+    if not self.loader:
+      raise Exception("No model loaded yet")
+    if newtask:
+      self.startTask(args)
+    print("\nStart exporting plan to the database at", datetime.now().strftime("%H:%M:%S"))
+    with Stage('export', self.database) as stage:
+      exportPlan(self.database, stage)
+    logProgress(100, self.database)
+
+
+  def whatif(self, args):
+    self.plan(args, reload=args.get('reload', False), export=False)
+    problems = {}
+    for i in frepple.problems():
+      problems[i.name] = problems.get(i.name, 0) + 1
+    return {'problems': problems}
+
+
+  def status(self, args):
+    return {
+      'database': self.database,
+      'processid': os.getpid(),
+      'started': str(self.started),
+      'loaded': self.loader is not None,
+      'runs': self.runs,
+      'lastrun': str(self.lastrun) if self.lastrun else None
+      }
+
+
+  def process(self, request):
+    '''
+    Executes a request and returns the reply.
+    '''
+    command = request.get('command')
+    environ = dict(os.environ)
+    try:
+      if command == 'plan':
+        self.plan(request)
+      elif command == 'replan':
+        self.plan(request, reload=False)
+      elif command == 'whatif':
+        return dict(self.whatif(request), status='ok')
+      elif command == 'export':
+        self.export(request)
+      elif command == 'status':
+        return dict(self.status(request), status='ok')
+      elif command == 'stop':
+        self.running = False
+      else:
+        return {'status': 'error', 'message': 'Unknown command %s' % command}
+      return {'status': 'ok'}
+    except SystemExit:
+      # Raised by checkCancel when the user cancels the task.
+      # The cancellation can interrupt the load halfway, and we reload the
+      # complete model in the next run.
+      print("Task cancelled")
+      self.loader = None
+      frepple.erase(True)
+      return {'status': 'cancelled'}
+    except Exception as e:
+      print("Error processing command %s: %s" % (command, e))
+      logMessage('%s' % e, 'Failed', self.database)
+      # The model in memory can't be trusted any longer
+      self.loader = None
+      frepple.erase(True)
+      return {'status': 'error', 'message': '%s' % e}
+    finally:
+      stopProgress()
+      # Settings of a command don't leak into the next one
+      os.environ.clear()
+      os.environ.update(environ)
+      sys.stdout.flush()
+
+
+  def serve(self):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    portfile = getPortFile(self.database)
+    fd = os.open(portfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+      f.write("%s %s\n" % (server.getsockname()[1], self.token))
+    print("Listening on port %s" % server.getsockname()[1])
+    sys.stdout.flush()
+    self.running = True
+    try:
+      while self.running:
+        conn, address = server.accept()
+        try:
+          stream = conn.makefile('rwb')
+          try:
+            request = json.loads(stream.readline().decode('utf-8'))
+          except ValueError:
+            continue
+          if not isinstance(request, dict) or request.get('token') != self.token:
+            reply = {'status': 'error', 'message': 'Access denied'}
+          else:
+            reply = self.process(request)
+          stream.write(json.dumps(reply).encode('utf-8') + b'\n')
+          stream.flush()
+        except socket.error as e:
+          print("Connection error: %s" % e)
+        finally:
+          conn.close()
+    finally:
+      server.close()
+      os.remove(portfile)
+      print("Stopped at", datetime.now().strftime("%H:%M:%S"))
+
+
+if __name__ == "__main__":
+  # Select database
+  try:
+    db = os.environ['FREPPLE_DATABASE'] or DEFAULT_DB_ALIAS
+  except:
+    db = DEFAULT_DB_ALIAS
+
+  # Use the test database if we are running the test suite
+  if 'FREPPLE_TEST' in os.environ:
+    settings.DATABASES[db]['NAME'] = settings.DATABASES[db]['TEST']['NAME']
+
+  printWelcome(prefix='daemon', database=db)
+  daemon = PlanningDaemon(db)
+
+  # Load the model right away, so the first plan is fast as well
+  try:
+    daemon.load()
+  except Exception as e:
+    print("Error loading the model: %s" % e)
+    daemon.loader = None
+    frepple.erase(True)
+  daemon.serve()
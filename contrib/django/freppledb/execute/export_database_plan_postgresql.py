@@ -21,16 +21,45 @@ PostgreSQL database.
 
 The code in this file is executed NOT by the Django web application, but by the
 embedded Python interpreter from the frePPLe engine.
+
+Three exporters are available:
+  - DatabaseCopy sends the data with the COPY protocol of the database
+    driver, over a pool of connections of this process. This is the default.
+  - DatabaseDiffCopy does the same, but only applies the differences with
+    the previous plan in a single transaction.
+  - DatabasePipe sends the data through a pipe to a psql process.
+
+By default the export functions run in 2 threads. When the parameter
+plan.exportThreads is bigger than 1, the model is split into that number of
+partitions instead, and each partition is exported by a separate thread
+over its own connection. The parameter plan.exportPartitioning selects how
+operations, buffers and resources are partitioned: on a hash of their name
+(default) or by the cluster number computed by the engine. Demands are
+always partitioned on a hash of their name. The entities are assigned to
+their partition in a single pass over the model, before the threads start.
+
+The threads generate the rows in Python, and only one of them can run
+Python code at any time. The speedup of more partitions comes from the
+database work running in parallel. Generating the rows doesn't run faster.
 '''
+from collections import deque
 from datetime import timedelta, datetime, date
 import os
+from queue import Queue, Empty
+import re
 from subprocess import Popen, PIPE
 from time import time
-from threading import Thread
+from threading import Thread, Lock
+from zlib import crc32
 
 from django.db import connections, DEFAULT_DB_ALIAS, transaction
 from django.conf import settings
 
+from freppledb.common.dashboard import Dashboard
+from freppledb.common.models import Parameter
+from freppledb.execute.progress import reportProgress, checkCancel, TaskCancelled
+from freppledb.input.models import Buffer
+
 import frepple
 
 if 'FREPPLE_DATABASE' in os.environ:
@@ -41,52 +70,81 @@ else:
 encoding = 'UTF8'
 timestamp = str(datetime.now())
 
+# Time buckets of the resource plan, shared by all exporter threads, and
+# the name of the bucket calendar they come from (empty for daily buckets)
+resourcebuckets = None
+resourcebucketname = ''
+resourcebuckets_lock = Lock()
+
 
 def truncate(process):
   print("Emptying database plan tables...")
   starttime = time()
-  process.stdin.write('truncate table out_demandpegging;\n'.encode(encoding))
-  process.stdin.write('truncate table out_problem, out_resourceplan, out_constraint;\n'.encode(encoding))
-  process.stdin.write('truncate table out_loadplan, out_flowplan, out_operationplan;\n'.encode(encoding))
-  process.stdin.write('truncate table out_demand;\n'.encode(encoding))
-  process.stdin.write("delete from purchase_order where status='proposed' or status is null;\n".encode(encoding))
-  process.stdin.write("delete from distribution_order where status='proposed' or status is null;\n".encode(encoding))
-  process.stdin.write("delete from operationplan where status='proposed' or status is null;\n".encode(encoding))
+  process.execute('truncate table out_demandpegging')
+  process.execute('truncate table out_problem, out_resourceplan, out_constraint')
+  process.execute('truncate table out_loadplan, out_flowplan, out_operationplan')
+  process.execute('truncate table out_demand')
+  process.execute("delete from purchase_order where status='proposed' or status is null")
+  process.execute("delete from distribution_order where status='proposed' or status is null")
+  process.execute("delete from operationplan where status='proposed' or status is null")
   print("Emptied plan tables in %.2f seconds" % (time() - starttime))
 
 
 def exportProblems(process):
   print("Exporting problems...")
   starttime = time()
-  process.stdin.write('COPY out_problem (entity, name, owner, description, startdate, enddate, weight) FROM STDIN;\n'.encode(encoding))
-  for i in frepple.problems():
-    process.stdin.write(("%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (
+  process.copy(
+    'out_problem (entity, name, owner, description, startdate, enddate, weight)',
+    ("%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (
        i.entity, i.name,
        isinstance(i.owner, frepple.operationplan) and i.owner.operation.name or i.owner.name,
        i.description, str(i.start), str(i.end),
        round(i.weight, 4)
-    )).encode(encoding))
-  process.stdin.write('\\.\n'.encode(encoding))
+      ) for i in frepple.problems())
+    )
   print('Exported problems in %.2f seconds' % (time() - starttime))
 
 
 def exportConstraints(process):
   print("Exporting constraints...")
   starttime = time()
-  process.stdin.write('COPY out_constraint (demand,entity,name,owner,description,startdate,enddate,weight) FROM STDIN;\n'.encode(encoding))
-  for d in frepple.demands():
-    for i in d.constraints:
-      process.stdin.write(("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (
-         d.name, i.entity, i.name,
-         isinstance(i.owner, frepple.operationplan) and i.owner.operation.name or i.owner.name,
-         i.description, str(i.start), str(i.end),
-         round(i.weight, 4)
-       )).encode(encoding))
-  process.stdin.write('\\.\n'.encode(encoding))
+  process.copy(
+    'out_constraint (demand,entity,name,owner,description,startdate,enddate,weight)',
+    ("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (
+       d.name, i.entity, i.name,
+       isinstance(i.owner, frepple.operationplan) and i.owner.operation.name or i.owner.name,
+       i.description, str(i.start), str(i.end),
+       round(i.weight, 4)
+      ) for d in frepple.demands() for i in d.constraints)
+    )
   print('Exported constraints in %.2f seconds' % (time() - starttime))
 
 
 def exportOperationplans(process):
+
+  def getOutOperationplans():
+    for i in process.entities('operations'):
+      opname = i.name[0:300]
+      for j in i.operationplans:
+        yield "%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (
+          j.id, opname, round(j.quantity, 4), str(j.start), str(j.end),
+          round(j.criticality, 4), j.locked, j.unavailable,
+          j.owner and j.owner.id or "\\N"
+          )
+
+  def getOperationplans():
+    for i in process.entities('operations'):
+      if isinstance(i, excluded_operations):
+        continue
+      opname = i.name[0:300]
+      for j in i.operationplans:
+        if not j.locked and not (j.demand or (j.owner and j.owner.demand)):
+          yield "%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (
+            j.id, opname, j.status, round(j.quantity, 4),
+            str(j.start), str(j.end), round(j.criticality, 4),
+            timestamp
+            )
+
   print("Exporting operationplans...")
   starttime = time()
   excluded_operations = (
@@ -98,110 +156,154 @@ def exportOperationplans(process):
   # TODO: the first part of the export is a redundant duplicate. We still need it for the pegging information... for now.
   # TODO: also run an update for the criticality of the existing, locked operationplan records
   # TODO: export of owner, export of demand delivery
-  process.stdin.write('COPY out_operationplan (id,operation,quantity,startdate,enddate,criticality,locked,unavailable,owner) FROM STDIN;\n'.encode(encoding))
-  for i in frepple.operations():
-    opname = i.name[0:300]
-    for j in i.operationplans:
-      process.stdin.write(("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (
-        j.id, opname, round(j.quantity, 4), str(j.start), str(j.end),
-        round(j.criticality, 4), j.locked, j.unavailable,
-        j.owner and j.owner.id or "\\N"
-        )).encode(encoding))
-  process.stdin.write('\\.\n'.encode(encoding))
-  process.stdin.write('COPY operationplan (id,operation_id,status,quantity,startdate,enddate,criticality,lastmodified) FROM STDIN;\n'.encode(encoding))
-  for i in frepple.operations():
-    if isinstance(i, excluded_operations):
-      continue
-    opname = i.name[0:300]
-    for j in i.operationplans:
-      if not j.locked and not (j.demand or (j.owner and j.owner.demand)):
-        process.stdin.write(("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (
-          j.id, opname, j.status, round(j.quantity, 4),
-          str(j.start), str(j.end), round(j.criticality, 4),
-          timestamp
-          )).encode(encoding))
-  process.stdin.write('\\.\n'.encode(encoding))
+  process.copy(
+    'out_operationplan (id,operation,quantity,startdate,enddate,criticality,locked,unavailable,owner)',
+    getOutOperationplans()
+    )
+  process.copy(
+    'operationplan (id,operation_id,status,quantity,startdate,enddate,criticality,lastmodified)',
+    getOperationplans()
+    )
   print('Exported operationplans in %.2f seconds' % (time() - starttime))
 
 
 def exportFlowplans(process):
   print("Exporting flowplans...")
   starttime = time()
-  process.stdin.write('COPY out_flowplan (operationplan_id, thebuffer, quantity, flowdate, onhand) FROM STDIN;\n'.encode(encoding))
-  for i in frepple.buffers():
-    for j in i.flowplans:
-      process.stdin.write(("%s\t%s\t%s\t%s\t%s\n" % (
-         j.operationplan.id, j.buffer.name,
-         round(j.quantity, 4),
-         str(j.date), round(j.onhand, 4)
-         )).encode(encoding))
-  process.stdin.write('\\.\n'.encode(encoding))
+  process.copy(
+    'out_flowplan (operationplan_id, thebuffer, quantity, flowdate, onhand)',
+    ("%s\t%s\t%s\t%s\t%s\n" % (
+       j.operationplan.id, j.buffer.name,
+       round(j.quantity, 4),
+       str(j.date), round(j.onhand, 4)
+      ) for i in process.entities('buffers') for j in i.flowplans)
+    )
   print('Exported flowplans in %.2f seconds' % (time() - starttime))
 
 
 def exportLoadplans(process):
   print("Exporting loadplans...")
   starttime = time()
-  process.stdin.write('COPY out_loadplan (operationplan_id, theresource, quantity, startdate, enddate, setup) FROM STDIN;\n'.encode(encoding))
-  for i in frepple.resources():
-    for j in i.loadplans:
-      if j.quantity < 0:
-        process.stdin.write(("%s\t%s\t%s\t%s\t%s\t%s\n" % (
-          j.operationplan.id, j.resource.name,
-          round(-j.quantity, 4),
-          str(j.startdate), str(j.enddate),
-          j.setup and j.setup or "\\N"
-          )).encode(encoding))
-  process.stdin.write('\\.\n'.encode(encoding))
+  process.copy(
+    'out_loadplan (operationplan_id, theresource, quantity, startdate, enddate, setup)',
+    ("%s\t%s\t%s\t%s\t%s\t%s\n" % (
+       j.operationplan.id, j.resource.name,
+       round(-j.quantity, 4),
+       str(j.startdate), str(j.enddate),
+       j.setup and j.setup or "\\N"
+      ) for i in process.entities('resources') for j in i.loadplans if j.quantity < 0)
+    )
   print('Exported loadplans in %.2f seconds' % (time() - starttime))
 
 
+def getResourceBuckets():
+  '''
+  Returns the list of time buckets of the resource plan.
+  The list is computed only once per export, and shared by all threads.
+  '''
+  global resourcebuckets, resourcebucketname
+  with resourcebuckets_lock:
+    if resourcebuckets is not None:
+      return resourcebuckets
+
+    # Determine start and end date of the reporting horizon
+    # The start date is computed as 5 weeks before the start of the earliest loadplan in
+    # the entire plan.
+    # The end date is computed as 5 weeks after the end of the latest loadplan in
+    # the entire plan.
+    # If no loadplans exist at all we use the current date +- 1 month.
+    startdate = datetime.max
+    enddate = datetime.min
+    for i in frepple.resources():
+      for j in i.loadplans:
+        if j.startdate < startdate:
+          startdate = j.startdate
+        if j.enddate > enddate:
+          enddate = j.enddate
+    if startdate == datetime.max:
+      startdate = frepple.settings.current
+    if enddate == datetime.min:
+      enddate = frepple.settings.current
+    startdate = (startdate - timedelta(days=30)).date()
+    enddate = (enddate + timedelta(days=30)).date()
+    if enddate > date(2030, 12, 30):  # This is the max frePPLe can represent.
+      enddate = date(2030, 12, 30)
+
+    # Build a list of horizon buckets.
+    # By default we use daily buckets. A bucket calendar can be configured
+    # with the parameter plan.resourceBucket.
+    bucket = Parameter.getValue('plan.resourceBucket', database, '')
+    buckets = []
+    if bucket:
+      cursor = connections[database].cursor()
+      cursor.execute('''
+        select startdate, enddate
+        from common_bucketdetail
+        where bucket_id = %s and enddate > %s and startdate < %s
+        order by startdate
+        ''', (bucket, startdate, enddate))
+      for start, end in cursor.fetchall():
+        buckets.append(start)
+      if buckets:
+        buckets.append(end)
+      else:
+        print("Warning: bucket %s has no dates in the plan horizon. Using daily buckets." % bucket)
+    if buckets:
+      resourcebucketname = bucket
+    else:
+      resourcebucketname = ''
+      while startdate < enddate:
+        buckets.append(startdate)
+        startdate += timedelta(days=1)
+    resourcebuckets = buckets
+    return buckets
+
+
 def exportResourceplans(process):
   print("Exporting resourceplans...")
   starttime = time()
+  buckets = getResourceBuckets()
+  sparse = Parameter.getValue('plan.resourceSparse', database, 'false') == 'true'
 
-  # Determine start and end date of the reporting horizon
-  # The start date is computed as 5 weeks before the start of the earliest loadplan in
-  # the entire plan.
-  # The end date is computed as 5 weeks after the end of the latest loadplan in
-  # the entire plan.
-  # If no loadplans exist at all we use the current date +- 1 month.
-  startdate = datetime.max
-  enddate = datetime.min
-  for i in frepple.resources():
-    for j in i.loadplans:
-      if j.startdate < startdate:
-        startdate = j.startdate
-      if j.enddate > enddate:
-        enddate = j.enddate
-  if startdate == datetime.max:
-    startdate = frepple.settings.current
-  if enddate == datetime.min:
-    enddate = frepple.settings.current
-  startdate = (startdate - timedelta(days=30)).date()
-  enddate = (enddate + timedelta(days=30)).date()
-  if enddate > date(2030, 12, 30):  # This is the max frePPLe can represent.
-    enddate = date(2030, 12, 30)
-
-  # Build a list of horizon buckets
-  buckets = []
-  while startdate < enddate:
-    buckets.append(startdate)
-    startdate += timedelta(days=1)
+  def resourceplans():
+    # In sparse mode a record is only created when the plan changes, and
+    # the plan is valid until the next record of the resource. A record with
+    # all zeroes closes the horizon of each resource.
+    # The reports densify these records again with ResourceSummary.densified().
+    for i in process.entities('resources'):
+      prev = None
+      for j in i.plan(buckets):
+        cur = (
+          round(j['available'], 4), round(j['unavailable'], 4),
+          round(j['setup'], 4), round(j['load'], 4), round(j['free'], 4)
+          )
+        if not sparse or cur != prev:
+          yield "%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % ((i.name, str(j['start'])) + cur)
+          prev = cur
+      if sparse and prev is not None:
+        yield "%s\t%s\t0\t0\t0\t0\t0\n" % (i.name, str(buckets[-1]))
 
   # Loop over all reporting buckets of all resources
-  process.stdin.write('COPY out_resourceplan (theresource,startdate,available,unavailable,setup,load,free) FROM STDIN;\n'.encode(encoding))
-  for i in frepple.resources():
-    for j in i.plan(buckets):
-      process.stdin.write(("%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (
-       i.name, str(j['start']),
-       round(j['available'], 4),
-       round(j['unavailable'], 4),
-       round(j['setup'], 4),
-       round(j['load'], 4),
-       round(j['free'], 4)
-       )).encode(encoding))
-  process.stdin.write('\\.\n'.encode(encoding))
+  process.copy(
+    'out_resourceplan (theresource,startdate,available,unavailable,setup,load,free)',
+    resourceplans()
+    )
+
+  # Record how the resource plan was exported. The reports need this to
+  # densify the records, also when the parameters are changed afterwards.
+  process.update(
+    "delete from common_parameter where name = %s",
+    [('plan.resourceExport',)]
+    )
+  process.update(
+    "insert into common_parameter (name, value, description, lastmodified) values (%s, %s, %s, %s)",
+    [(
+      'plan.resourceExport',
+      ('sparse %s' % resourcebucketname).strip() if sparse else 'dense',
+      'Layout of the exported resource plan, updated by each plan export',
+      datetime.now()
+      )]
+    )
   print('Exported resourceplans in %.2f seconds' % (time() - starttime))
 
 
@@ -232,40 +334,40 @@ def exportDemand(process):
 
   print("Exporting demand plans...")
   starttime = time()
-  process.stdin.write('COPY out_demand (demand,item,customer,due,quantity,plandate,planquantity,operationplan) FROM STDIN;\n'.encode(encoding))
-  for i in frepple.demands():
-    if i.quantity == 0:
-      continue
-    for j in deliveries(i):
-      process.stdin.write(("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % j).encode(encoding))
-  process.stdin.write('\\.\n'.encode(encoding))
+  process.copy(
+    'out_demand (demand,item,customer,due,quantity,plandate,planquantity,operationplan)',
+    ("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % j
+      for i in process.entities('demands') if i.quantity != 0 for j in deliveries(i))
+    )
   print('Exported demand plans in %.2f seconds' % (time() - starttime))
 
 
 def exportPegging(process):
+
+  def getPegging():
+    for i in process.entities('demands'):
+      # Find non-hidden demand owner
+      n = i
+      while n.hidden and n.owner:
+        n = n.owner
+      n = n and n.name or 'unspecified'
+      # Export pegging
+      for j in i.pegging:
+        yield "%s\t%s\t%s\t%s\n" % (
+          n, str(j.level),
+          j.operationplan.id, round(j.quantity, 4)
+          )
+
   print("Exporting pegging...")
   starttime = time()
-  process.stdin.write('COPY out_demandpegging (demand,level,operationplan,quantity) FROM STDIN;\n'.encode(encoding))
-  for i in frepple.demands():
-    # Find non-hidden demand owner
-    n = i
-    while n.hidden and n.owner:
-      n = n.owner
-    n = n and n.name or 'unspecified'
-    # Export pegging
-    for j in i.pegging:
-      process.stdin.write(("%s\t%s\t%s\t%s\n" % (
-        n, str(j.level),
-        j.operationplan.id, round(j.quantity, 4)
-        )).encode(encoding))
-  process.stdin.write('\\.\n'.encode(encoding))
+  process.copy('out_demandpegging (demand,level,operationplan,quantity)', getPegging())
   print('Exported pegging in %.2f seconds' % (time() - starttime))
 
 
 def exportPurchaseOrders(process):
 
   def getPOs(flag):
-    for i in frepple.operations():
+    for i in process.entities('operations'):
       if not isinstance(i, frepple.operation_itemsupplier):
         continue
       for j in i.operationplans:
@@ -276,27 +378,25 @@ def exportPurchaseOrders(process):
   starttime = time()
 
   # Export new proposed orders
-  process.stdin.write('COPY purchase_order (id,reference,item_id,location_id,supplier_id,quantity,startdate,enddate,criticality,source,status,lastmodified) FROM STDIN;\n'.encode(encoding))
-  for p in getPOs(True):
-    process.stdin.write(("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\tproposed\t%s\n" % (
-      p.id, p.reference or "\\N",
-      p.operation.buffer.item.name[0:300],
-      p.operation.buffer.location.name[0:300],
-      p.operation.itemsupplier.supplier.name[0:300],
-      round(p.quantity, 4), str(p.start), str(p.end),
-      round(p.criticality, 4),
-      p.source or "\\N",
-      timestamp
-      )).encode(encoding))
-  process.stdin.write('\\.\n'.encode(encoding))
+  process.copy(
+    'purchase_order (id,reference,item_id,location_id,supplier_id,quantity,startdate,enddate,criticality,source,status,lastmodified)',
+    ("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\tproposed\t%s\n" % (
+       p.id, p.reference or "\\N",
+       p.operation.buffer.item.name[0:300],
+       p.operation.buffer.location.name[0:300],
+       p.operation.itemsupplier.supplier.name[0:300],
+       round(p.quantity, 4), str(p.start), str(p.end),
+       round(p.criticality, 4),
+       p.source or "\\N",
+       timestamp
+      ) for p in getPOs(True))
+    )
 
   # Export existing orders
-  with transaction.atomic(using=database, savepoint=False):
-    cursor = connections[database].cursor()
-    cursor.executemany(
-      "update purchase_order set criticality=%s where id=%s",
-      [ (round(j.criticality, 4), j.id) for j in getPOs(False) ]
-      )
+  process.update(
+    "update purchase_order set criticality=%s where id=%s",
+    [ (round(j.criticality, 4), j.id) for j in getPOs(False) ]
+    )
 
   print('Exported purchase orders in %.2f seconds' % (time() - starttime))
 
@@ -304,7 +404,7 @@ def exportPurchaseOrders(process):
 def exportDistributionOrders(process):
 
   def getDOs(flag):
-    for i in frepple.operations():
+    for i in process.entities('operations'):
       if not isinstance(i, frepple.operation_itemdistribution):
         continue
       for j in i.operationplans:
@@ -315,96 +415,681 @@ def exportDistributionOrders(process):
   starttime = time()
 
   # Export new proposed orders
-  process.stdin.write('COPY distribution_order (id,reference,item_id,origin_id,destination_id,quantity,startdate,enddate,criticality,source,status,consume_material,lastmodified) FROM STDIN;\n'.encode(encoding))
-  for p in getDOs(True):
-    process.stdin.write(("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\tproposed\ttrue\t%s\n" % (
-      p.id, p.reference or "\\N",
-      p.operation.destination.item.name[0:300],
-      p.operation.origin.location.name[0:300],
-      p.operation.destination.location.name[0:300],
-      round(p.quantity, 4), str(p.start), str(p.end),
-      round(p.criticality, 4),
-      p.source or "\\N",
-      timestamp
-      )).encode(encoding))
-  process.stdin.write('\\.\n'.encode(encoding))
+  process.copy(
+    'distribution_order (id,reference,item_id,origin_id,destination_id,quantity,startdate,enddate,criticality,source,status,consume_material,lastmodified)',
+    ("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\tproposed\ttrue\t%s\n" % (
+       p.id, p.reference or "\\N",
+       p.operation.destination.item.name[0:300],
+       p.operation.origin.location.name[0:300],
+       p.operation.destination.location.name[0:300],
+       round(p.quantity, 4), str(p.start), str(p.end),
+       round(p.criticality, 4),
+       p.source or "\\N",
+       timestamp
+      ) for p in getDOs(True))
+    )
 
   # Update existing orders
-  with transaction.atomic(using=database, savepoint=False):
-    cursor = connections[database].cursor()
-    cursor.executemany(
-      "update distribution_order set criticality=%s where id=%s",
-      [ (round(j.criticality, 4), j.id) for j in getDOs(False) ]
-      )
+  process.update(
+    "update distribution_order set criticality=%s where id=%s",
+    [ (round(j.criticality, 4), j.id) for j in getDOs(False) ]
+    )
 
   print('Exported distribution orders in %.2f seconds' % (time() - starttime))
 
 
-class DatabasePipe(Thread):
+# Number of rows and seconds spent for each exported table
+statistics = {}
+statistics_lock = Lock()
+
+
+def aggregateInventory():
+  '''
+  Computes the inventory profile of all buffers in all time buckets, and
+  stores it in the table out_inventory. The quantities of a buffer include
+  all buffers in the hierarchy below it.
+  Only buckets with material movements are stored. Material movements before
+  the first bucket are counted in the first bucket.
+  The aggregation is skipped when the parameter plan.aggregateInventory is
+  false. The parameter plan.inventoryExport records whether the table is
+  filled, for the inventory report.
+  '''
+  aggregate = Parameter.getValue('plan.aggregateInventory', database, 'true').lower() == 'true'
+  if aggregate:
+    print("Aggregating inventory...")
+    starttime = time()
+    Buffer.rebuildHierarchy(database=database)
+  with transaction.atomic(using=database):
+    cursor = connections[database].cursor()
+    cursor.execute("delete from out_inventory")
+    cursor.execute("delete from common_parameter where name = 'plan.inventoryExport'")
+    cursor.execute(
+      "insert into common_parameter (name, value, description, lastmodified) values (%s, %s, %s, %s)",
+      (
+        'plan.inventoryExport', aggregate and 'aggregated' or 'none',
+        'Indicates whether the inventory profile is aggregated, updated by each plan export',
+        datetime.now()
+      ))
+    if not aggregate:
+      return
+    cursor.execute('''
+      insert into out_inventory
+        (thebuffer, bucket, startdate, enddate, produced, consumed, startoh, endoh)
+      with flows as (
+        select parent.name as thebuffer, d.bucket_id as bucket, d.startdate, d.enddate,
+          coalesce(sum(greatest(out_flowplan.quantity, 0)), 0) as produced,
+          coalesce(-sum(least(out_flowplan.quantity, 0)), 0) as consumed
+        from buffer parent
+        inner join buffer child
+          on child.lft between parent.lft and parent.rght
+        inner join out_flowplan
+          on out_flowplan.thebuffer = child.name
+        inner join common_bucketdetail d
+          on d.enddate > out_flowplan.flowdate
+          and (
+            d.startdate <= out_flowplan.flowdate
+            or d.startdate = (
+              select min(startdate) from common_bucketdetail first
+              where first.bucket_id = d.bucket_id
+              )
+            )
+        group by parent.name, d.bucket_id, d.startdate, d.enddate
+        ),
+      initial as (
+        select parent.name as thebuffer, sum(first.onhand - first.quantity) as onhand
+        from buffer parent
+        inner join buffer child
+          on child.lft between parent.lft and parent.rght
+        inner join (
+          select distinct on (thebuffer) thebuffer, onhand, quantity
+          from out_flowplan
+          order by thebuffer, flowdate, id
+          ) first
+          on first.thebuffer = child.name
+        group by parent.name
+        )
+      select thebuffer, bucket, startdate, enddate, produced, consumed,
+        endoh - produced + consumed, endoh
+      from (
+        select flows.thebuffer, flows.bucket, flows.startdate, flows.enddate,
+          flows.produced, flows.consumed,
+          coalesce(initial.onhand, 0) + sum(flows.produced - flows.consumed)
+            over (partition by flows.thebuffer, flows.bucket order by flows.startdate) as endoh
+        from flows
+        left outer join initial
+          on initial.thebuffer = flows.thebuffer
+        ) inventory
+      ''')
+    recordStatistics('out_inventory', cursor.rowcount, time() - starttime, time() - starttime)
+  print('Aggregated inventory in %.2f seconds' % (time() - starttime))
+
+
+def refreshWidgets():
+  '''
+  Publishes a new plan version, which invalidates the cached dashboard
+  widgets. When the parameter plan.prewarmWidgets is true, the widgets are
+  rendered again right away.
+  '''
+  Dashboard.bumpPlanVersion(database)
+  if Parameter.getValue('plan.prewarmWidgets', database, 'false').lower() == 'true':
+    print("Prewarming dashboard widgets...")
+    starttime = time()
+    cnt = Dashboard.prewarm(database)
+    print('Prewarmed %d dashboard widgets in %.2f seconds' % (cnt, time() - starttime))
+
+
+def recordStatistics(table, rows, seconds, dbseconds=None):
+  table = table.split(' ', 1)[0]
+  with statistics_lock:
+    stats = statistics.setdefault(table, [0, 0.0, None])
+    stats[0] += rows
+    stats[1] += seconds
+    if dbseconds is not None:
+      stats[2] = (stats[2] or 0) + dbseconds
+  print('Copied %d rows into %s in %.2f seconds (%d rows per second)' % (
+    rows, table, seconds, rows / seconds if seconds else 0
+    ))
+
+
+def printStatistics():
+  print("Export statistics:")
+  for table, (rows, seconds, dbseconds) in sorted(statistics.items()):
+    print("  %-20s %10d rows %10.2f seconds %10d rows per second" % (
+      table, rows, seconds, rows / seconds if seconds else 0
+      ))
+
+
+class DatabaseExporter(Thread):
+  '''
+  Base class for a thread running a list of export functions.
+  The optional argument 'partition' is a tuple (index, count, mode), which
+  limits the export to the entities of a single partition of the model.
+  '''
+  # Number of export functions finished and to be run, to report the progress
+  steps = [0, 0]
+  stepsLock = Lock()
+
+  # Entities of each category in each partition
+  partitions = {}
+
+  def __init__(self, *f, partition=None):
+    super(DatabaseExporter, self).__init__()
+    self.functions = f
+    self.partition = partition
+    self.exception = None
+
+  def runFunctions(self):
+    for f in self.functions:
+      checkCancel(database)
+      f(self)
+      with DatabaseExporter.stepsLock:
+        DatabaseExporter.steps[0] += 1
+        if DatabaseExporter.steps[1]:
+          reportProgress(DatabaseExporter.steps[0] / DatabaseExporter.steps[1], database)
+
+  def entities(self, category):
+    '''
+    Returns the entities of a category (operations, buffers, resources or
+    demands) that belong to the partition of this exporter.
+    '''
+    if not self.partition:
+      return getattr(frepple, category)()
+    return DatabaseExporter.partitions[category][self.partition[0]]
+
+  @staticmethod
+  def assignPartitions(count, mode):
+    '''
+    Assigns all entities to a partition, in a single pass over the model.
+    Entities are assigned to a partition by their cluster number, or by a
+    hash of their name. Demands are always assigned by name.
+    '''
+    DatabaseExporter.partitions = {}
+    for category in ('operations', 'buffers', 'resources', 'demands'):
+      result = [ [] for i in range(count) ]
+      if mode == 'cluster' and category != 'demands':
+        for i in getattr(frepple, category)():
+          result[i.cluster % count].append(i)
+      else:
+        for i in getattr(frepple, category)():
+          result[crc32(i.name.encode(encoding)) % count].append(i)
+      DatabaseExporter.partitions[category] = result
+
+  def update(self, sql, rows):
+    '''
+    Runs an update statement for each row of a list.
+    '''
+    with transaction.atomic(using=database, savepoint=False):
+      cursor = connections[database].cursor()
+      cursor.executemany(sql, rows)
+
+  @classmethod
+  def prepare(cls):
+    '''
+    Called before the export functions run.
+    '''
+    runExporters(cls, (truncate,))
+
+  @classmethod
+  def finish(cls):
+    '''
+    Called after all export functions are finished.
+    '''
+    pass
+
+  @classmethod
+  def close(cls):
+    '''
+    Called at the end of the export, also when it failed.
+    '''
+    pass
+
+
+class DatabasePipe(DatabaseExporter):
   '''
   An auxiliary class that allows us to run a function with its own
   PostgreSQL process pipe.
   '''
-  def __init__(self, *f):
-    super(DatabasePipe, self).__init__()
-    self.functions = f
+
+  def execute(self, sql):
+    self.process.stdin.write(("%s;\n" % sql).encode(encoding))
+
+  def copy(self, table, rows):
+    starttime = time()
+    cnt = 0
+    self.process.stdin.write(('COPY %s FROM STDIN;\n' % table).encode(encoding))
+    for row in rows:
+      self.process.stdin.write(row.encode(encoding))
+      cnt += 1
+    self.process.stdin.write('\\.\n'.encode(encoding))
+    recordStatistics(table, cnt, time() - starttime)
 
   def run(self):
     test = 'FREPPLE_TEST' in os.environ
 
     # Start a PSQL process
-    my_env = os.environ
+    my_env = os.environ.copy()
     my_env['PGPASSWORD'] = settings.DATABASES[database]['PASSWORD']
-    process = Popen("psql -q -w -U%s %s%s%s" % (
+    self.process = Popen("psql -q -w -U%s %s%s%s" % (
         settings.DATABASES[database]['USER'],
        settings.DATABASES[database]['HOST'] and ("-h %s " % settings.DATABASES[database]['HOST']) or '',
        settings.DATABASES[database]['PORT'] and ("-p %s " % settings.DATABASES[database]['PORT']) or '',
        settings.DATABASES[database]['TEST']['NAME'] if test else settings.DATABASES[database]['NAME'],
      ), stdin=PIPE, stderr=PIPE, bufsize=0, shell=True, env=my_env)
-    if process.returncode is None:
+    if self.process.returncode is None:
       # PSQL session is still running
-      process.stdin.write("SET statement_timeout = 0;\n".encode(encoding))
-      process.stdin.write("SET client_encoding = 'UTF8';\n".encode(encoding))
+      self.execute("SET statement_timeout = 0")
+      self.execute("SET client_encoding = 'UTF8'")
 
     # Run the functions sequentially
     try:
-      for f in self.functions:
-        f(process)
+      self.runFunctions()
     finally:
-      msg = process.communicate()[1]
+      msg = self.process.communicate()[1]
       if msg:
         print(msg)
       # Close the pipe and PSQL process
-      if process.returncode is None:
+      if self.process.returncode is None:
         # PSQL session is still running.
-        process.stdin.write('\\q\n'.encode(encoding))
-      process.stdin.close()
+        self.process.stdin.write('\\q\n'.encode(encoding))
+      self.process.stdin.close()
 
 
-def exportfrepple():
+class CopyStream(object):
   '''
-  This function exports the data from the frePPLe memory into the database.
-  The export runs in parallel over 4 connections to PostgreSQL.
+  A file-like object for the copy_expert method of the database driver.
+  It reads the rows from an iterator and returns them in large blocks.
+  The rows of the last blocks are remembered, so we can report the row
+  causing an error. The database can report the error a few blocks after
+  receiving the row, and we keep 'historysize' characters.
+  The time spent generating the rows is measured, to separate it from the
+  time spent in the database.
   '''
-  global timestamp
-  timestamp = str(datetime.now())
+  def __init__(self, rows, historysize=4 << 20):
+    self.rows = iter(rows)
+    self.count = 0
+    self.readtime = 0.0
+    self.history = deque()
+    self.historylength = 0
+    self.historysize = historysize
 
-  # Truncate
-  task = DatabasePipe(truncate)
-  task.start()
-  task.join()
+  def read(self, size=-1):
+    starttime = time()
+    try:
+      return self.readBlock(size)
+    finally:
+      self.readtime += time() - starttime
 
-  # Export process
-  tasks = (
-    DatabasePipe(exportResourceplans, exportDemand, exportProblems, exportConstraints),
-    DatabasePipe(exportPurchaseOrders, exportDistributionOrders, exportOperationplans, exportFlowplans, exportLoadplans, exportPegging)
-    )
+  def readBlock(self, size):
+    checkCancel(database)
+    data = []
+    length = 0
+    for row in self.rows:
+      self.count += 1
+      self.history.append(row)
+      data.append(row)
+      length += len(row)
+      if size > 0 and length >= size:
+        break
+    self.historylength += length
+    while self.historylength > self.historysize and len(self.history) > len(data):
+      self.historylength -= len(self.history.popleft())
+    return ''.join(data)
+
+  def getRow(self, line):
+    '''
+    Returns the row with the given line number, if we still remember it.
+    '''
+    idx = line - 1 - self.count + len(self.history)
+    if idx >= 0 and idx < len(self.history):
+      return self.history[idx].rstrip('\n')
+    return None
+
+
+class DatabaseCopy(DatabaseExporter):
+  '''
+  An auxiliary class that allows us to run a function over a database
+  connection of this process.
+  The data is sent with the COPY protocol of the database driver, in blocks
+  of 'buffersize' characters.
+  The connections are kept in a pool, and reused by the next exporter. They
+  are closed at the end of the export.
+  '''
+  buffersize = 1 << 20
+  pool = Queue()
+
+  @classmethod
+  def close(cls):
+    while True:
+      try:
+        conn = cls.pool.get_nowait()
+      except Empty:
+        break
+      try:
+        conn.close()
+      except Exception:
+        pass
+
+  @classmethod
+  def getConnection(cls):
+    try:
+      return cls.pool.get_nowait()
+    except Empty:
+      wrapper = connections[database]
+      conn = wrapper.get_new_connection(wrapper.get_connection_params())
+      conn.autocommit = True
+      with conn.cursor() as cursor:
+        cursor.execute("SET statement_timeout = 0")
+        cursor.execute("SET client_encoding = 'UTF8'")
+      return conn
+
+  def execute(self, sql):
+    with self.connection.cursor() as cursor:
+      cursor.execute(sql)
+
+  def copy(self, table, rows):
+    starttime = time()
+    stream = CopyStream(rows, 4 * self.buffersize)
+    with self.connection.cursor() as cursor:
+      try:
+        cursor.copy_expert('COPY %s FROM STDIN' % table, stream, size=self.buffersize)
+      except TaskCancelled:
+        raise
+      except Exception as e:
+        # Report the row causing the error
+        row = None
+        context = getattr(getattr(e, 'diag', None), 'context', None)
+        if context:
+          line = re.search(r'line (\d+)', context)
+          if line:
+            row = stream.getRow(int(line.group(1)))
+        raise Exception("Error exporting into %s: %s%s" % (
+          table.split(' ', 1)[0], str(e).strip(),
+          ("\nRow: %s" % row) if row else ''
+          ))
+    seconds = time() - starttime
+    recordStatistics(table, stream.count, seconds, seconds - stream.readtime)
+
+  def run(self):
+    self.connection = self.getConnection()
+    try:
+      self.runFunctions()
+    except Exception as e:
+      print("Error:", e)
+      self.exception = e
+    finally:
+      # Return the connection to the pool
+      if not self.connection.closed:
+        self.pool.put(self.connection)
+      # Close the connection Django opened in this thread for the updates
+      connections[database].close()
+
+
+class DatabaseDiffCopy(DatabaseCopy):
+  '''
+  An exporter that only writes the differences with the previous plan.
+
+  The export functions copy the new plan into staging tables. Next, a
+  single transaction deletes the records that disappeared from the plan
+  and inserts the new ones. Unchanged records aren't touched, and users
+  see either the complete previous or the complete new plan.
+
+  A record is identified by a fingerprint: a hash of all exported fields,
+  except the lastmodified timestamp. Identical records are numbered to
+  keep them apart.
+  The identifiers of the operationplans are assigned again in every planning
+  run. Before comparing, a new operationplan that matches an existing one on
+  its operation, quantity and dates gets the identifier of the existing one,
+  in all staging tables. Unchanged operationplans, and the flowplans, loadplans
+  and pegging referring to them, thus keep their identifier and aren't touched.
+
+  The updates of the existing orders are collected, and applied in the same
+  transaction.
+  '''
+
+  # Tables written by the export, and a condition selecting the records
+  # owned by the plan
+  tables = [
+    ('out_operationplan', None),
+    ('operationplan', "status = 'proposed' or status is null"),
+    ('purchase_order', "status = 'proposed' or status is null"),
+    ('distribution_order', "status = 'proposed' or status is null"),
+    ('out_flowplan', None),
+    ('out_loadplan', None),
+    ('out_resourceplan', None),
+    ('out_demand', None),
+    ('out_demandpegging', None),
+    ('out_problem', None),
+    ('out_constraint', None),
+    ]
+
+  # Columns referring to the identifier of an operationplan
+  idColumns = {
+    'out_operationplan': ('id', 'owner'),
+    'operationplan': ('id', 'owner_id'),
+    'purchase_order': ('id',),
+    'distribution_order': ('id',),
+    'out_flowplan': ('operationplan_id',),
+    'out_loadplan': ('operationplan_id',),
+    'out_demand': ('operationplan',),
+    'out_demandpegging': ('operationplan',),
+    }
+
+  # Columns exported in each table
+  columns = {}
+
+  # Update statements to run when applying the differences
+  updates = []
+  updatesLock = Lock()
+
+  @classmethod
+  def prepare(cls):
+    cls.columns = {}
+    cls.updates = []
+    conn = cls.getConnection()
+    with conn.cursor() as cursor:
+      for table, condition in cls.tables:
+        cursor.execute("drop table if exists tmp_%s" % table)
+        cursor.execute("create unlogged table tmp_%s (like %s including defaults)" % (table, table))
+    cls.pool.put(conn)
+
+  def copy(self, table, rows):
+    name, fields = table.split(' ', 1)
+    self.columns[name] = [ i.strip() for i in fields.strip(' ()').split(',') ]
+    super(DatabaseDiffCopy, self).copy("tmp_%s %s" % (name, fields), rows)
+
+  def update(self, sql, rows):
+    rows = list(rows)
+    with self.updatesLock:
+      self.updates.append((sql, rows))
+
+  @classmethod
+  def mapIdentifiers(cls, cursor):
+    '''
+    Gives the new operationplans the identifier of a matching existing one.
+
+    Identifiers used in both the previous and the new plan are left alone:
+    these are the confirmed operationplans loaded from the database.
+    Among the others, a new operationplan is matched with an existing one
+    that has the same operation, quantity and dates. Existing identifiers
+    that are mapped to don't appear in the new plan, so the renumbered
+    staging tables remain free of duplicate identifiers.
+    '''
+    if 'out_operationplan' not in cls.columns:
+      return
+    fingerprint = "md5(row(operation, quantity, startdate, enddate)::text)"
+    cursor.execute('''
+      create temporary table tmp_idmap on commit drop as
+      select s.id as newid, t.id as oldid
+      from (
+        select id, fp, row_number() over (partition by fp order by id) as rn
+        from (
+          select id, %s as fp from out_operationplan
+          where not exists (select 1 from tmp_out_operationplan where tmp_out_operationplan.id = out_operationplan.id)
+          ) x
+        ) t
+      inner join (
+        select id, fp, row_number() over (partition by fp order by id) as rn
+        from (
+          select id, %s as fp from tmp_out_operationplan
+          where not exists (select 1 from out_operationplan where out_operationplan.id = tmp_out_operationplan.id)
+          ) y
+        ) s
+      on t.fp = s.fp and t.rn = s.rn
+      ''' % (fingerprint, fingerprint))
+    cursor.execute("analyze tmp_idmap")
+    for table, columns in cls.idColumns.items():
+      for col in columns:
+        if col in cls.columns.get(table, ()):
+          cursor.execute('''
+            update tmp_%s set %s = tmp_idmap.oldid
+            from tmp_idmap where tmp_%s.%s = tmp_idmap.newid
+            ''' % (table, col, table, col))
+
+  @classmethod
+  def finish(cls):
+    print("Applying the differences with the previous plan...")
+    starttime = time()
+    conn = cls.getConnection()
+    conn.autocommit = False
+    try:
+      with conn.cursor() as cursor:
+        cls.mapIdentifiers(cursor)
+        for table, condition in cls.tables:
+          if table not in cls.columns:
+            continue
+          fields = cls.columns[table]
+          fingerprint = "md5(row(%s)::text)" % ','.join([ i for i in fields if i != 'lastmodified' ])
+          where = ("where %s" % condition) if condition else ''
+
+          # Delete records not present any longer
+          cursor.execute('''
+            delete from %s where ctid in (
+              select t.ctid
+              from (
+                select ctid, fp, row_number() over (partition by fp) as rn
+                from (select ctid, %s as fp from %s %s) x
+                ) t
+              left outer join (
+                select fp, row_number() over (partition by fp) as rn
+                from (select %s as fp from tmp_%s) y
+                ) s
+              on t.fp = s.fp and t.rn = s.rn
+              where s.fp is null
+              )
+            ''' % (table, fingerprint, table, where, fingerprint, table))
+          deleted = cursor.rowcount
+
+          # Insert new records
+          cursor.execute('''
+            insert into %s (%s)
+            select %s
+            from (
+              select *, row_number() over (partition by fp) as rn
+              from (select %s, %s as fp from tmp_%s) x
+              ) s
+            left outer join (
+              select fp, row_number() over (partition by fp) as rn
+              from (select %s as fp from %s %s) y
+              ) t
+            on s.fp = t.fp and s.rn = t.rn
+            where t.fp is null
+            ''' % (
+              table, ','.join(fields), ','.join([ "s.%s" % i for i in fields ]),
+              ','.join(fields), fingerprint, table, fingerprint, table, where
+            ))
+          print("Table %s: %d records deleted, %d records inserted" % (table, deleted, cursor.rowcount))
+
+        # Update the existing records
+        for sql, rows in cls.updates:
+          cursor.executemany(sql, rows)
+      conn.commit()
+    except Exception:
+      conn.rollback()
+      raise
+    finally:
+      conn.autocommit = True
+      with conn.cursor() as cursor:
+        for table, condition in cls.tables:
+          cursor.execute("drop table if exists tmp_%s" % table)
+      cls.pool.put(conn)
+    print("Applied the differences in %.2f seconds" % (time() - starttime))
+
+
+def runExporters(exporter, *groups, report=False):
+  '''
+  Runs groups of export functions in parallel, each in a separate thread.
+  A group is either a tuple of functions or an exporter instance.
+  With the argument 'report' the progress of the task is reported as the
+  functions finish.
+  '''
+  tasks = [ g if isinstance(g, DatabaseExporter) else exporter(*g) for g in groups ]
+  DatabaseExporter.steps = [0, sum(len(i.functions) for i in tasks) if report else 0]
   # Start all threads
   for i in tasks:
     i.start()
   # Wait for all threads to finish
   for i in tasks:
     i.join()
+  for i in tasks:
+    if getattr(i, 'exception', None):
+      # A thread stopped because the task got cancelled
+      checkCancel(database)
+      raise i.exception
+
+
+def exportfrepple(exporter=DatabaseCopy):
+  '''
+  This function exports the data from the frePPLe memory into the database.
+  The export runs in parallel over 2 connections to PostgreSQL, or over
+  the number of connections set in the parameter plan.exportThreads.
+  '''
+  global timestamp, resourcebuckets
+  timestamp = str(datetime.now())
+  resourcebuckets = None
+  statistics.clear()
+  try:
+    threads = int(Parameter.getValue('plan.exportThreads', database, '0'))
+  except ValueError:
+    threads = 0
+  partitioning = Parameter.getValue('plan.exportPartitioning', database, 'hash')
+  if partitioning not in ('hash', 'cluster'):
+    print("Warning: invalid value '%s' for parameter plan.exportPartitioning. Using 'hash'." % partitioning)
+    partitioning = 'hash'
+
+  try:
+    # Truncate, or prepare the staging tables
+    exporter.prepare()
+
+    # Export process
+    if threads > 1:
+      print("Exporting the plan in %d partitions by %s" % (threads, partitioning))
+      DatabaseExporter.assignPartitions(threads, partitioning)
+      runExporters(
+        exporter,
+        (exportProblems, exportConstraints),
+        *[
+          exporter(
+            exportResourceplans, exportDemand, exportPurchaseOrders, exportDistributionOrders,
+            exportOperationplans, exportFlowplans, exportLoadplans, exportPegging,
+            partition=(i, threads, partitioning)
+            )
+          for i in range(threads)
+          ],
+        report=True
+        )
+      DatabaseExporter.partitions = {}
+    else:
+      runExporters(
+        exporter,
+        (exportResourceplans, exportDemand, exportProblems, exportConstraints),
+        (exportPurchaseOrders, exportDistributionOrders, exportOperationplans, exportFlowplans, exportLoadplans, exportPegging),
+        report=True
+        )
+    exporter.finish()
+  finally:
+    exporter.close()
+  aggregateInventory()
+  printStatistics()
 
   # Report on the output
   cursor = connections[database].cursor()
@@ -417,58 +1102,46 @@ def exportfrepple():
     union select 'out_resourceplan', count(*) from out_resourceplan
     union select 'out_demandpegging', count(*) from out_demandpegging
     union select 'out_demand', count(*) from out_demand
+    union select 'out_inventory', count(*) from out_inventory
     union select 'purchase_order', count(*) from purchase_order
     union select 'distribution_order', count(*) from distribution_order
     order by 1
     ''')
   for table, recs in cursor.fetchall():
     print("Table %s: %d records" % (table, recs))
+  refreshWidgets()
 
 
-def exportfrepple_sequential():
+def exportfrepple_sequential(exporter=DatabaseCopy):
   '''
   This function exports the data from the frePPLe memory into the database.
   The export runs sequentially over s single connection to PostgreSQL.
   '''
-  test = 'FREPPLE_TEST' in os.environ
-
-  # Start a PSQL process
-  my_env = os.environ
-  my_env['PGPASSWORD'] = settings.DATABASES[database]['PASSWORD']
-  process = Popen("psql -q -w -U%s %s%s%s" % (
-      settings.DATABASES[database]['USER'],
-     settings.DATABASES[database]['HOST'] and ("-h %s " % settings.DATABASES[database]['HOST']) or '',
-     settings.DATABASES[database]['PORT'] and ("-p %s " % settings.DATABASES[database]['PORT']) or '',
-     test and settings.DATABASES[database]['TEST']['NAME'] or settings.DATABASES[database]['NAME'],
-   ), stdin=PIPE, stderr=PIPE, bufsize=0, shell=True, env=my_env)
-  if process.returncode is None:
-    # PSQL session is still running
-    process.stdin.write("SET statement_timeout = 0;\n".encode(encoding))
-    process.stdin.write("SET client_encoding = 'UTF8';\n".encode(encoding))
-
-  # Send all output to the PSQL process through a pipe
+  global timestamp, resourcebuckets
+  timestamp = str(datetime.now())
+  resourcebuckets = None
+  statistics.clear()
+
   try:
-    truncate(process)
-    exportProblems(process)
-    exportConstraints(process)
-    exportOperationplans(process)
-    exportPurchaseOrders(process)
-    exportDistributionOrders(process)
-    exportFlowplans(process)
-    exportLoadplans(process)
-    exportResourceplans(process)
-    exportDemand(process)
-    exportPegging(process)
+    # Truncate, or prepare the staging tables
+    exporter.prepare()
+
+    # Run all export functions in the current thread
+    task = exporter(
+      exportProblems, exportConstraints, exportOperationplans,
+      exportPurchaseOrders, exportDistributionOrders, exportFlowplans,
+      exportLoadplans, exportResourceplans, exportDemand, exportPegging
+      )
+    DatabaseExporter.steps = [0, len(task.functions)]
+    task.run()
+    if getattr(task, 'exception', None):
+      checkCancel(database)
+      raise task.exception
+    exporter.finish()
   finally:
-    # Print any error messages
-    msg = process.communicate()[1]
-    if msg:
-      print(msg)
-    # Close the pipe and PSQL process
-    if process.returncode is None:
-      # PSQL session is still running.
-      process.stdin.write('\\q\n'.encode(encoding))
-    process.stdin.close()
+    exporter.close()
+  aggregateInventory()
+  printStatistics()
 
   cursor = connections[database].cursor()
   cursor.execute('''
@@ -480,9 +1153,11 @@ def exportfrepple_sequential():
     union select 'out_resourceplan', count(*) from out_resourceplan
     union select 'out_demandpegging', count(*) from out_demandpegging
     union select 'out_demand', count(*) from out_demand
+    union select 'out_inventory', count(*) from out_inventory
     union select 'purchase_order', count(*) from purchase_order
     union select 'distribution_order', count(*) from distribution_order
     order by 1
     ''')
   for table, recs in cursor.fetchall():
     print("Table %s: %d records" % (table, recs or 0))
+  refreshWidgets()
@@ -25,12 +25,17 @@ It extracts the information fields from the database, and then uses the Python
 API of frePPLe to bring the data into the frePPLe C++ core engine.
 '''
 from datetime import datetime
+from itertools import count
 import os
+import sys
+from queue import Queue, Empty
+from threading import Condition, Thread, local
 from time import time
 
 from django.db import connections, DEFAULT_DB_ALIAS
 from django.conf import settings
 
+from freppledb.execute.progress import reportProgress, checkCancel
 from freppledb.input.models import Resource
 
 import frepple
@@ -38,7 +43,78 @@ import frepple
 
 class loadData(object):
 
-  def __init__(self, database=None, filter=None):
+  # Entities each loading step depends on.
+  # In a parallel load an entity is only created in the engine after all
+  # entities it refers to are loaded. The order of this list is also the
+  # order of a sequential load.
+  dependencies = [
+    ('loadCalendars', ()),
+    ('loadCalendarBuckets', ('loadCalendars',)),
+    ('loadLocations', ('loadCalendars',)),
+    ('loadCustomers', ()),
+    ('loadSuppliers', ()),
+    ('loadOperations', ('loadLocations',)),
+    ('loadSuboperations', ('loadOperations',)),
+    ('loadItems', ('loadOperations',)),
+    ('loadBuffers', ('loadItems', 'loadLocations', 'loadOperations')),
+    ('loadSetupMatrices', ()),
+    ('loadResources', ('loadCalendars', 'loadLocations', 'loadSetupMatrices')),
+    ('loadResourceSkills', ('loadResources',)),
+    ('loadItemSuppliers', ('loadSuppliers', 'loadBuffers', 'loadResources')),
+    ('loadItemDistributions', ('loadBuffers', 'loadResources')),
+    ('loadFlows', ('loadBuffers', 'loadSuboperations')),
+    ('loadLoads', ('loadResourceSkills', 'loadSuboperations')),
+    ('loadOperationPlans', ('loadFlows', 'loadLoads')),
+    ('loadPurchaseOrders', ('loadItemSuppliers', 'loadOperationPlans')),
+    ('loadDistributionOrders', ('loadItemDistributions', 'loadOperationPlans')),
+    ('loadDemand', ('loadCustomers', 'loadBuffers', 'loadOperationPlans')),
+    ]
+
+
+  # Tables of which the records are identified by their name in the engine.
+  # Changes in these tables can be applied incrementally to a model in memory.
+  # The list is ordered such that deleting the records in the reverse order
+  # deletes dependent objects first.
+  incrementalTables = [
+    ('calendar', 'calendar', 'loadCalendars', False),
+    ('location', 'location', 'loadLocations', False),
+    ('customer', 'customer', 'loadCustomers', False),
+    ('supplier', 'supplier', 'loadSuppliers', False),
+    ('operation', 'operation', 'loadOperations', True),
+    ('item', 'item', 'loadItems', False),
+    ('buffer', 'buffer', 'loadBuffers', True),
+    ('resource', 'resource', 'loadResources', True),
+    ('demand', 'demand', 'loadDemand', False),
+    ]
+
+  # Tables with operationplans, identified by their id in the engine.
+  incrementalOrders = [
+    ('operationplan', 'loadOperationPlans', 'and quantity >= 0'),
+    ('purchase_order', 'loadPurchaseOrders', ''),
+    ('distribution_order', 'loadDistributionOrders', ''),
+    ]
+
+  # Tables of which any change requires a complete reload of the model.
+  structuralTables = [
+    'calendarbucket', 'suboperation', 'setupmatrix', 'setuprule',
+    'resourceskill', 'itemsupplier', 'itemdistribution', 'flow', 'resourceload'
+    ]
+
+  # Fields that can't be reset to their default value in memory. Clearing
+  # any of them also requires a complete reload of the model.
+  # Structure: table, field
+  unresettableFields = [
+    ('buffer', 'producing_id'),
+    ('demand', 'operation_id'),
+    ('demand', 'maxlateness')
+    ]
+
+  # Margin in seconds for the difference between the clocks of the
+  # application servers and the database server.
+  syncWindow = 60
+
+
+  def __init__(self, database=None, filter=None, batchsize=10000, threads=None, incremental=False, reset=False):
     if database:
       self.database = database
     elif 'FREPPLE_DATABASE' in os.environ:
@@ -51,6 +127,243 @@ class loadData(object):
     else:
       self.filter_and = ""
       self.filter_where = ""
+    # Number of records we retrieve from the database in a single round trip.
+    # A value of 0 or None reads the complete result of a query in one go.
+    self.batchsize = batchsize
+    # Number of threads, each with its own database connection, that read
+    # the data in parallel. A value of 0 or None gives a sequential load.
+    self.threads = threads
+    # An incremental loader remembers the keys of the loaded records. It
+    # allows applying the changes since the previous load with sync().
+    self.incremental = incremental
+    # When reloading records already in memory, fields that are empty in the
+    # database need to be reset explicitly to their default value.
+    self.reset = reset
+    self.snapshot = None
+    self.synctime = None
+    self.filter = filter
+    self.cache = {}
+    self.cursorcount = count(1)
+    self.statistics = {}
+    self.local = local()
+
+
+  @property
+  def cursor(self):
+    '''
+    Database cursor of the current thread.
+    '''
+    try:
+      return self.local.cursor
+    except AttributeError:
+      self.local.cursor = connections[self.database].cursor()
+      return self.local.cursor
+
+
+  def closeCursor(self):
+    if hasattr(self.local, 'cursor'):
+      self.local.cursor.close()
+      del self.local.cursor
+
+
+  def fetch(self, sql):
+    '''
+    Generator that returns all records of a SQL query.
+
+    When a batch size is configured the query is executed with a server-side
+    cursor and the records are retrieved in batches of that size. The memory
+    use then no longer grows with the size of the query result.
+
+    In a parallel load the remaining batches are retrieved by a separate
+    thread, while the current one is creating the objects in the engine.
+    '''
+    stats = self.statistics.setdefault(getattr(self.local, 'stage', None), {
+      'records': 0, 'fetch': 0.0, 'wait': 0.0, 'construct': 0.0, 'total': 0.0
+      })
+    starttime = time()
+    if not self.batchsize:
+      self.cursor.execute(sql)
+      data = self.cursor.fetchall()
+      stats['records'] += len(data)
+      stats['fetch'] += time() - starttime
+      self.acquire()
+      for rec in data:
+        yield rec
+      return
+
+    conn = connections[self.database]
+    conn.ensure_connection()
+    # A cursor declared "with hold" can also be used outside of a transaction
+    cursor = conn.connection.cursor(
+      name="frepple_load_%s" % next(self.cursorcount), withhold=True
+      )
+    reader = None
+    try:
+      cursor.execute(sql)
+      batch = cursor.fetchmany(self.batchsize)
+      stats['fetch'] += time() - starttime
+      self.acquire()
+      if self.threads:
+        # Read the next batches in the background
+        queue = Queue(maxsize=2)
+        reader = Thread(target=self.readBatches, args=(cursor, queue, stats))
+        reader.daemon = True
+        reader.start()
+      while batch:
+        stats['records'] += len(batch)
+        for rec in batch:
+          yield rec
+        if self.threads:
+          batch = queue.get()
+          if isinstance(batch, Exception):
+            raise batch
+        else:
+          starttime = time()
+          batch = cursor.fetchmany(self.batchsize)
+          stats['fetch'] += time() - starttime
+    finally:
+      if reader and reader.is_alive():
+        # Unblock the reader when we stop before the end of the data
+        while reader.is_alive():
+          try:
+            queue.get(timeout=0.1)
+          except Empty:
+            pass
+      cursor.close()
+
+
+  def readBatches(self, cursor, queue, stats):
+    '''
+    Reads all remaining records from a cursor and puts them in a queue.
+    An empty batch marks the end of the data.
+    '''
+    try:
+      while True:
+        starttime = time()
+        batch = cursor.fetchmany(self.batchsize)
+        stats['fetch'] += time() - starttime
+        queue.put(batch)
+        if not batch:
+          break
+    except Exception as e:
+      queue.put(e)
+
+
+  def acquire(self):
+    '''
+    In a parallel load this method waits until all entities the current step
+    depends on are loaded and until no other step is creating objects in the
+    engine. The step keeps the lock until it finishes.
+    '''
+    if not self.threads or self.local.locked:
+      return
+    stage = self.local.stage
+    starttime = time()
+    with self.condition:
+      while True:
+        if self.error:
+          raise RuntimeError("Loading aborted after an error in another thread")
+        if not self.constructing and self.done.issuperset(self.requires[stage]):
+          break
+        self.condition.wait()
+      self.constructing = stage
+      self.local.locked = True
+    self.local.lockstart = time()
+    self.statistics[stage]['wait'] += self.local.lockstart - starttime
+
+
+  def runStep(self, stage):
+    '''
+    Executes a loading step and records its statistics.
+    '''
+    self.local.stage = stage
+    self.local.locked = False
+    stats = self.statistics[stage] = {
+      'records': 0, 'fetch': 0.0, 'wait': 0.0, 'construct': 0.0, 'total': 0.0
+      }
+    starttime = time()
+    try:
+      checkCancel(self.database)
+      getattr(self, stage)()
+    except Exception as e:
+      if not self.threads:
+        raise
+      with self.condition:
+        if not self.error:
+          self.error = e
+        self.condition.notify_all()
+    finally:
+      stats['total'] = time() - starttime
+      if not self.threads:
+        stats['construct'] = stats['total'] - stats['fetch']
+        self.stepsDone += 1
+      else:
+        with self.condition:
+          if self.local.locked:
+            stats['construct'] = time() - self.local.lockstart
+            self.constructing = None
+            self.local.locked = False
+          self.done.add(stage)
+          self.stepsDone += 1
+          self.condition.notify_all()
+      reportProgress(self.stepsDone / len(self.dependencies), self.database)
+
+
+  def runWorker(self):
+    '''
+    Thread that picks the next loading step till all steps are started.
+    '''
+    try:
+      while True:
+        with self.condition:
+          if not self.todo or self.error:
+            return
+          stage = self.todo.pop(0)
+        self.runStep(stage)
+    finally:
+      self.closeCursor()
+      connections[self.database].close()
+
+
+  def printStatistics(self):
+    print('Loading statistics (in seconds):')
+    print('  %-22s %10s %10s %10s %10s %10s' % ('entity', 'records', 'total', 'fetch', 'wait', 'construct'))
+    for stage, deps in self.dependencies:
+      stats = self.statistics.get(stage, None)
+      if not stats:
+        continue
+      print('  %-22s %10d %10.2f %10.2f %10.2f %10.2f' % (
+        stage[4:], stats['records'], stats['total'], stats['fetch'],
+        stats['wait'], stats['construct']
+        ))
+
+
+  def recordStatistics(self, stage):
+    '''
+    Adds the statistics of each loading step as a sub-stage of a Stage.
+    '''
+    for step, deps in self.dependencies:
+      stats = self.statistics.get(step, None)
+      if stats:
+        stage.add(
+          'load.%s' % step[4:].lower(), rows=stats['records'],
+          walltime=stats['total'], dbtime=stats['fetch']
+          )
+
+
+  def lookup(self, cls, name):
+    '''
+    Returns the frePPLe object of a certain class and name.
+
+    The objects are cached, which saves a call to the Python API of the
+    engine for every foreign key of every record we load.
+    '''
+    try:
+      return self.cache[(cls, name)]
+    except KeyError:
+      obj = cls(name=name)
+      self.cache[(cls, name)] = obj
+      return obj
 
 
   def loadParameter(self):
@@ -102,19 +415,22 @@ class loadData(object):
     print('Importing locations...')
     cnt = 0
     starttime = time()
-    self.cursor.execute('''
+    for i in self.fetch('''
       SELECT
         name, description, owner_id, available_id, category, subcategory, source
       FROM location %s
-      ''' % self.filter_where)
-    for i in self.cursor.fetchall():
+      ''' % self.filter_where):
       cnt += 1
       try:
         x = frepple.location(name=i[0], description=i[1], category=i[4], subcategory=i[5], source=i[6])
         if i[2]:
-          x.owner = frepple.location(name=i[2])
+          x.owner = self.lookup(frepple.location, i[2])
+        elif self.reset:
+          x.owner = None
         if i[3]:
-          x.available = frepple.calendar(name=i[3])
+          x.available = self.lookup(frepple.calendar, i[3])
+        elif self.reset:
+          x.available = None
       except Exception as e:
         print("Error:", e)
     print('Loaded %d locations in %.2f seconds' % (cnt, time() - starttime))
@@ -124,12 +440,11 @@ class loadData(object):
     print('Importing calendars...')
     cnt = 0
     starttime = time()
-    self.cursor.execute('''
+    for i in self.fetch('''
       SELECT
         name, defaultvalue, source
       FROM calendar %s
-      ''' % self.filter_where)
-    for i in self.cursor.fetchall():
+      ''' % self.filter_where):
       cnt += 1
       try:
         frepple.calendar(name=i[0], default=i[1], source=i[2])
@@ -142,15 +457,14 @@ class loadData(object):
     print('Importing calendar buckets...')
     cnt = 0
     starttime = time()
-    self.cursor.execute('''
+    for i in self.fetch('''
        SELECT
          calendar_id, startdate, enddate, id, priority, value,
          sunday, monday, tuesday, wednesday, thursday, friday, saturday,
          starttime, endtime, source
       FROM calendarbucket %s
       ORDER BY calendar_id, startdate desc
-      ''' % self.filter_where)
-    for i in self.cursor.fetchall():
+      ''' % self.filter_where):
       cnt += 1
       try:
         days = 0
@@ -168,7 +482,7 @@ class loadData(object):
           days += 32
         if i[12]:
           days += 64
-        b = frepple.calendar(name=i[0]).addBucket(i[3])
+        b = self.lookup(frepple.calendar, i[0]).addBucket(i[3])
         b.value = i[5]
         b.days = days
         if i[13]:
@@ -192,17 +506,18 @@ class loadData(object):
     print('Importing customers...')
     cnt = 0
     starttime = time()
-    self.cursor.execute('''
+    for i in self.fetch('''
       SELECT
         name, description, owner_id, category, subcategory, source
       FROM customer %s
-      ''' % self.filter_where)
-    for i in self.cursor.fetchall():
+      ''' % self.filter_where):
       cnt += 1
       try:
         x = frepple.customer(name=i[0], description=i[1], category=i[3], subcategory=i[4], source=i[5])
         if i[2]:
-          x.owner = frepple.customer(name=i[2])
+          x.owner = self.lookup(frepple.customer, i[2])
+        elif self.reset:
+          x.owner = None
       except Exception as e:
         print("Error:", e)
     print('Loaded %d customers in %.2f seconds' % (cnt, time() - starttime))
@@ -212,17 +527,18 @@ class loadData(object):
     print('Importing suppliers...')
     cnt = 0
     starttime = time()
-    self.cursor.execute('''
+    for i in self.fetch('''
       SELECT
         name, description, owner_id, category, subcategory, source
       FROM supplier %s
-      ''' % self.filter_where)
-    for i in self.cursor.fetchall():
+      ''' % self.filter_where):
       cnt += 1
       try:
         x = frepple.supplier(name=i[0], description=i[1], category=i[3], subcategory=i[4], source=i[5])
         if i[2]:
-          x.owner = frepple.supplier(name=i[2])
+          x.owner = self.lookup(frepple.supplier, i[2])
+        elif self.reset:
+          x.owner = None
       except Exception as e:
         print("Error:", e)
     print('Loaded %d suppliers in %.2f seconds' % (cnt, time() - starttime))
@@ -232,14 +548,13 @@ class loadData(object):
     print('Importing operations...')
     cnt = 0
     starttime = time()
-    self.cursor.execute('''
+    for i in self.fetch('''
       SELECT
         name, fence, posttime, sizeminimum, sizemultiple, sizemaximum,
         type, duration, duration_per, location_id, cost, search, description,
         category, subcategory, source
       FROM operation %s
-      ''' % self.filter_where)
-    for i in self.cursor.fetchall():
+      ''' % self.filter_where):
       cnt += 1
       try:
         if not i[6] or i[6] == "fixed_time":
@@ -248,14 +563,20 @@ class loadData(object):
             )
           if i[7]:
             x.duration = i[7]
+          elif self.reset:
+            x.duration = 0
         elif i[6] == "time_per":
           x = frepple.operation_time_per(
             name=i[0], description=i[12], category=i[13], subcategory=i[14], source=i[15]
             )
           if i[7]:
             x.duration = i[7]
+          elif self.reset:
+            x.duration = 0
           if i[8]:
             x.duration_per = i[8]
+          elif self.reset:
+            x.duration_per = 0
         elif i[6] == "alternate":
           x = frepple.operation_alternate(
             name=i[0], description=i[12], category=i[13], subcategory=i[14], source=i[15]
@@ -272,20 +593,36 @@ class loadData(object):
           raise ValueError("Operation type '%s' not recognized" % i[6])
         if i[1]:
           x.fence = i[1]
+        elif self.reset:
+          x.fence = 0
         if i[2]:
           x.posttime = i[2]
+        elif self.reset:
+          x.posttime = 0
         if i[3] is not None:
           x.size_minimum = i[3]
+        elif self.reset:
+          x.size_minimum = 1
         if i[4]:
           x.size_multiple = i[4]
+        elif self.reset:
+          x.size_multiple = 0
         if i[5]:
           x.size_maximum = i[5]
+        elif self.reset:
+          x.size_maximum = sys.float_info.max
         if i[9]:
-          x.location = frepple.location(name=i[9])
+          x.location = self.lookup(frepple.location, i[9])
+        elif self.reset:
+          x.location = None
         if i[10]:
           x.cost = i[10]
+        elif self.reset:
+          x.cost = 0
         if i[11]:
           x.search = i[11]
+        elif self.reset and i[6] == "alternate":
+          x.search = 'PRIORITY'
       except Exception as e:
         print("Error:", e)
     print('Loaded %d operations in %.2f seconds' % (cnt, time() - starttime))
@@ -295,7 +632,8 @@ class loadData(object):
     print('Importing suboperations...')
     cnt = 0
     starttime = time()
-    self.cursor.execute('''
+    curopername = None
+    for i in self.fetch('''
       SELECT operation_id, suboperation_id, priority, effective_start, effective_end,
         (select type
          from operation
@@ -303,9 +641,7 @@ class loadData(object):
       FROM suboperation
       WHERE priority >= 0 %s
       ORDER BY operation_id, priority
-      ''' % self.filter_and)
-    curopername = None
-    for i in self.cursor.fetchall():
+      ''' % self.filter_and):
       cnt += 1
       try:
         if i[0] != curopername:
@@ -313,7 +649,7 @@ class loadData(object):
           curoper = frepple.operation(name=curopername)
         sub = frepple.suboperation(
           owner=curoper,
-          operation=frepple.operation(name=i[1]),
+          operation=self.lookup(frepple.operation, i[1]),
           priority=i[2]
           )
         if i[3]:
@@ -329,22 +665,27 @@ class loadData(object):
     print('Importing items...')
     cnt = 0
     starttime = time()
-    self.cursor.execute('''
+    for i in self.fetch('''
       SELECT
         name, description, operation_id, owner_id,
         price, category, subcategory, source
       FROM item %s
-      ''' % self.filter_where)
-    for i in self.cursor.fetchall():
+      ''' % self.filter_where):
       cnt += 1
       try:
         x = frepple.item(name=i[0], description=i[1], category=i[5], subcategory=i[6], source=i[7])
         if i[2]:
-          x.operation = frepple.operation(name=i[2])
+          x.operation = self.lookup(frepple.operation, i[2])
+        elif self.reset:
+          x.operation = None
         if i[3]:
-          x.owner = frepple.item(name=i[3])
+          x.owner = self.lookup(frepple.item, i[3])
+        elif self.reset:
+          x.owner = None
         if i[4]:
           x.price = i[4]
+        elif self.reset:
+          x.price = 0
       except Exception as e:
         print("Error:", e)
     print('Loaded %d items in %.2f seconds' % (cnt, time() - starttime))
@@ -354,17 +695,16 @@ class loadData(object):
     print('Importing item suppliers...')
     cnt = 0
     starttime = time()
-    self.cursor.execute('''
+    cursuppliername = None
+    curitemname = None
+    for i in self.fetch('''
       SELECT
         supplier_id, item_id, location_id, sizeminimum, sizemultiple,
         cost, priority, effective_start, effective_end, source, leadtime,
         resource_id, resource_qty
       FROM itemsupplier %s
       ORDER BY supplier_id, item_id, location_id, priority desc
-      ''' % self.filter_where)
-    cursuppliername = None
-    curitemname = None
-    for i in self.cursor.fetchall():
+      ''' % self.filter_where):
       cnt += 1
       try:
         if i[0] != cursuppliername:
@@ -378,7 +718,7 @@ class loadData(object):
           leadtime=i[10] or 0, resource_qty=i[12]
           )
         if i[2]:
-          curitemsupplier.location = frepple.location(name=i[2])
+          curitemsupplier.location = self.lookup(frepple.location, i[2])
         if i[3]:
           curitemsupplier.size_minimum = i[3]
         if i[4]:
@@ -392,7 +732,7 @@ class loadData(object):
         if i[8]:
           curitemsupplier.effective_end = i[8]
         if i[11]:
-          curitemsupplier.resource = frepple.resource(name=i[11])
+          curitemsupplier.resource = self.lookup(frepple.resource, i[11])
       except Exception as e:
         print("Error:", e)
     print('Loaded %d item suppliers in %.2f seconds' % (cnt, time() - starttime))
@@ -402,17 +742,16 @@ class loadData(object):
     print('Importing item distributions...')
     cnt = 0
     starttime = time()
-    self.cursor.execute('''
+    curoriginname = None
+    curitemname = None
+    for i in self.fetch('''
       SELECT
         origin_id, item_id, location_id, sizeminimum, sizemultiple,
         cost, priority, effective_start, effective_end, source,
         leadtime, resource_id, resource_qty
       FROM itemdistribution %s
       ORDER BY origin_id, item_id, location_id, priority desc
-      ''' % self.filter_where)
-    curoriginname = None
-    curitemname = None
-    for i in self.cursor.fetchall():
+      ''' % self.filter_where):
       cnt += 1
       try:
         if i[0] != curoriginname:
@@ -426,7 +765,7 @@ class loadData(object):
           leadtime=i[10] or 0, resource_qty=i[12]
           )
         if i[2]:
-          curitemdistribution.destination = frepple.location(name=i[2])
+          curitemdistribution.destination = self.lookup(frepple.location, i[2])
         if i[3]:
           curitemdistribution.size_minimum = i[3]
         if i[4]:
@@ -440,7 +779,7 @@ class loadData(object):
         if i[8]:
           curitemdistribution.effective_end = i[8]
         if i[11]:
-          curitemdistribution.resource = frepple.resource(name=i[11])
+          curitemdistribution.resource = self.lookup(frepple.resource, i[11])
       except Exception as e:
         print("Error:", e)
     print('Loaded %d item itemdistributions in %.2f seconds' % (cnt, time() - starttime))
@@ -450,60 +789,85 @@ class loadData(object):
     print('Importing buffers...')
     cnt = 0
     starttime = time()
-    self.cursor.execute('''
+    for i in self.fetch('''
       SELECT name, description, location_id, item_id, onhand,
         minimum, minimum_calendar_id, producing_id, type, leadtime, min_inventory,
         max_inventory, min_interval, max_interval, size_minimum,
         size_multiple, size_maximum, fence, category, subcategory, source
       FROM buffer %s
-      ''' % self.filter_where)
-    for i in self.cursor.fetchall():
+      ''' % self.filter_where):
       cnt += 1
       if i[8] == "procure":
         b = frepple.buffer_procure(
-          name=i[0], description=i[1], item=frepple.item(name=i[3]), onhand=i[4],
+          name=i[0], description=i[1], item=self.lookup(frepple.item, i[3]), onhand=i[4],
           category=i[18], subcategory=i[19], source=i[20]
           )
         if i[9]:
           b.leadtime = i[9]
+        elif self.reset:
+          b.leadtime = 0
         if i[10]:
           b.mininventory = i[10]
+        elif self.reset:
+          b.mininventory = 0
         if i[11]:
           b.maxinventory = i[11]
+        elif self.reset:
+          b.maxinventory = 0
         if i[14]:
           b.size_minimum = i[14]
+        elif self.reset:
+          b.size_minimum = 0
         if i[15]:
           b.size_multiple = i[15]
+        elif self.reset:
+          b.size_multiple = 0
         if i[16]:
           b.size_maximum = i[16]
+        elif self.reset:
+          b.size_maximum = sys.float_info.max
         if i[17]:
           b.fence = i[17]
+        elif self.reset:
+          b.fence = 0
       elif i[8] == "infinite":
         b = frepple.buffer_infinite(
-          name=i[0], description=i[1], item=frepple.item(name=i[3]), onhand=i[4],
+          name=i[0], description=i[1], item=self.lookup(frepple.item, i[3]), onhand=i[4],
           category=i[18], subcategory=i[19], source=i[20]
           )
       elif not i[8] or i[8] == "default":
         b = frepple.buffer(
-          name=i[0], description=i[1], item=frepple.item(name=i[3]), onhand=i[4],
+          name=i[0], description=i[1], item=self.lookup(frepple.item, i[3]), onhand=i[4],
           category=i[18], subcategory=i[19], source=i[20]
           )
       else:
         raise ValueError("Buffer type '%s' not recognized" % i[8])
       if i[20] == 'tool':
         b.tool = True
+      elif self.reset:
+        b.tool = False
       if i[2]:
-        b.location = frepple.location(name=i[2])
+        b.location = self.lookup(frepple.location, i[2])
+      elif self.reset:
+        b.location = None
       if i[5]:
         b.minimum = i[5]
+      elif self.reset:
+        b.minimum = 0
       if i[6]:
-        b.minimum_calendar = frepple.calendar(name=i[6])
+        b.minimum_calendar = self.lookup(frepple.calendar, i[6])
+      elif self.reset:
+        b.minimum_calendar = None
       if i[7]:
-        b.producing = frepple.operation(name=i[7])
+        b.producing = self.lookup(frepple.operation, i[7])
       if i[12]:
         b.mininterval = i[12]
+      elif self.reset:
+        b.mininterval = -1
       if i[13]:
         b.maxinterval = i[13]
+      elif self.reset:
+        b.maxinterval = 0
     print('Loaded %d buffers in %.2f seconds' % (cnt, time() - starttime))
 
 
@@ -511,13 +875,12 @@ class loadData(object):
     print('Importing setup matrix rules...')
     cnt = 0
     starttime = time()
-    self.cursor.execute('''
+    for i in self.fetch('''
       SELECT
         setupmatrix_id, priority, fromsetup, tosetup, duration, cost, source
       FROM setuprule %s
       ORDER BY setupmatrix_id, priority DESC
-      ''' % self.filter_where)
-    for i in self.cursor.fetchall():
+      ''' % self.filter_where):
       cnt += 1
       try:
         r = frepple.setupmatrix(name=i[0], source=i[6]).addRule(priority=i[1])
@@ -539,14 +902,13 @@ class loadData(object):
     cnt = 0
     starttime = time()
     Resource.rebuildHierarchy(database=self.database)
-    self.cursor.execute('''
+    for i in self.fetch('''
       SELECT
         name, description, maximum, maximum_calendar_id, location_id, type, cost,
         maxearly, setup, setupmatrix_id, category, subcategory, owner_id, source
       FROM %s %s
       ORDER BY lvl ASC, name
-      ''' % (connections[self.cursor.db.alias].ops.quote_name('resource'), self.filter_where) )
-    for i in self.cursor.fetchall():
+      ''' % (connections[self.cursor.db.alias].ops.quote_name('resource'), self.filter_where) ):
       cnt += 1
       try:
         if i[5] == "infinite":
@@ -558,31 +920,51 @@ class loadData(object):
             name=i[0], description=i[1], category=i[10], subcategory=i[11], source=i[13]
             )
           if i[3]:
-            x.maximum_calendar = frepple.calendar(name=i[3])
+            x.maximum_calendar = self.lookup(frepple.calendar, i[3])
+          elif self.reset:
+            x.maximum_calendar = None
           if i[7]:
             x.maxearly = i[7]
+          elif self.reset:
+            x.maxearly = 100 * 86400
         elif not i[5] or i[5] == "default":
           x = frepple.resource_default(
             name=i[0], description=i[1], category=i[10], subcategory=i[11], source=i[13]
             )
           if i[3]:
-            x.maximum_calendar = frepple.calendar(name=i[3])
+            x.maximum_calendar = self.lookup(frepple.calendar, i[3])
+          elif self.reset:
+            x.maximum_calendar = None
           if i[7]:
             x.maxearly = i[7]
+          elif self.reset:
+            x.maxearly = 100 * 86400
           if i[2]:
             x.maximum = i[2]
+          elif self.reset:
+            x.maximum = 0
         else:
           raise ValueError("Resource type '%s' not recognized" % i[5])
         if i[4]:
-          x.location = frepple.location(name=i[4])
+          x.location = self.lookup(frepple.location, i[4])
+        elif self.reset:
+          x.location = None
         if i[6]:
           x.cost = i[6]
+        elif self.reset:
+          x.cost = 0
         if i[8]:
           x.setup = i[8]
+        elif self.reset:
+          x.setup = ''
         if i[9]:
-          x.setupmatrix = frepple.setupmatrix(name=i[9])
+          x.setupmatrix = self.lookup(frepple.setupmatrix, i[9])
+        elif self.reset:
+          x.setupmatrix = None
         if i[12]:
-          x.owner = frepple.resource(name=i[12])
+          x.owner = self.lookup(frepple.resource, i[12])
+        elif self.reset:
+          x.owner = None
       except Exception as e:
         print("Error:", e)
     print('Loaded %d resources in %.2f seconds' % (cnt, time() - starttime))
@@ -592,17 +974,16 @@ class loadData(object):
     print('Importing resource skills...')
     cnt = 0
     starttime = time()
-    self.cursor.execute('''
+    for i in self.fetch('''
       SELECT
         resource_id, skill_id, effective_start, effective_end, priority, source
       FROM resourceskill %s
       ORDER BY skill_id, priority, resource_id
-      ''' % self.filter_where)
-    for i in self.cursor.fetchall():
+      ''' % self.filter_where):
       cnt += 1
       try:
         cur = frepple.resourceskill(
-          resource=frepple.resource(name=i[0]), skill=frepple.skill(name=i[1]),
+          resource=self.lookup(frepple.resource, i[0]), skill=self.lookup(frepple.skill, i[1]),
           priority=i[4] or 1, source=i[5]
           )
         if i[2]:
@@ -620,21 +1001,20 @@ class loadData(object):
     starttime = time()
     # Note: The sorting of the flows is not really necessary, but helps to make
     # the planning progress consistent across runs and database engines.
-    self.cursor.execute('''
+    curbufname = None
+    for i in self.fetch('''
       SELECT
         operation_id, thebuffer_id, quantity, type, effective_start,
         effective_end, name, priority, search, source
       FROM flow %s
       ORDER BY operation_id, thebuffer_id
-      ''' % self.filter_where)
-    curbufname = None
-    for i in self.cursor.fetchall():
+      ''' % self.filter_where):
       cnt += 1
       try:
         if i[1] != curbufname:
           curbufname = i[1]
           curbuf = frepple.buffer(name=curbufname)
-        curflow = frepple.flow(operation=frepple.operation(name=i[0]), type="flow_%s" % i[3], buffer=curbuf, quantity=i[2], source=i[9])
+        curflow = frepple.flow(operation=self.lookup(frepple.operation, i[0]), type="flow_%s" % i[3], buffer=curbuf, quantity=i[2], source=i[9])
         if i[4]:
           curflow.effective_start = i[4]
         if i[5]:
@@ -663,21 +1043,20 @@ class loadData(object):
     starttime = time()
     # Note: The sorting of the loads is not really necessary, but helps to make
     # the planning progress consistent across runs and database engines.
-    self.cursor.execute('''
+    curresname = None
+    for i in self.fetch('''
       SELECT
         operation_id, resource_id, quantity, effective_start, effective_end, name,
         priority, setup, search, skill_id, source
       FROM resourceload %s
       ORDER BY operation_id, resource_id
-      ''' % self.filter_where)
-    curresname = None
-    for i in self.cursor.fetchall():
+      ''' % self.filter_where):
       cnt += 1
       try:
         if i[1] != curresname:
           curresname = i[1]
           curres = frepple.resource(name=curresname)
-        curload = frepple.load(operation=frepple.operation(name=i[0]), resource=curres, quantity=i[2], source=i[10])
+        curload = frepple.load(operation=self.lookup(frepple.operation, i[0]), resource=curres, quantity=i[2], source=i[10])
         if i[3]:
           curload.effective_start = i[3]
         if i[4]:
@@ -691,7 +1070,7 @@ class loadData(object):
         if i[8]:
           curload.search = i[8]
         if i[9]:
-          curload.skill = frepple.skill(name=i[9])
+          curload.skill = self.lookup(frepple.skill, i[9])
       except Exception as e:
         print("Error:", e)
     self.cursor.execute('''
@@ -708,17 +1087,16 @@ class loadData(object):
     print('Importing operationplans...')
     cnt = 0
     starttime = time()
-    self.cursor.execute('''
+    for i in self.fetch('''
       SELECT
         operation_id, id, quantity, startdate, enddate, status, source
       FROM operationplan
       WHERE owner_id IS NULL and quantity >= 0 and status <> 'closed' %s
       ORDER BY id ASC
-      ''' % self.filter_and)
-    for i in self.cursor.fetchall():
+      ''' % self.filter_and):
       cnt += 1
       opplan = frepple.operationplan(
-        operation=frepple.operation(name=i[0]),
+        operation=self.lookup(frepple.operation, i[0]),
         id=i[1], quantity=i[2], source=i[6],
         start=i[3], end=i[4], status=i[5]
         )
@@ -727,17 +1105,16 @@ class loadData(object):
         # have already consumed all materials.
         # TODO Specifying this explicitly may be more appropriate
         opplan.consume_material = False
-    self.cursor.execute('''
+    for i in self.fetch('''
       SELECT
         operation_id, id, quantity, startdate, enddate, status, owner_id, source
       FROM operationplan
       WHERE owner_id IS NOT NULL and quantity >= 0 and status <> 'closed' %s
       ORDER BY id ASC
-      ''' % self.filter_and)
-    for i in self.cursor.fetchall():
+      ''' % self.filter_and):
       cnt += 1
       opplan = frepple.operationplan(
-        operation=frepple.operation(name=i[0]),
+        operation=self.lookup(frepple.operation, i[0]),
         id=i[1], quantity=i[2], source=i[7],
         owner=frepple.operationplan(id=i[6]),
         start=i[3], end=i[4], status=i[5]
@@ -754,21 +1131,20 @@ class loadData(object):
     print('Importing purchase orders...')
     cnt = 0
     starttime = time()
-    self.cursor.execute('''
+    for i in self.fetch('''
       SELECT
         location_id, id, reference, item_id, supplier_id, quantity, startdate, enddate, status, source
       FROM purchase_order
       WHERE status <> 'closed' %s
       ORDER BY id ASC
-      ''' % self.filter_and)
-    for i in self.cursor.fetchall():
+      ''' % self.filter_and):
       cnt += 1
       try:
         frepple.operation_itemsupplier.createOrder(
-          location=frepple.location(name=i[0]),
+          location=self.lookup(frepple.location, i[0]),
           id=i[1], reference=i[2],
-          item=frepple.item(name=i[3]) if i[3] else None,
-          supplier=frepple.supplier(name=i[4]) if i[4] else None,
+          item=self.lookup(frepple.item, i[3]) if i[3] else None,
+          supplier=self.lookup(frepple.supplier, i[4]) if i[4] else None,
           quantity=i[5], start=i[6], end=i[7],
           status=i[8], source=i[9]
           )
@@ -781,22 +1157,21 @@ class loadData(object):
     print('Importing distribution orders...')
     cnt = 0
     starttime = time()
-    self.cursor.execute('''
+    for i in self.fetch('''
       SELECT
         destination_id, id, reference, item_id, origin_id, quantity, startdate,
         enddate, consume_material, status, source
       FROM distribution_order
       WHERE status <> 'closed' %s
       ORDER BY id ASC
-      ''' % self.filter_and)
-    for i in self.cursor.fetchall():
+      ''' % self.filter_and):
       cnt += 1
       try:
         frepple.operation_itemdistribution.createOrder(
-          destination=frepple.location(name=i[0]),
+          destination=self.lookup(frepple.location, i[0]),
           id=i[1], reference=i[2],
-          item=frepple.item(name=i[3]) if i[3] else None,
-          origin=frepple.location(name=i[4]) if i[4] else None,
+          item=self.lookup(frepple.item, i[3]) if i[3] else None,
+          origin=self.lookup(frepple.location, i[4]) if i[4] else None,
           quantity=i[5], start=i[6], end=i[7],
           consume_material=i[8] if i[8] != None else True,
           status=i[9], source=i[10]
@@ -810,34 +1185,41 @@ class loadData(object):
     print('Importing demands...')
     cnt = 0
     starttime = time()
-    self.cursor.execute('''
+    for i in self.fetch('''
       SELECT
         name, due, quantity, priority, item_id,
         operation_id, customer_id, owner_id, minshipment, maxlateness,
         category, subcategory, source, location_id, status
       FROM demand
       WHERE (status IS NULL OR status ='open' OR status = 'quote') %s
-      ''' % self.filter_and)
-    for i in self.cursor.fetchall():
+      ''' % self.filter_and):
       cnt += 1
       try:
         x = frepple.demand(
           name=i[0], due=i[1], quantity=i[2], priority=i[3], status=i[14],
-          item=frepple.item(name=i[4]), category=i[10], subcategory=i[11],
+          item=self.lookup(frepple.item, i[4]), category=i[10], subcategory=i[11],
           source=i[12]
           )
         if i[5]:
-          x.operation = frepple.operation(name=i[5])
+          x.operation = self.lookup(frepple.operation, i[5])
         if i[6]:
-          x.customer = frepple.customer(name=i[6])
+          x.customer = self.lookup(frepple.customer, i[6])
+        elif self.reset:
+          x.customer = None
         if i[7]:
-          x.owner = frepple.demand(name=i[7])
+          x.owner = self.lookup(frepple.demand, i[7])
+        elif self.reset:
+          x.owner = None
         if i[8]:
           x.minshipment = i[8]
+        elif self.reset:
+          x.minshipment = 1
         if i[9] is not None:
           x.maxlateness = i[9]
         if i[13]:
-          x.location = frepple.location(name=i[13])
+          x.location = self.lookup(frepple.location, i[13])
+        elif self.reset:
+          x.location = None
       except Exception as e:
         print("Error:", e)
     print('Loaded %d demands in %.2f seconds' % (cnt, time() - starttime))
@@ -855,38 +1237,215 @@ class loadData(object):
     # and cpu time.
     settings.DEBUG = False
 
-    # Create a database connection
-    self.cursor = connections[self.database].cursor()
-
-    # Sequential load of all entities
-    # Some entities could be loaded in parallel threads, but in preliminary tests
-    # we haven't seen a clear performance gain. It is unclear what the limiting
-    # bottleneck is: python or frepple, definitely not the database...
+    synctime = self.getSyncTime()
+    self.cache = {}
+    self.stepsDone = 0
     self.loadParameter()
-    self.loadCalendars()
-    self.loadCalendarBuckets()
-    self.loadLocations()
-    self.loadCustomers()
-    self.loadSuppliers()
-    self.loadOperations()
-    self.loadSuboperations()
-    self.loadItems()
-    self.loadBuffers()
-    self.loadSetupMatrices()
-    self.loadResources()
-    self.loadResourceSkills()
-    self.loadItemSuppliers()
-    self.loadItemDistributions()
-    self.loadFlows()
-    self.loadLoads()
-    self.loadOperationPlans()
-    self.loadPurchaseOrders()
-    self.loadDistributionOrders()
-    self.loadDemand()
+
+    if self.threads:
+      # Parallel load of all entities.
+      # Each thread reads data over its own database connection, but only a
+      # single thread at a time creates objects in the engine.
+      self.requires = dict(self.dependencies)
+      self.todo = [ i[0] for i in self.dependencies ]
+      self.done = set()
+      self.constructing = None
+      self.error = None
+      self.condition = Condition()
+      workers = [ Thread(target=self.runWorker) for i in range(self.threads) ]
+      for w in workers:
+        w.start()
+      for w in workers:
+        w.join()
+      if self.error:
+        # A thread stopped because the task got cancelled
+        checkCancel(self.database)
+        raise self.error
+    else:
+      # Sequential load of all entities
+      for stage, deps in self.dependencies:
+        self.runStep(stage)
+
     self.finalize()
+    self.printStatistics()
+    if self.incremental:
+      self.snapshot = self.takeSnapshot()
+      self.synctime = synctime
 
     # Close the database connection
-    self.cursor.close()
+    self.closeCursor()
 
     # Finalize
     print('Done')
+
+
+  def getSyncTime(self):
+    '''
+    Returns the time from which the next sync() needs to reload changes.
+
+    The field lastmodified is filled in by the application before its
+    transaction commits. A record committed after this moment can thus have
+    an older timestamp. We go back to the start of the oldest transaction
+    still open on the database, and keep a margin for the clock of the
+    application servers. Changes in this window are loaded again at the next
+    sync, which is harmless.
+    '''
+    self.cursor.execute('''
+      select least(now(), min(xact_start)) - interval '%d seconds'
+      from pg_stat_activity
+      where datname = current_database() and pid <> pg_backend_pid()
+      ''' % self.syncWindow)
+    return self.cursor.fetchone()[0]
+
+
+  def takeSnapshot(self):
+    '''
+    Returns the keys of all records currently loaded in memory.
+    '''
+    snapshot = {}
+    for table, cls, step, typed in self.incrementalTables:
+      if table == 'demand':
+        where = "WHERE (status IS NULL OR status ='open' OR status = 'quote') %s" % self.filter_and
+      else:
+        where = self.filter_where
+      self.cursor.execute("SELECT name, %s FROM %s %s" % (
+        'type' if typed else 'null',
+        connections[self.database].ops.quote_name(table), where
+        ))
+      snapshot[table] = dict(self.cursor.fetchall())
+    for table, field in self.unresettableFields:
+      if table == 'demand':
+        where = "WHERE (status IS NULL OR status ='open' OR status = 'quote') %s" % self.filter_and
+      else:
+        where = self.filter_where
+      self.cursor.execute("SELECT name FROM %s %s %s %s IS NOT NULL" % (
+        connections[self.database].ops.quote_name(table), where,
+        'AND' if where else 'WHERE', field
+        ))
+      snapshot['%s.%s' % (table, field)] = set(i[0] for i in self.cursor.fetchall())
+    for table, step, extra in self.incrementalOrders:
+      # Proposed operationplans are erased from memory before replanning, and
+      # we only need to keep track of the other ones.
+      self.cursor.execute('''
+        SELECT id FROM %s
+        WHERE status IS NOT NULL AND status NOT IN ('proposed', 'closed') %s %s
+        ''' % (table, extra, self.filter_and))
+      snapshot[table] = set(i[0] for i in self.cursor.fetchall())
+    for table in self.structuralTables:
+      # The transaction ids of the records change with every update, also
+      # when lastmodified is older than the previous snapshot.
+      self.cursor.execute(
+        "SELECT count(*), max(lastmodified), sum(xmin::text::bigint) FROM %s %s" % (table, self.filter_where)
+        )
+      snapshot[table] = self.cursor.fetchone()
+    return snapshot
+
+
+  def sync(self):
+    '''
+    Applies all database changes since the previous load or sync to the
+    model in memory: new and changed records are loaded again, and records
+    deleted from the database are removed from the engine.
+
+    This method only makes sense for a process that keeps the model in
+    memory across planning runs. The proposed operationplans are expected to
+    be erased from memory already, with frepple.erase(False).
+
+    The return value is False when the changes can't be applied
+    incrementally. A complete reload of the model is then required.
+    '''
+    if not self.incremental or not self.snapshot:
+      raise Exception("Incremental sync requires a previous incremental load")
+    settings.DEBUG = False
+    starttime = time()
+    synctime = self.getSyncTime()
+    print('Synchronizing changes since %s...' % self.synctime)
+    snapshot = self.takeSnapshot()
+
+    # Verify whether the changes can be applied incrementally
+    for table in self.structuralTables:
+      if snapshot[table] != self.snapshot[table]:
+        print("Table %s has changed" % table)
+        return False
+    for table, cls, step, typed in self.incrementalTables:
+      if typed:
+        old = self.snapshot[table]
+        for name, tp in snapshot[table].items():
+          if name in old and old[name] != tp:
+            print("Type of %s '%s' has changed" % (table, name))
+            return False
+    for table, field in self.unresettableFields:
+      key = '%s.%s' % (table, field)
+      for name in (self.snapshot[key] - snapshot[key]) & snapshot[table].keys():
+        print("Field %s of %s '%s' has been cleared" % (field, table, name))
+        return False
+
+    # Objects held in the cache can be deleted below
+    self.cache = {}
+    self.loadParameter()
+
+    # Remove deleted objects from memory, dependent objects first
+    cnt = 0
+    for table, cls, step, typed in reversed(self.incrementalTables):
+      for name in self.snapshot[table].keys() - snapshot[table].keys():
+        try:
+          getattr(frepple, cls)(name=name, action='R')
+          cnt += 1
+        except Exception as e:
+          print("Error:", e)
+
+    # Remove deleted and changed operationplans from memory. The changed ones
+    # are loaded again below.
+    for table, step, extra in self.incrementalOrders:
+      self.cursor.execute('''
+        SELECT id FROM %s WHERE lastmodified > %%s %s
+        ''' % (table, self.filter_and), (self.synctime,))
+      changed = set(i[0] for i in self.cursor.fetchall())
+      for i in (self.snapshot[table] - snapshot[table]) | (self.snapshot[table] & changed):
+        try:
+          frepple.operationplan(id=i, action='R')
+          cnt += 1
+        except frepple.DataException:
+          # Already deleted together with its owner
+          pass
+    print('Removed %d objects' % cnt)
+
+    # Load new and changed records.
+    # The solver replaces the proposed operationplans anyway, and we skip them.
+    filter = "%slastmodified > '%s'" % (
+      ("(%s) and " % self.filter) if self.filter else '',
+      self.synctime
+      )
+    delta = loadData(database=self.database, filter=filter, batchsize=self.batchsize, reset=True)
+    for table, cls, step, typed in self.incrementalTables:
+      delta.runStep(step)
+    delta.printStatistics()
+    delta.closeCursor()
+    delta = loadData(
+      database=self.database, batchsize=self.batchsize,
+      filter="%s and status is not null and status <> 'proposed'" % filter
+      )
+    for table, step, extra in self.incrementalOrders:
+      delta.runStep(step)
+    delta.printStatistics()
+    delta.closeCursor()
+    self.finalize()
+    self.closeCursor()
+
+    self.snapshot = snapshot
+    self.synctime = synctime
+    print('Synchronized changes in %.2f seconds' % (time() - starttime))
+    return True
+
+
+  def refresh(self):
+    '''
+    Prepares a model kept in memory for a new planning run.
+    The previous plan is erased and the changes in the database are applied
+    incrementally. When that isn't possible the complete model is reloaded.
+    '''
+    frepple.erase(False)
+    if not self.sync():
+      print("Reloading the complete model")
+      frepple.erase(True)
+      self.run()
@@ -103,7 +103,8 @@ class Command(BaseCommand):
       # Run the backup command
       # Commenting the next line is a little more secure, but requires you to 
       # create a .pgpass file.
-      os.environ['PGPASSWORD'] = settings.DATABASES[database]['PASSWORD']
+      env = os.environ.copy()
+      env['PGPASSWORD'] = settings.DATABASES[database]['PASSWORD']
       args = [
         "pg_dump",
         "-b", "-w",
@@ -115,7 +116,7 @@ class Command(BaseCommand):
       if settings.DATABASES[database]['PORT']:
         args.append("--port=%s " % settings.DATABASES[database]['PORT'])
       args.append(settings.DATABASES[database]['NAME'])
-      ret = subprocess.call(args)
+      ret = subprocess.call(args, env=env)
       if ret:
         raise Exception("Run of run pg_dump failed")
 
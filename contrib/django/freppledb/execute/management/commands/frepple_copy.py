@@ -16,12 +16,20 @@
 #
 
 import os
+import re
+import shutil
+from collections import deque
 from optparse import make_option
 from datetime import datetime
+from subprocess import call, Popen, PIPE, DEVNULL
+from tempfile import mkdtemp
+from time import sleep
 
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, DEFAULT_DB_ALIAS
 from django.conf import settings
 
+from freppledb.execute.management.commands.frepple_daemon import sendCommand
 from freppledb.execute.models import Task
 from freppledb.common.models import User, Scenario
 from freppledb import VERSION
@@ -32,8 +40,28 @@ class Command(BaseCommand):
   This command copies the contents of a database into another.
   The original data in the destination database are lost.
 
-  The pg_dump and psql commands need to be in the path, otherwise
-  this command will fail.
+  The following copy methods are available:
+    - template:
+      The destination database is recreated with the source database as
+      template. This is the fastest method, but it requires that the
+      databases are on the same server, that the database user is allowed
+      to create databases, and that nobody else is connected to the source.
+      The web server and the worker of a database stay connected to it, so
+      in practice this method can only copy scenarios nobody is using. It
+      never works for the default database while the web server runs.
+      The planning engine daemon and the worker of the destination are
+      stopped before replacing it. Other sessions on the destination are
+      disconnected.
+    - parallel:
+      The source is dumped with pg_dump in the directory format and restored
+      with pg_restore, both with multiple parallel jobs.
+    - plain:
+      The output of pg_dump is piped into psql.
+  The default method 'auto' tries the template method first, and falls back
+  to the parallel method.
+
+  The pg_dump, pg_restore and psql commands need to be in the path,
+  otherwise this command will fail.
   '''
   option_list = BaseCommand.option_list + (
     make_option(
@@ -52,6 +80,15 @@ class Command(BaseCommand):
       '--task', dest='task', type='int',
       help='Task identifier (generated automatically if not provided)'
       ),
+    make_option(
+      '--method', dest='method', type='choice', default='auto',
+      choices=['auto', 'template', 'parallel', 'plain'],
+      help='Copy method: auto (default), template, parallel or plain'
+      ),
+    make_option(
+      '--jobs', dest='jobs', type='int', default=4,
+      help='Number of parallel jobs of the parallel copy method (default = 4)'
+      ),
     )
   args = 'source_database destination_database'
 
@@ -133,20 +170,15 @@ class Command(BaseCommand):
       destinationscenario.save()
 
       # Copying the data
-      # Commenting the next line is a little more secure, but requires you to create a .pgpass file.
-      os.environ['PGPASSWORD'] = settings.DATABASES[source]['PASSWORD']
-      ret = os.system("pg_dump -c -U%s -Fp %s%s%s | psql -U%s %s%s%s" % (
-        settings.DATABASES[source]['USER'],
-        settings.DATABASES[source]['HOST'] and ("-h %s " % settings.DATABASES[source]['HOST']) or '',
-        settings.DATABASES[source]['PORT'] and ("-p %s " % settings.DATABASES[source]['PORT']) or '',
-        test and settings.DATABASES[source]['TEST']['NAME'] or settings.DATABASES[source]['NAME'],
-        settings.DATABASES[destination]['USER'],
-        settings.DATABASES[destination]['HOST'] and ("-h %s " % settings.DATABASES[destination]['HOST']) or '',
-        settings.DATABASES[destination]['PORT'] and ("-p %s " % settings.DATABASES[destination]['PORT']) or '',
-        test and settings.DATABASES[destination]['TEST']['NAME'] or settings.DATABASES[destination]['NAME'],
-        ))
-      if ret:
-        raise Exception('Exit code of the database copy command is %d' % ret)
+      method = options.get('method', None) or 'auto'
+      if method in ('auto', 'template') and self.copyTemplate(source, destination, test):
+        print("Copied database with the template method")
+      elif method == 'template':
+        raise CommandError("Can't copy the database with the template method")
+      elif method == 'plain':
+        self.copyPlain(source, destination, test)
+      else:
+        self.copyParallel(source, destination, test, task, options.get('jobs', None) or 4)
 
       # Update the scenario table
       destinationscenario.status = 'In use'
@@ -183,3 +215,185 @@ class Command(BaseCommand):
       if task:
         task.save()
       settings.DEBUG = tmp_debug
+
+
+  def getName(self, database, test):
+    if test:
+      return settings.DATABASES[database]['TEST']['NAME']
+    else:
+      return settings.DATABASES[database]['NAME']
+
+
+  def getArguments(self, database):
+    '''
+    Returns the command line arguments to connect to a database.
+    '''
+    args = ['-U', settings.DATABASES[database]['USER']]
+    if settings.DATABASES[database]['HOST']:
+      args.extend(['-h', settings.DATABASES[database]['HOST']])
+    if settings.DATABASES[database]['PORT']:
+      args.extend(['-p', str(settings.DATABASES[database]['PORT'])])
+    return args
+
+
+  def copyTemplate(self, source, destination, test):
+    '''
+    Recreates the destination database with the source database as template.
+    Returns False when this isn't possible.
+    The copy is first created under a temporary name. The destination
+    database is only replaced when the copy succeeded, and it is left
+    untouched otherwise.
+    '''
+    src = settings.DATABASES[source]
+    dst = settings.DATABASES[destination]
+    if src['HOST'] != dst['HOST'] or src['PORT'] != dst['PORT'] or src['USER'] != dst['USER']:
+      return False
+    if destination == DEFAULT_DB_ALIAS:
+      # The worker running this command is connected to it
+      return False
+    sourcename = self.getName(source, test)
+    destinationname = self.getName(destination, test)
+    # PostgreSQL truncates names to 63 characters
+    temporaryname = '%s_copy' % destinationname[:58]
+
+    # Connect to the maintenance database of the server
+    connections[source].close()
+    connections[destination].close()
+    wrapper = connections[source]
+    params = wrapper.get_connection_params()
+    params['database'] = 'postgres'
+    conn = wrapper.get_new_connection(params)
+    conn.autocommit = True
+    try:
+      with conn.cursor() as cursor:
+        cursor.execute("select rolcreatedb or rolsuper from pg_roles where rolname = current_user")
+        if not cursor.fetchone()[0]:
+          print("Template copy not possible: the database user can't create databases")
+          return False
+        cursor.execute(
+          "select count(*) from pg_stat_activity where datname = %s and pid <> pg_backend_pid()",
+          (sourcename,)
+          )
+        if cursor.fetchone()[0]:
+          print("Template copy not possible: other sessions are connected to the source database")
+          return False
+        cursor.execute('drop database if exists "%s"' % temporaryname)
+        try:
+          cursor.execute('create database "%s" template "%s"' % (temporaryname, sourcename))
+        except Exception as e:
+          # A session connected to the source in the meantime
+          print("Template copy failed: %s" % e)
+          return False
+        # Disconnect the sessions on the destination, and replace it
+        self.stopServices(destination, destinationname, cursor)
+        cursor.execute(
+          "select pg_terminate_backend(pid) from pg_stat_activity where datname = %s and pid <> pg_backend_pid()",
+          (destinationname,)
+          )
+        try:
+          cursor.execute('drop database if exists "%s"' % destinationname)
+        except Exception as e:
+          # A session connected to the destination in the meantime
+          print("Template copy failed: %s" % e)
+          cursor.execute('drop database "%s"' % temporaryname)
+          return False
+        cursor.execute('alter database "%s" rename to "%s"' % (temporaryname, destinationname))
+      return True
+    finally:
+      conn.close()
+
+
+  def stopServices(self, destination, destinationname, cursor, timeout=10):
+    '''
+    Stops the planning engine daemon and the worker of the destination
+    database, and waits for their sessions to disconnect. A worker is
+    started again when a new task is submitted.
+    '''
+    try:
+      if sendCommand(destination, 'stop') is not None:
+        print("Stopped the planning engine daemon of the destination")
+    except Exception as e:
+      print("Can't stop the planning engine daemon of the destination: %s" % e)
+    try:
+      with connections[destination].cursor() as c:
+        c.execute("notify frepple_task, 'stop'")
+    finally:
+      connections[destination].close()
+    for i in range(timeout):
+      cursor.execute(
+        "select count(*) from pg_stat_activity where datname = %s and pid <> pg_backend_pid()",
+        (destinationname,)
+        )
+      if not cursor.fetchone()[0]:
+        break
+      sleep(1)
+
+
+  def copyParallel(self, source, destination, test, task, jobs):
+    '''
+    Copies the database with pg_dump and pg_restore in parallel jobs.
+    The progress of the task is updated per table.
+    '''
+    with connections[source].cursor() as cursor:
+      cursor.execute("select count(*) from pg_tables where schemaname = 'public'")
+      tables = cursor.fetchone()[0] or 1
+    tmpdir = mkdtemp(prefix='frepple_copy_')
+    try:
+      dumpdir = os.path.join(tmpdir, 'dump')
+      self.runCommand(
+        ['pg_dump', '-Fd', '-j', str(jobs), '-v', '-f', dumpdir]
+          + self.getArguments(source) + [self.getName(source, test)],
+        settings.DATABASES[source]['PASSWORD'], task, tables, 0, 50
+        )
+      self.runCommand(
+        ['pg_restore', '-c', '--if-exists', '-j', str(jobs), '-v', '-d', self.getName(destination, test)]
+          + self.getArguments(destination) + [dumpdir],
+        settings.DATABASES[destination]['PASSWORD'], task, tables, 50, 100
+        )
+    finally:
+      shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+  # Messages of pg_dump and pg_restore when they start on a table
+  tablePattern = re.compile(r'(?:dumping contents of|processing data for) table "?([^"\s]+)')
+
+  def runCommand(self, cmd, password, task, tables, start, end):
+    '''
+    Runs pg_dump or pg_restore, and reports the progress per table.
+    '''
+    env = os.environ.copy()
+    # Commenting the next line is a little more secure, but requires you to create a .pgpass file.
+    env['PGPASSWORD'] = password
+    process = Popen(cmd, stdout=DEVNULL, stderr=PIPE, env=env, universal_newlines=True)
+    done = 0
+    messages = deque(maxlen=10)
+    for line in process.stderr:
+      m = self.tablePattern.search(line)
+      if m:
+        done += 1
+        task.status = '%d%%' % (start + (end - start) * min(done, tables) / tables)
+        task.message = 'Copying table %s' % m.group(1)
+        task.save(update_fields=['status', 'message'])
+      elif 'error' in line.lower():
+        messages.append(line.strip())
+    ret = process.wait()
+    if ret:
+      raise Exception('Exit code of %s is %d: %s' % (cmd[0], ret, '\n'.join(messages)))
+
+
+  def copyPlain(self, source, destination, test):
+    # Commenting the next line is a little more secure, but requires you to create a .pgpass file.
+    env = os.environ.copy()
+    env['PGPASSWORD'] = settings.DATABASES[source]['PASSWORD']
+    ret = call("pg_dump -c -U%s -Fp %s%s%s | psql -U%s %s%s%s" % (
+      settings.DATABASES[source]['USER'],
+      settings.DATABASES[source]['HOST'] and ("-h %s " % settings.DATABASES[source]['HOST']) or '',
+      settings.DATABASES[source]['PORT'] and ("-p %s " % settings.DATABASES[source]['PORT']) or '',
+      test and settings.DATABASES[source]['TEST']['NAME'] or settings.DATABASES[source]['NAME'],
+      settings.DATABASES[destination]['USER'],
+      settings.DATABASES[destination]['HOST'] and ("-h %s " % settings.DATABASES[destination]['HOST']) or '',
+      settings.DATABASES[destination]['PORT'] and ("-p %s " % settings.DATABASES[destination]['PORT']) or '',
+      test and settings.DATABASES[destination]['TEST']['NAME'] or settings.DATABASES[destination]['NAME'],
+      ), shell=True, env=env)
+    if ret:
+      raise Exception('Exit code of the database copy command is %d' % ret)
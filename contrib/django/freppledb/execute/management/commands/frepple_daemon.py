@@ -0,0 +1,122 @@
+#
+# Copyright (C) 2016 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import os
+import socket
+import subprocess
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.conf import settings
+
+
+def getPortFile(database=DEFAULT_DB_ALIAS):
+  '''
+  Returns the file in which a planning engine daemon publishes its port
+  number and access token.
+  '''
+  if database == DEFAULT_DB_ALIAS:
+    return os.path.join(settings.FREPPLE_LOGDIR, 'daemon.port')
+  else:
+    return os.path.join(settings.FREPPLE_LOGDIR, 'daemon_%s.port' % database)
+
+
+def sendCommand(database, command, **args):
+  '''
+  Sends a command to the planning engine daemon of a database, and waits
+  for its reply.
+  Returns None when no daemon is running for the database.
+  '''
+  try:
+    with open(getPortFile(database)) as f:
+      port, token = f.read().split()
+    conn = socket.create_connection(('127.0.0.1', int(port)))
+  except (IOError, OSError, ValueError):
+    return None
+  try:
+    args['command'] = command
+    args['token'] = token
+    stream = conn.makefile('rwb')
+    stream.write(json.dumps(args).encode('utf-8') + b'\n')
+    stream.flush()
+    reply = stream.readline()
+    if not reply:
+      raise Exception("Planning engine daemon closed the connection")
+    return json.loads(reply.decode('utf-8'))
+  finally:
+    conn.close()
+
+
+class Command(BaseCommand):
+  option_list = BaseCommand.option_list + (
+    make_option(
+      '--database', action='store', dest='database',
+      default=DEFAULT_DB_ALIAS,
+      help='Nominates a specific database to plan'
+      ),
+    make_option(
+      '--stop', dest='stop', action='store_true', default=False,
+      help='Stop the planning engine daemon'
+      ),
+    make_option(
+      '--status', dest='status', action='store_true', default=False,
+      help='Show the status of the planning engine daemon'
+      ),
+  )
+  help = '''
+  Starts a planning engine that keeps the model in memory between runs.
+
+  While the daemon is running, the frepple_run command hands over the plan
+  generation to it. Only the data changed since the previous run is then
+  read from the database.
+  '''
+
+  requires_system_checks = False
+
+  def handle(self, **options):
+    database = options['database'] or DEFAULT_DB_ALIAS
+    if database not in settings.DATABASES:
+      raise CommandError("No database settings known for '%s'" % database )
+
+    if options['status']:
+      reply = sendCommand(database, 'status')
+      if not reply:
+        print("Planning engine daemon for database '%s' isn't running" % database)
+      else:
+        for key in sorted(reply):
+          print("%s: %s" % (key, reply[key]))
+      return
+
+    if options['stop']:
+      if not sendCommand(database, 'stop'):
+        print("Planning engine daemon for database '%s' isn't running" % database)
+      return
+
+    if sendCommand(database, 'status'):
+      raise CommandError("Planning engine daemon for database '%s' is already running" % database)
+
+    # Launch the engine in the background
+    from freppledb.execute.management.commands.frepple_run import getEngineScript, getEngineEnvironment, getEngineCommand
+    cmd = getEngineScript('daemon.py')
+    env = getEngineEnvironment(database)
+    if os.name == 'nt':
+      subprocess.Popen(getEngineCommand(cmd, env), env=env, creationflags=0x08000000)
+    else:
+      subprocess.Popen(getEngineCommand(cmd, env), env=env)
+    print("Started planning engine daemon for database '%s'" % database)
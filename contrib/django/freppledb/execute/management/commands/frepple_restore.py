@@ -99,7 +99,8 @@ class Command(BaseCommand):
 
       # Run the restore command
       # Commenting the next line is a little more secure, but requires you to create a .pgpass file.
-      os.environ['PGPASSWORD'] = settings.DATABASES[database]['PASSWORD']
+      env = os.environ.copy()
+      env['PGPASSWORD'] = settings.DATABASES[database]['PASSWORD']
       cmd = [ "psql", '--username=%s' % settings.DATABASES[database]['USER'] ]
       if settings.DATABASES[database]['HOST']:
         cmd.append("--host=%s" % settings.DATABASES[database]['HOST'])
@@ -107,7 +108,7 @@ class Command(BaseCommand):
         cmd.append("--port=%s " % settings.DATABASES[database]['PORT'])
       cmd.append(settings.DATABASES[database]['NAME'])
       cmd.append('<%s' % os.path.abspath(os.path.join(settings.FREPPLE_LOGDIR, args[0])))
-      ret = subprocess.call(cmd, shell=True)  # Shell needs to be True in order to interpret the < character
+      ret = subprocess.call(cmd, shell=True, env=env)  # Shell needs to be True in order to interpret the < character
       if ret:
         raise Exception("Run of run psql failed")
 
@@ -16,6 +16,7 @@
 #
 
 import os
+import shutil
 import sys
 from datetime import datetime
 from importlib import import_module
@@ -26,8 +27,63 @@ from django.core.management.base import BaseCommand, CommandError
 from django.db import DEFAULT_DB_ALIAS
 from django.conf import settings
 
+import freppledb.execute
 from freppledb.common.models import User
 from freppledb.execute.models import Task
+from freppledb.execute.management.commands.frepple_daemon import sendCommand
+
+
+def getEngineScript(name='commands.py'):
+  '''
+  Locates a Python script to be run by the planning engine.
+  The first installed application providing the script is used.
+  '''
+  for app in settings.INSTALLED_APPS:
+    mod = import_module(app)
+    path = os.path.join(os.path.dirname(mod.__file__), name)
+    if os.path.exists(path):
+      return path
+  raise Exception("Can't locate %s" % name)
+
+
+def getEngineEnvironment(database=DEFAULT_DB_ALIAS, **variables):
+  '''
+  Returns the environment variables for running the planning engine, with
+  the extra variables passed as arguments.
+  The environment of this process isn't changed: other threads of a worker
+  can start processes at the same time.
+  '''
+  env = os.environ.copy()
+  env.update(variables)
+  env['FREPPLE_DATABASE'] = database
+  env['PATH'] = settings.FREPPLE_HOME + os.pathsep + os.environ['PATH'] + os.pathsep + settings.FREPPLE_APP
+  if os.path.isfile(os.path.join(settings.FREPPLE_HOME, 'libfrepple.so')):
+    env['LD_LIBRARY_PATH'] = settings.FREPPLE_HOME
+  if 'DJANGO_SETTINGS_MODULE' not in env:
+    env['DJANGO_SETTINGS_MODULE'] = 'freppledb.settings'
+  if os.path.exists(os.path.join(settings.FREPPLE_HOME, 'python34.zip')):
+    # For the py2exe executable
+    env['PYTHONPATH'] = os.path.join(
+      settings.FREPPLE_HOME,
+      'python%d%d.zip' %(sys.version_info[0], sys.version_info[1])
+      ) + os.pathsep + os.path.normpath(settings.FREPPLE_APP)
+  else:
+    # Other executables
+    env['PYTHONPATH'] = os.path.normpath(settings.FREPPLE_APP)
+  return env
+
+
+def getEngineCommand(cmd, env):
+  '''
+  Returns the command line to run a script with the planning engine.
+  '''
+  return [shutil.which('frepple', path=env['PATH']) or 'frepple', cmd]
+
+
+# Planning engine processes started in the background, by task identifier.
+# The worker waits for them, to keep the databases of the task locked until
+# the plan is really finished.
+backgroundProcesses = {}
 
 
 class Command(BaseCommand):
@@ -112,14 +168,15 @@ class Command(BaseCommand):
           raise ValueError("Invalid plan type: %s" % options['plantype'])
       else:
         plantype = 1
+      variables = {}
       if options['env']:
         task.arguments = "--constraint=%d --plantype=%d --env=%s" % (constraint, plantype, options['env'])
         for i in options['env'].split(','):
           j = i.split('=')
           if len(j) == 1:
-            os.environ[j[0]] = '1'
+            variables[j[0]] = '1'
           else:
-            os.environ[j[0]] = j[1]
+            variables[j[0]] = j[1]
       else:
         task.arguments = "--constraint=%d --plantype=%d" % (constraint, plantype)
       if options['background']:
@@ -129,45 +186,42 @@ class Command(BaseCommand):
       task.save(using=database)
 
       # Locate commands.py
-      cmd = None
-      for app in settings.INSTALLED_APPS:
-        mod = import_module(app)
-        if os.path.exists(os.path.join(os.path.dirname(mod.__file__), 'commands.py')):
-          cmd = os.path.join(os.path.dirname(mod.__file__), 'commands.py')
-          break
-      if not cmd:
-        raise Exception("Can't locate commands.py")
+      cmd = getEngineScript('commands.py')
+
+      # A planning engine daemon keeps the model in memory. When one is
+      # running for this database, we let it generate the plan.
+      # The daemon runs the standard plan generation. A run with another
+      # commands.py or with extra environment settings is executed normally.
+      standard = cmd == os.path.join(os.path.dirname(freppledb.execute.__file__), 'commands.py')
+      reply = None
+      if standard and not options['env'] and not options['background']:
+        reply = sendCommand(
+          database, 'plan', task=task.id, constraint=constraint, plantype=plantype
+          )
+      if reply:
+        if reply['status'] == 'error':
+          raise Exception(reply.get('message', 'Planning engine daemon failed'))
+        # A run cancelled by a user is shown in the status field
+        task.status = 'Cancelled' if reply['status'] == 'cancelled' else 'Done'
+        task.finished = datetime.now()
+        return
 
       # Prepare environment
-      os.environ['FREPPLE_PLANTYPE'] = str(plantype)
-      os.environ['FREPPLE_CONSTRAINT'] = str(constraint)
-      os.environ['FREPPLE_TASKID'] = str(task.id)
-      os.environ['FREPPLE_DATABASE'] = database
-      os.environ['PATH'] = settings.FREPPLE_HOME + os.pathsep + os.environ['PATH'] + os.pathsep + settings.FREPPLE_APP
-      if os.path.isfile(os.path.join(settings.FREPPLE_HOME, 'libfrepple.so')):
-        os.environ['LD_LIBRARY_PATH'] = settings.FREPPLE_HOME
-      if 'DJANGO_SETTINGS_MODULE' not in os.environ:
-        os.environ['DJANGO_SETTINGS_MODULE'] = 'freppledb.settings'
-      if os.path.exists(os.path.join(settings.FREPPLE_HOME, 'python34.zip')):
-        # For the py2exe executable
-        os.environ['PYTHONPATH'] = os.path.join(
-          settings.FREPPLE_HOME,
-          'python%d%d.zip' %(sys.version_info[0], sys.version_info[1])
-          ) + os.pathsep + os.path.normpath(settings.FREPPLE_APP)
-      else:
-        # Other executables
-        os.environ['PYTHONPATH'] = os.path.normpath(settings.FREPPLE_APP)
+      variables['FREPPLE_PLANTYPE'] = str(plantype)
+      variables['FREPPLE_CONSTRAINT'] = str(constraint)
+      variables['FREPPLE_TASKID'] = str(task.id)
+      env = getEngineEnvironment(database, **variables)
 
       if options['background']:
         # Execute as background process on Windows
         if os.name == 'nt':
-          subprocess.Popen(['frepple', cmd], creationflags=0x08000000)
+          backgroundProcesses[task.id] = subprocess.Popen(getEngineCommand(cmd, env), env=env, creationflags=0x08000000)
         else:
           # Execute as background process on Linux
-          subprocess.Popen(['frepple', cmd])
+          backgroundProcesses[task.id] = subprocess.Popen(getEngineCommand(cmd, env), env=env)
       else:
         # Execute in foreground
-        ret = subprocess.call(['frepple', cmd])
+        ret = subprocess.call(getEngineCommand(cmd, env), env=env)
         if ret != 0 and ret != 2:
           # Return code 0 is a successful run
           # Return code is 2 is a run cancelled by a user. That's shown in the status field.
@@ -16,18 +16,21 @@
 #
 
 import logging
+import select
 import time
 from datetime import datetime, timedelta
-from threading import Thread
+from threading import Condition, Thread
 from optparse import make_option
 
-from django.db import DEFAULT_DB_ALIAS
+from django.db import DEFAULT_DB_ALIAS, connections
 from django.core import management
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 
 from freppledb import VERSION
+from freppledb.common.dashboard import Dashboard
 from freppledb.common.models import Parameter
+from freppledb.execute.management.commands.frepple_run import backgroundProcesses
 from freppledb.execute.models import Task
 
 
@@ -56,6 +59,335 @@ def checkActive(database=DEFAULT_DB_ALIAS):
       return False
 
 
+class TaskListener(Thread):
+  '''
+  Waits for notifications of new tasks in the queue.
+  A trigger on the task table sends a notification on the channel
+  'frepple_task' when a task is added.
+  A notification with the payload 'stop' asks the worker to exit, eg because
+  its database is about to be replaced by a copy.
+  '''
+  def __init__(self, database, wakeup, stop=None):
+    self.database = database
+    self.wakeup = wakeup
+    self.stop = stop
+    Thread.__init__(self)
+    self.daemon = True
+
+  def run(self):
+    try:
+      wrapper = connections[self.database]
+      conn = wrapper.get_new_connection(wrapper.get_connection_params())
+      conn.autocommit = True
+      with conn.cursor() as cursor:
+        cursor.execute("listen frepple_task")
+      while True:
+        if select.select([conn], [], [], 60) != ([], [], []):
+          conn.poll()
+          if conn.notifies:
+            stop = any(i.payload == 'stop' for i in conn.notifies)
+            del conn.notifies[:]
+            if stop and self.stop:
+              self.stop()
+              return
+            self.wakeup()
+    except Exception as e:
+      # The worker falls back to polling the queue
+      logger.error("Can't listen for new tasks: %s" % e)
+
+
+def getTaskDatabases(task, database=DEFAULT_DB_ALIAS):
+  '''
+  Returns a tuple with the databases a task reads from and the databases it
+  writes to.
+  '''
+  if task.name == 'copy scenario':
+    args = task.arguments.split()
+    return (args[0],), (args[1],)
+  elif task.name in ('backup database', 'Openbravo export'):
+    return (database,), ()
+  else:
+    return (), (database,)
+
+
+class DatabaseLock:
+  '''
+  A lock on a database, shared by all processes.
+
+  The lock is a PostgreSQL advisory lock on the name of the database. It is
+  taken on a connection to the maintenance database 'postgres' of the
+  server, which the workers of all databases share. A copy task in one
+  worker thus excludes eg a plan generation in the worker of the destination
+  database. We don't connect to the frePPLe databases themselves: a copy
+  with the template method requires that nobody is connected to the source,
+  and it recreates the destination. Without access to the maintenance
+  database, the lock is taken on the default database.
+  Tasks writing to a database hold an exclusive lock, and tasks only
+  reading from it hold a shared lock.
+  '''
+  key = 0x66726570
+
+  def __init__(self, database, exclusive=True):
+    self.database = database
+    self.exclusive = exclusive
+    self.connection = None
+
+  def acquire(self):
+    '''
+    Acquires the lock without waiting. Returns true when the lock is held.
+    '''
+    wrapper = connections[DEFAULT_DB_ALIAS]
+    params = wrapper.get_connection_params()
+    params['database'] = 'postgres'
+    try:
+      conn = wrapper.get_new_connection(params)
+    except Exception:
+      conn = wrapper.get_new_connection(wrapper.get_connection_params())
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+      # The lock is on the real name of the database, which is unique on
+      # the server
+      cursor.execute(
+        "select %s(%%s, hashtext(%%s))" % ('pg_try_advisory_lock' if self.exclusive else 'pg_try_advisory_lock_shared'),
+        (self.key, connections[self.database].settings_dict['NAME'])
+        )
+      locked = cursor.fetchone()[0]
+    if locked:
+      self.connection = conn
+    else:
+      conn.close()
+    return locked
+
+  def release(self):
+    # Closing the session releases the lock
+    if self.connection:
+      self.connection.close()
+      self.connection = None
+
+
+def runTask(task, database=DEFAULT_DB_ALIAS):
+  try:
+    logger.info("starting task %d at %s" % (task.id, datetime.now()))
+    background = False
+    task.started = datetime.now()
+    # A
+    if task.name == 'generate plan':
+      kwargs = {}
+      for i in task.arguments.split():
+        j = i.split('=')
+        if len(j) > 1:
+          kwargs[j[0][2:]] = j[1]
+        else:
+          kwargs[j[0][2:]] = True
+      if 'background' in kwargs:
+        background = True
+      management.call_command('frepple_run', database=database, task=task.id, **kwargs)
+      process = backgroundProcesses.pop(task.id, None)
+      if process:
+        # Keep the databases of the task locked until the engine finishes
+        ret = process.wait()
+        background = False
+        if ret != 0 and ret != 2:
+          raise Exception('Failed with exit code %d' % ret)
+    # B
+    elif task.name == 'generate model':
+      args = {}
+      for i in task.arguments.split():
+        key, val = i.split('=')
+        args[key[2:]] = val
+      management.call_command('frepple_flush', database=database)
+      management.call_command('frepple_createmodel', database=database, task=task.id, verbosity=0, **args)
+    # C
+    elif task.name == 'empty database':
+      # Erase the database contents
+      args = {}
+      if task.arguments:
+        for i in task.arguments.split():
+          key, val = i.split('=')
+          args[key[2:]] = val
+      management.call_command('frepple_flush', database=database, task=task.id, **args)
+    # D
+    elif task.name == 'load dataset':
+      args = task.arguments.split()
+      management.call_command('loaddata', *args, verbosity=0, database=database, task=task.id)
+    # E
+    elif task.name == 'copy scenario':
+      args = task.arguments.split()
+      management.call_command('frepple_copy', args[0], args[1], force=True, task=task.id)
+    # F
+    elif task.name == 'backup database':
+      management.call_command('frepple_backup', database=database, task=task.id)
+    # G
+    elif task.name == 'generate buckets':
+      args = {}
+      for i in task.arguments.split():
+        key, val = i.split('=')
+        args[key[2:]] = val
+      management.call_command('frepple_createbuckets', database=database, task=task.id, **args)
+    # J
+    elif task.name == 'Openbravo import' and 'freppledb.openbravo' in settings.INSTALLED_APPS:
+      args = {}
+      for i in task.arguments.split():
+        key, val = i.split('=')
+        args[key[2:]] = val
+      management.call_command('openbravo_import', database=database, task=task.id, verbosity=0, **args)
+    # K
+    elif task.name == 'Openbravo export' and 'freppledb.openbravo' in settings.INSTALLED_APPS:
+      management.call_command('openbravo_export', database=database, task=task.id, verbosity=0)
+    else:
+      logger.error('Task %s not recognized' % task.name)
+    # Read the task again from the database and update.
+    task = Task.objects.all().using(database).get(pk=task.id)
+    if task.status not in ('Done', 'Failed') or not task.finished or not task.started:
+      now = datetime.now()
+      if not task.started:
+        task.started = now
+      if not background:
+        if not task.finished:
+          task.finished = now
+        if task.status not in ('Done', 'Failed'):
+          task.status = 'Done'
+      task.save(using=database)
+    logger.info("finished task %d at %s: success" % (task.id, datetime.now()))
+  except Exception as e:
+    task.status = 'Failed'
+    now = datetime.now()
+    if not task.started:
+      task.started = now
+    task.finished = now
+    task.message = str(e)
+    task.save(using=database)
+    logger.info("finished task %d at %s: failed" % (task.id, datetime.now()))
+  finally:
+    # The task may have changed any data: the cached report counts and
+    # widgets are invalidated. A successful plan export already did this
+    # itself, and may have rendered the widgets again.
+    if task.name != 'generate plan' or task.status != 'Done':
+      try:
+        Dashboard.bumpPlanVersion(database)
+      except Exception as e:
+        logger.error("Error publishing a new plan version: %s" % e)
+
+
+class TaskRunner(Thread):
+  '''
+  Thread running a single task.
+  '''
+  def __init__(self, task, database, done):
+    self.task = task
+    self.database = database
+    self.done = done
+    self.reads, self.writes = getTaskDatabases(task, database)
+    self.locks = []
+    Thread.__init__(self)
+    self.daemon = True
+
+  def lock(self):
+    '''
+    Locks all databases used by the task. Returns false, without holding any
+    lock, when another process is using one of them.
+    '''
+    for db in set(self.reads + self.writes):
+      lock = DatabaseLock(db, exclusive=db in self.writes)
+      if not lock.acquire():
+        self.unlock()
+        return False
+      self.locks.append(lock)
+    return True
+
+  def unlock(self):
+    for lock in self.locks:
+      lock.release()
+    self.locks = []
+
+  def run(self):
+    try:
+      runTask(self.task, self.database)
+    finally:
+      self.unlock()
+      for db in set(self.reads + self.writes + (self.database,)):
+        connections[db].close()
+      self.done(self)
+
+
+class WorkerPool:
+  '''
+  Runs the tasks in the queue of a database, with a maximum number of
+  tasks at the same time.
+
+  A task writing to a database excludes all other tasks using that database.
+  Tasks only reading from a database, eg a backup, run together.
+  Tasks are started in the order of the queue: a task waits for all earlier
+  tasks it conflicts with.
+  The workers of other databases are excluded with a DatabaseLock.
+  '''
+  def __init__(self, database=DEFAULT_DB_ALIAS, concurrency=1):
+    self.database = database
+    self.concurrency = concurrency
+    self.running = {}
+    self.condition = Condition()
+    self.signalled = False
+    self.stopped = False
+
+  def stop(self):
+    '''
+    Stops starting new tasks. The worker exits when the running tasks finish.
+    '''
+    with self.condition:
+      self.stopped = True
+      self.signalled = True
+      self.condition.notify()
+
+  def wakeup(self, runner=None):
+    with self.condition:
+      if runner:
+        del self.running[runner.task.id]
+      self.signalled = True
+      self.condition.notify()
+
+  def wait(self, timeout):
+    with self.condition:
+      if not self.signalled:
+        self.condition.wait(timeout)
+      self.signalled = False
+
+  def startTasks(self):
+    '''
+    Starts the waiting tasks that don't conflict with running or earlier
+    tasks. Returns the number of tasks that remain waiting.
+    '''
+    with self.condition:
+      if self.stopped:
+        return 0
+      reading = set()
+      writing = set()
+      for runner in self.running.values():
+        reading.update(runner.reads)
+        writing.update(runner.writes)
+      waiting = 0
+      for task in Task.objects.all().using(self.database).filter(status='Waiting').order_by('id'):
+        if task.id in self.running:
+          continue
+        reads, writes = getTaskDatabases(task, self.database)
+        runner = None
+        if len(self.running) < self.concurrency \
+          and not writing.intersection(reads + writes) \
+          and not reading.intersection(writes):
+            runner = TaskRunner(task, self.database, self.wakeup)
+            if not runner.lock():
+              # Used by a task of another worker
+              runner = None
+        if runner:
+          self.running[task.id] = runner
+          runner.start()
+        else:
+          waiting += 1
+        # Later tasks can't overtake this one
+        reading.update(reads)
+        writing.update(writes)
+      return waiting
+
+
 class Command(BaseCommand):
   help = '''Processes the job queue of a database.
     The command is intended only to be used internally by frePPLe, not by an API or user.
@@ -69,6 +401,10 @@ class Command(BaseCommand):
       '--continuous', action="store_true", dest='continuous',
       default=False, help='Keep the worker alive after the queue is empty'
       ),
+    make_option(
+      '--concurrency', action='store', dest='concurrency', type='int',
+      help='Maximum number of tasks running at the same time (default = value of the parameter worker.concurrency, or 1)'
+      ),
   )
   requires_system_checks = False
 
@@ -89,6 +425,15 @@ class Command(BaseCommand):
     else:
       continuous = False
 
+    if options.get('concurrency', None):
+      concurrency = options['concurrency']
+    else:
+      try:
+        concurrency = int(Parameter.getValue('worker.concurrency', database, '1'))
+      except ValueError:
+        concurrency = 1
+    concurrency = max(concurrency, 1)
+
     # Check if a worker already exists
     if checkActive(database):
       logger.info("Worker process already active")
@@ -97,106 +442,22 @@ class Command(BaseCommand):
     # Spawn a worker-alive thread
     WorkerAlive(database).start()
 
+    # Listen for new tasks
+    pool = WorkerPool(database, concurrency)
+    TaskListener(database, pool.wakeup, pool.stop).start()
+
     # Process the queue
     logger.info("Worker starting to process jobs in the queue")
     while True:
-      try:
-        task = Task.objects.all().using(database).filter(status='Waiting').order_by('id')[0]
-      except:
-        # No more tasks found
-        if continuous:
-          time.sleep(5)
-          continue
-        else:
-          break
-      try:
-        logger.info("starting task %d at %s" % (task.id, datetime.now()))
-        background = False
-        task.started = datetime.now()
-        # A
-        if task.name == 'generate plan':
-          kwargs = {}
-          for i in task.arguments.split():
-            j = i.split('=')
-            if len(j) > 1:
-              kwargs[j[0][2:]] = j[1]
-            else:
-              kwargs[j[0][2:]] = True
-          if 'background' in kwargs:
-            background = True
-          management.call_command('frepple_run', database=database, task=task.id, **kwargs)
-        # B
-        elif task.name == 'generate model':
-          args = {}
-          for i in task.arguments.split():
-            key, val = i.split('=')
-            args[key[2:]] = val
-          management.call_command('frepple_flush', database=database)
-          management.call_command('frepple_createmodel', database=database, task=task.id, verbosity=0, **args)
-        # C
-        elif task.name == 'empty database':
-          # Erase the database contents
-          args = {}
-          if task.arguments:
-            for i in task.arguments.split():
-              key, val = i.split('=')
-              args[key[2:]] = val
-          management.call_command('frepple_flush', database=database, task=task.id, **args)
-        # D
-        elif task.name == 'load dataset':
-          args = task.arguments.split()
-          management.call_command('loaddata', *args, verbosity=0, database=database, task=task.id)
-        # E
-        elif task.name == 'copy scenario':
-          args = task.arguments.split()
-          management.call_command('frepple_copy', args[0], args[1], force=True, task=task.id)
-        # F
-        elif task.name == 'backup database':
-          management.call_command('frepple_backup', database=database, task=task.id)
-        # G
-        elif task.name == 'generate buckets':
-          args = {}
-          for i in task.arguments.split():
-            key, val = i.split('=')
-            args[key[2:]] = val
-          management.call_command('frepple_createbuckets', database=database, task=task.id, **args)
-        # J
-        elif task.name == 'Openbravo import' and 'freppledb.openbravo' in settings.INSTALLED_APPS:
-          args = {}
-          for i in task.arguments.split():
-            key, val = i.split('=')
-            args[key[2:]] = val
-          management.call_command('openbravo_import', database=database, task=task.id, verbosity=0, **args)
-        # K
-        elif task.name == 'Openbravo export' and 'freppledb.openbravo' in settings.INSTALLED_APPS:
-          management.call_command('openbravo_export', database=database, task=task.id, verbosity=0)
-        else:
-          logger.error('Task %s not recognized' % task.name)
-        # Read the task again from the database and update.
-        task = Task.objects.all().using(database).get(pk=task.id)
-        if task.status not in ('Done', 'Failed') or not task.finished or not task.started:
-          now = datetime.now()
-          if not task.started:
-            task.started = now
-          if not background:
-            if not task.finished:
-              task.finished = now
-            if task.status not in ('Done', 'Failed'):
-              task.status = 'Done'
-          task.save(using=database)
-        logger.info("finished task %d at %s: success" % (task.id, datetime.now()))
-      except Exception as e:
-        task.status = 'Failed'
-        now = datetime.now()
-        if not task.started:
-          task.started = now
-        task.finished = now
-        task.message = str(e)
-        task.save(using=database)
-        logger.info("finished task %d at %s: failed" % (task.id, datetime.now()))
+      waiting = pool.startTasks()
+      if not waiting and not pool.running and (pool.stopped or not continuous):
+        # No more tasks found, or asked to stop
+        break
+      # Wait till a new task is added or a running task finishes
+      pool.wait(5)
     # Remove the parameter again
     try:
-      Parameter.objects.all().using(self.database).get(pk='Worker alive').delete()
+      Parameter.objects.all().using(database).get(pk='Worker alive').delete()
     except:
       pass
     # Exit
@@ -206,7 +206,9 @@ class Command(BaseCommand):
 
       # The simulation only support complete shipments for the full quantity.
       # We enforce that the generated plan respects this as well.
-      Demand.objects.all().using(database).update(minshipment=F('quantity'))
+      # The last modification is updated as well, so a planning engine daemon
+      # picks up the change.
+      Demand.objects.all().using(database).update(minshipment=F('quantity'), lastmodified=datetime.now())
 
       # Loop over all dates in the simulation horizon
       idx = 0
@@ -17,6 +17,8 @@
 from django.utils.translation import ugettext_lazy as _
 
 from freppledb.menu import menu
+import freppledb.execute.views
 
 # Add an item to the Admin menu
 menu.addItem("admin", "execute", url="/execute/", label=_('Execute'), index=100)
+menu.addItem("admin", "task performance", url="/execute/stages/", report=freppledb.execute.views.StageReport, index=150)
@@ -0,0 +1,48 @@
+#
+# Copyright (C) 2016 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+  dependencies = [
+    ('execute', '0001_initial'),
+  ]
+
+  operations = [
+    migrations.CreateModel(
+      name='TaskStage',
+      fields=[
+        ('id', models.AutoField(editable=False, primary_key=True, verbose_name='identifier', serialize=False)),
+        ('sequence', models.IntegerField(editable=False, verbose_name='sequence')),
+        ('stage', models.CharField(editable=False, verbose_name='stage', db_index=True, max_length=300)),
+        ('rows', models.BigIntegerField(null=True, editable=False, verbose_name='rows')),
+        ('walltime', models.FloatField(null=True, editable=False, verbose_name='wall time')),
+        ('cputime', models.FloatField(null=True, editable=False, verbose_name='cpu time')),
+        ('dbtime', models.FloatField(null=True, editable=False, verbose_name='database time')),
+        ('maxrss', models.BigIntegerField(null=True, editable=False, verbose_name='peak memory')),
+        ('task', models.ForeignKey(related_name='stages', verbose_name='task', editable=False, to='execute.Task')),
+      ],
+      options={
+        'db_table': 'execute_stage',
+        'ordering': ['task', 'sequence'],
+        'verbose_name': 'task stage',
+        'verbose_name_plural': 'task stages',
+      },
+    ),
+  ]
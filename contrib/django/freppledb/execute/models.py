@@ -59,3 +59,30 @@ class Task(models.Model):
     # Add record to the database
     # Check if a worker is present. If not launch one.
     return 1
+
+
+class TaskStage(models.Model):
+  '''
+  Resources used by a stage of a task.
+  Stages are named with a dotted notation, eg 'load' and 'load.items'.
+  See freppledb.execute.stages.
+  '''
+  # Database fields
+  id = models.AutoField(_('identifier'), primary_key=True, editable=False)
+  task = models.ForeignKey(Task, verbose_name=_('task'), db_index=True, editable=False, related_name='stages')
+  sequence = models.IntegerField(_('sequence'), editable=False)
+  stage = models.CharField(_('stage'), max_length=300, db_index=True, editable=False)
+  rows = models.BigIntegerField(_('rows'), null=True, editable=False)
+  walltime = models.FloatField(_('wall time'), null=True, editable=False)
+  cputime = models.FloatField(_('cpu time'), null=True, editable=False)
+  dbtime = models.FloatField(_('database time'), null=True, editable=False)
+  maxrss = models.BigIntegerField(_('peak memory increase'), null=True, editable=False)
+
+  def __str__(self):
+    return "%s - %s" % (self.task_id, self.stage)
+
+  class Meta:
+    db_table = "execute_stage"
+    verbose_name_plural = _('task stages')
+    verbose_name = _('task stage')
+    ordering = ['task', 'sequence']
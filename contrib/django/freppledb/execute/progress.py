@@ -0,0 +1,198 @@
+#
+# Copyright (C) 2016 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+r'''
+Reports the progress of the task run by the current process.
+
+The status of the task is written by a background thread, at most once every
+second. Updates in between are coalesced: only the last one is written.
+The same thread polls the task for a cancellation by the user.
+
+This makes it cheap to report progress frequently:
+  - reportProgress(fraction) sets the progress within the current phase of
+    the task. A phase is started with the function logProgress of the module
+    freppledb.execute.commands.
+  - checkCancel() stops the task when the user cancelled it. In the main
+    thread the task is marked as cancelled and the process exits. In other
+    threads the exception TaskCancelled is raised.
+
+The task is identified by the environment variable FREPPLE_TASKID.
+'''
+import atexit
+import os
+import sys
+from threading import Condition, Lock, Thread, current_thread, main_thread
+
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from freppledb.execute.models import Task
+
+
+class TaskCancelled(Exception):
+  '''
+  Raised in a worker thread when the user cancels the task.
+  '''
+  pass
+
+
+class TaskProgress(Thread):
+
+  # Minimum number of seconds between updates of the task
+  interval = 1.0
+
+  def __init__(self, task, database=DEFAULT_DB_ALIAS):
+    super(TaskProgress, self).__init__()
+    self.daemon = True
+    self.task = task
+    self.database = database
+    self.status = None
+    self.message = None
+    self.finished = None
+    self.pending = False
+    self.cancelled = False
+    self.stopped = False
+    self.phase = (0, 0)
+    self.condition = Condition()
+    self.lock = Lock()
+
+  def update(self, status=None, message=None, finished=None):
+    '''
+    Registers a change of the task. The change is written by the background
+    thread.
+    '''
+    with self.condition:
+      if status is not None:
+        self.status = status
+      if message is not None:
+        self.message = message
+      if finished is not None:
+        self.finished = finished
+      self.pending = True
+
+  def write(self):
+    '''
+    Writes the pending changes of the task, and checks for a cancellation.
+    '''
+    with self.lock:
+      with self.condition:
+        pending = self.pending
+        status, message, finished = self.status, self.message, self.finished
+        self.pending = False
+      cursor = connections[self.database].cursor()
+      if pending:
+        cursor.execute('''
+          update execute_log
+          set status = coalesce(%s, status), message = coalesce(%s, message),
+            finished = coalesce(%s, finished)
+          where id = %s and status not in ('Canceling', 'Cancelled')
+          ''', (status, message, finished, self.task))
+        if cursor.rowcount:
+          return
+      cursor.execute("select status from execute_log where id = %s", (self.task,))
+      row = cursor.fetchone()
+      if row and row[0] == 'Canceling':
+        self.cancelled = True
+
+  def run(self):
+    try:
+      while True:
+        with self.condition:
+          self.condition.wait(self.interval)
+          if self.stopped:
+            return
+        try:
+          self.write()
+        except Exception as e:
+          print("Error updating the status of task %s: %s" % (self.task, e))
+    finally:
+      connections[self.database].close()
+
+  def stop(self):
+    '''
+    Stops the background thread and writes the last changes.
+    '''
+    with self.condition:
+      self.stopped = True
+      self.condition.notify()
+    self.join()
+    self.write()
+
+
+# The progress writer of the task currently run by this process
+_progress = None
+_lock = Lock()
+
+
+def getProgress(database=DEFAULT_DB_ALIAS):
+  '''
+  Returns the progress writer of the task run by this process, or None
+  when the process doesn't run a task.
+  '''
+  global _progress
+  task = os.environ.get('FREPPLE_TASKID', None)
+  with _lock:
+    if _progress:
+      if task and _progress.task == int(task) and _progress.database == database:
+        return _progress
+      _progress.stop()
+      _progress = None
+    if not task:
+      return None
+    if not Task.objects.all().using(database).filter(pk=task).exists():
+      raise Exception("Task identifier not found")
+    _progress = TaskProgress(int(task), database)
+    _progress.start()
+    return _progress
+
+
+@atexit.register
+def stopProgress():
+  '''
+  Writes the last changes of the task and stops the background thread.
+  '''
+  global _progress
+  with _lock:
+    if _progress:
+      _progress.stop()
+      _progress = None
+
+
+def reportProgress(fraction, database=DEFAULT_DB_ALIAS):
+  '''
+  Reports which fraction of the current phase of the task is completed.
+  '''
+  progress = _progress
+  if not progress:
+    return
+  start, end = progress.phase
+  status = '%d%%' % (start + (end - start) * min(fraction, 1))
+  if status != progress.status:
+    progress.update(status=status)
+
+
+def checkCancel(database=DEFAULT_DB_ALIAS):
+  '''
+  Stops the task when the user has cancelled it.
+  '''
+  progress = _progress
+  if not progress or not progress.cancelled:
+    return
+  if current_thread() is not main_thread():
+    raise TaskCancelled("Task %s is cancelled" % progress.task)
+  stopProgress()
+  Task.objects.all().using(progress.database).filter(pk=progress.task).update(status='Cancelled')
+  sys.exit(2)
@@ -0,0 +1,123 @@
+#
+# Copyright (C) 2016 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+r'''
+Measures the resources used by the stages of a task.
+
+A stage is measured with a context manager:
+    with Stage('load') as stage:
+      ...
+      stage.add('load.items', rows=100, walltime=1.5, dbtime=0.5)
+
+The wall time and cpu time of the stage are measured, as well as the
+increase of the peak memory of the process during the stage. The peak
+memory of a process never goes down: a stage that reuses memory freed by an
+earlier stage reports no increase. Steps inside the stage that collect
+their own statistics are added as sub-stages with the method add().
+
+When the process runs a task (ie the environment variable FREPPLE_TASKID is
+set) the measurements are stored in the table execute_stage.
+'''
+import os
+import sys
+from time import time, process_time
+
+try:
+  import resource
+except ImportError:
+  # Not available on Windows
+  resource = None
+
+from django.db import DEFAULT_DB_ALIAS
+
+from freppledb.execute.models import TaskStage
+
+
+def peakMemory():
+  '''
+  Returns the peak resident memory of this process in kB, or None when the
+  platform doesn't report it.
+  '''
+  if not resource:
+    return None
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    # Reported in bytes on Mac OS
+    rss //= 1024
+  return rss
+
+
+class Stage:
+
+  # Sequence number of the stages of the task
+  sequence = 0
+
+  def __init__(self, name, database=DEFAULT_DB_ALIAS):
+    self.name = name
+    self.database = database
+    self.rows = None
+    self.dbtime = None
+    self.substages = []
+
+  def add(self, name, rows=None, walltime=None, cputime=None, dbtime=None, maxrss=None):
+    '''
+    Adds a sub-stage. The rows and database time of all sub-stages are
+    summed in the stage. The argument maxrss is the increase of the peak
+    memory during the sub-stage, in kB.
+    '''
+    self.substages.append((name, rows, walltime, cputime, dbtime, maxrss))
+    if rows is not None:
+      self.rows = (self.rows or 0) + rows
+    if dbtime is not None:
+      self.dbtime = (self.dbtime or 0) + dbtime
+
+  def __enter__(self):
+    self.starttime = time()
+    self.startcpu = process_time()
+    self.startrss = peakMemory()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    walltime = time() - self.starttime
+    cputime = process_time() - self.startcpu
+    peak = peakMemory()
+    print("Stage %s: %.2f seconds, %.2f seconds cpu%s" % (
+      self.name, walltime, cputime,
+      ", process peak memory %d kB" % peak if peak else ''
+      ))
+    if exc_type is None:
+      self.save(walltime, cputime, peak - self.startrss if peak is not None else None)
+    return False
+
+  def save(self, walltime, cputime, maxrss):
+    try:
+      task = int(os.environ['FREPPLE_TASKID'])
+    except (KeyError, ValueError):
+      return
+    records = [(self.name, self.rows, walltime, cputime, self.dbtime, maxrss)]
+    records.extend(self.substages)
+    stages = []
+    for name, rows, walltime, cputime, dbtime, maxrss in records:
+      Stage.sequence += 1
+      stages.append(TaskStage(
+        task_id=task, sequence=Stage.sequence, stage=name, rows=rows,
+        walltime=walltime, cputime=cputime, dbtime=dbtime, maxrss=maxrss
+        ))
+    try:
+      TaskStage.objects.using(self.database).bulk_create(stages)
+    except Exception as e:
+      print("Error saving the statistics of stage %s: %s" % (self.name, e))
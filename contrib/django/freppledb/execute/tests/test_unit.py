@@ -16,6 +16,10 @@
 #
 
 import os
+from datetime import datetime
+from threading import Event
+from time import sleep
+from unittest import mock
 
 from django.conf import settings
 from django.core import management, serializers
@@ -24,6 +28,12 @@ from django.db.models import Sum, Count, Q
 from django.test import TransactionTestCase, TestCase
 from django.test.utils import override_settings
 
+from freppledb.common.models import Parameter
+from freppledb.execute.management.commands.frepple_copy import Command as CopyCommand
+from freppledb.execute.management.commands.frepple_daemon import sendCommand
+from freppledb.execute.management.commands.frepple_runworker import DatabaseLock, WorkerPool
+from freppledb.execute.models import Task, TaskStage
+from freppledb.execute.progress import getProgress, reportProgress, checkCancel, stopProgress
 import freppledb.output as output
 import freppledb.input as input
 
@@ -66,6 +76,47 @@ class execute_with_commands(TransactionTestCase):
     self.assertTrue(output.models.LoadPlan.objects.count() > 40)
     self.assertTrue(output.models.OperationPlan.objects.count(), 350)
 
+    # Check the statistics of the plan generation
+    task = Task.objects.filter(name='generate plan').order_by('-id')[0]
+    stages = list(TaskStage.objects.filter(task=task).order_by('sequence'))
+    names = [ s.stage for s in stages ]
+    for stage in ('load.demand', 'export.out_flowplan'):
+      self.assertIn(stage, names)
+    # Every stage is followed by its sub-stages
+    self.assertEqual([ n for n in names if '.' not in n ], ['load', 'solve', 'export'])
+    self.assertTrue(all(
+      n.startswith('load.') for n in names[names.index('load') + 1:names.index('solve')]
+      ))
+    self.assertTrue(all(n.startswith('export.') for n in names[names.index('export') + 1:]))
+    sequences = [ s.sequence for s in stages ]
+    self.assertEqual(sequences, sorted(set(sequences)))
+    for s in stages:
+      if '.' not in s.stage:
+        self.assertGreater(s.walltime, 0)
+        self.assertGreaterEqual(s.cputime, 0)
+        self.assertTrue(s.maxrss is None or s.maxrss >= 0)
+    self.assertGreater(stages[names.index('load.demand')].rows, 0)
+
+  def test_parallel_load(self):
+    # Loading the model over parallel connections gives the same model, and
+    # thus the same plan, as a sequential load
+    results = []
+    for threads in ('0', '4'):
+      Parameter.objects.update_or_create(name='plan.loadThreads', defaults={'value': threads})
+      management.call_command('frepple_run', plantype=1, constraint=15)
+      task = Task.objects.filter(name='generate plan').order_by('-id')[0]
+      results.append((
+        { s.stage: s.rows for s in TaskStage.objects.filter(task=task, stage__startswith='load.') },
+        output.models.OperationPlan.objects.count(),
+        output.models.FlowPlan.objects.count(),
+        output.models.LoadPlan.objects.count(),
+        output.models.ResourceSummary.objects.count(),
+        output.models.Demand.objects.count(),
+        output.models.Problem.objects.count(),
+        ))
+    self.assertTrue(results[0][0])
+    self.assertEqual(results[0], results[1])
+
 
 class execute_multidb(TransactionTestCase):
   multi_db = True
@@ -130,6 +181,165 @@ class execute_multidb(TransactionTestCase):
     self.assertNotEqual(count2, 0)
     self.assertNotEqual(count2, count1new)
 
+  def test_copy_methods(self):
+    db1 = DEFAULT_DB_ALIAS
+    db2 = None
+    for i in settings.DATABASES:
+      if i != DEFAULT_DB_ALIAS:
+        db2 = i
+        break
+    if not db2:
+      # Only a single database is configured and we skip this test
+      return
+    count1 = input.models.Demand.objects.all().using(db1).count()
+    self.assertNotEqual(count1, 0)
+
+    # Copy with the parallel and plain methods
+    for method in ('parallel', 'plain'):
+      management.call_command('frepple_flush', database=db2)
+      self.assertEqual(input.models.Demand.objects.all().using(db2).count(), 0)
+      transaction.commit(using=db1)
+      transaction.commit(using=db2)
+      management.call_command('frepple_copy', db1, db2, force=True, method=method)
+      self.assertEqual(input.models.Demand.objects.all().using(db2).count(), count1)
+
+    # A template copy that isn't possible leaves the destination untouched
+    management.call_command('frepple_flush', database=db2)
+    transaction.commit(using=db1)
+    transaction.commit(using=db2)
+    copied = CopyCommand().copyTemplate(db1, db2, True)
+    self.assertEqual(input.models.Demand.objects.all().using(db2).count(), count1 if copied else 0)
+
+
+class execute_daemon(TransactionTestCase):
+
+  fixtures = ["demo"]
+
+  def setUp(self):
+    # Make sure the test database is used
+    os.environ['FREPPLE_TEST'] = "YES"
+
+  def tearDown(self):
+    sendCommand(DEFAULT_DB_ALIAS, 'stop')
+    del os.environ['FREPPLE_TEST']
+
+  def test_daemon(self):
+    management.call_command('frepple_daemon')
+    # Wait till the daemon has loaded the model and accepts commands
+    status = None
+    for i in range(120):
+      status = sendCommand(DEFAULT_DB_ALIAS, 'status')
+      if status:
+        break
+      sleep(1)
+    self.assertIsNotNone(status, "Daemon didn't start")
+    self.assertTrue(status['loaded'])
+    self.assertEqual(status['runs'], 0)
+
+    # Plan and export
+    reply = sendCommand(DEFAULT_DB_ALIAS, 'plan', plantype=1, constraint=15)
+    self.assertEqual(reply['status'], 'ok')
+    self.assertNotEqual(output.models.FlowPlan.objects.count(), 0)
+    self.assertNotEqual(output.models.OperationPlan.objects.count(), 0)
+
+    # A second run only applies the changes in the database
+    input.models.Demand.objects.all().update(quantity=1, lastmodified=datetime.now())
+    reply = sendCommand(DEFAULT_DB_ALIAS, 'plan', plantype=1, constraint=15)
+    self.assertEqual(reply['status'], 'ok')
+    self.assertFalse(output.models.Demand.objects.filter(planquantity__gt=1).exists())
+    status = sendCommand(DEFAULT_DB_ALIAS, 'status')
+    self.assertEqual(status['runs'], 2)
+
+
+class execute_worker(TransactionTestCase):
+
+  def addTask(self, name, arguments=''):
+    task = Task(name=name, submitted=datetime.now(), status='Waiting', arguments=arguments)
+    task.save()
+    return task.id
+
+  def test_start_tasks(self):
+    # The tasks don't finish before we allow them to
+    finish = Event()
+
+    def runTask(task, database):
+      finish.wait(10)
+      Task.objects.filter(pk=task.id).update(status='Done')
+
+    with mock.patch(
+      'freppledb.execute.management.commands.frepple_runworker.runTask',
+      side_effect=runTask
+      ):
+      pool = WorkerPool(DEFAULT_DB_ALIAS, concurrency=3)
+      plan = self.addTask('generate plan')
+      backup1 = self.addTask('backup database')
+      backup2 = self.addTask('backup database')
+
+      # A task writing to the database excludes all others
+      self.assertEqual(pool.startTasks(), 2)
+      self.assertEqual(list(pool.running), [plan])
+
+      # Tasks reading from the database run together
+      finish.set()
+      pool.running[plan].join()
+      finish.clear()
+      self.assertEqual(pool.startTasks(), 0)
+      self.assertEqual(sorted(pool.running), [backup1, backup2])
+      finish.set()
+      for runner in list(pool.running.values()):
+        runner.join()
+
+  def test_database_lock(self):
+    # A lock held by another worker blocks the task
+    lock = DatabaseLock(DEFAULT_DB_ALIAS)
+    self.assertTrue(lock.acquire())
+    try:
+      other = DatabaseLock(DEFAULT_DB_ALIAS, exclusive=False)
+      self.assertFalse(other.acquire())
+      pool = WorkerPool(DEFAULT_DB_ALIAS)
+      self.addTask('generate plan')
+      self.assertEqual(pool.startTasks(), 1)
+      self.assertEqual(pool.running, {})
+    finally:
+      lock.release()
+    # Shared locks don't exclude each other
+    shared1 = DatabaseLock(DEFAULT_DB_ALIAS, exclusive=False)
+    shared2 = DatabaseLock(DEFAULT_DB_ALIAS, exclusive=False)
+    try:
+      self.assertTrue(shared1.acquire())
+      self.assertTrue(shared2.acquire())
+    finally:
+      shared1.release()
+      shared2.release()
+
+
+class execute_progress(TransactionTestCase):
+
+  def test_progress(self):
+    task = Task(name='generate plan', submitted=datetime.now(), status='Waiting')
+    task.save()
+    os.environ['FREPPLE_TASKID'] = str(task.id)
+    try:
+      # Progress within a phase
+      progress = getProgress()
+      progress.phase = (10, 20)
+      reportProgress(0.5)
+      progress.write()
+      self.assertEqual(Task.objects.get(pk=task.id).status, '15%')
+
+      # Updates don't overwrite a cancellation by the user
+      Task.objects.filter(pk=task.id).update(status='Canceling')
+      reportProgress(1)
+      progress.write()
+      self.assertTrue(progress.cancelled)
+      self.assertEqual(Task.objects.get(pk=task.id).status, 'Canceling')
+      with self.assertRaises(SystemExit):
+        checkCancel()
+      self.assertEqual(Task.objects.get(pk=task.id).status, 'Cancelled')
+    finally:
+      del os.environ['FREPPLE_TASKID']
+      stopProgress()
+
 
 class FixtureTest(TestCase):
 
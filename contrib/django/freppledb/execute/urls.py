@@ -26,6 +26,7 @@ urlpatterns = patterns(
   '',   # Prefix
   url(r'^execute/$', freppledb.execute.views.TaskReport.as_view(), name="execute"),
   url(r'^execute/logfrepple/$', freppledb.execute.views.logfile, name="execute_log"),
+  url(r'^execute/stages/$', freppledb.execute.views.StageReport.as_view(), name="execute_stages"),
   url(r'^execute/launch/(.+)/$', freppledb.execute.views.LaunchTask, name="execute_launch"),
   url(r'^execute/cancel/(.+)/$', freppledb.execute.views.CancelTask, name="execute_cancel"),
 )
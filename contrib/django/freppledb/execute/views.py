@@ -33,10 +33,11 @@ from django.http import Http404, HttpResponseRedirect, HttpResponseServerError,
 from django.contrib import messages
 from django.utils.encoding import force_text
 
-from freppledb.execute.models import Task
+from freppledb.execute.models import Task, TaskStage
 from freppledb.common.models import Scenario
 from freppledb.common.report import exportWorkbook, importWorkbook
 from freppledb.common.report import GridReport, GridFieldDateTime, GridFieldText, GridFieldInteger
+from freppledb.common.report import GridFieldNumber
 from freppledb.execute.management.commands.frepple_runworker import checkActive
 
 import logging
@@ -113,6 +114,45 @@ class TaskReport(GridReport):
             }
 
 
+class StageReport(GridReport):
+  '''
+  A report to compare the resources used by the stages of the tasks.
+  Each stage shows the change of its wall time compared to the previous run
+  of the same stage.
+  '''
+  title = _('Task performance')
+  basequeryset = TaskStage.objects.all().extra(select={
+    'change': '''
+      select round((100 * (execute_stage.walltime - previous.walltime) / previous.walltime)::numeric, 1)
+      from execute_stage previous
+      where previous.stage = execute_stage.stage
+        and previous.task_id < execute_stage.task_id
+        and previous.walltime > 0
+      order by previous.task_id desc
+      limit 1
+      '''
+    })
+  model = TaskStage
+  permissions = (("view_task_performance", "Can view task performance"),)
+  frozenColumns = 2
+  multiselect = False
+  editable = False
+  default_sort = (0, 'desc')
+
+  rows = (
+    GridFieldInteger('task', title=_('task'), field_name='task__id'),
+    GridFieldText('stage', title=_('stage'), editable=False),
+    GridFieldDateTime('submitted', title=_('submitted'), field_name='task__submitted', editable=False),
+    GridFieldInteger('rows', title=_('rows'), editable=False),
+    GridFieldNumber('walltime', title=_('wall time'), editable=False),
+    GridFieldNumber('change', title=_('change %'), editable=False, search=False),
+    GridFieldNumber('cputime', title=_('cpu time'), editable=False),
+    GridFieldNumber('dbtime', title=_('database time'), editable=False),
+    GridFieldInteger('maxrss', title=_('peak memory increase'), editable=False),
+    GridFieldInteger('id', title=_('identifier'), key=True, hidden=True),
+    )
+
+
 @staff_member_required
 @never_cache
 @csrf_protect
@@ -0,0 +1,66 @@
+#
+# Copyright (C) 2016 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.db import migrations, models, transaction
+
+
+def searchTables(apps):
+  # All tables with a text primary key are searchable
+  for app in ('common', 'input'):
+    for m in apps.get_app_config(app).get_models():
+      if isinstance(m._meta.pk, models.CharField):
+        yield m._meta.db_table, m._meta.pk.column
+
+
+def CreateSearchIndexes(apps, schema_editor):
+  cursor = schema_editor.connection.cursor()
+  try:
+    with transaction.atomic(using=schema_editor.connection.alias):
+      cursor.execute("create extension if not exists pg_trgm")
+  except Exception as e:
+    print('''
+
+      Warning: the pg_trgm extension couldn't be installed: %s
+      The search box will still work, but will be slow on big databases.
+      A database administrator can install the extension with "create extension pg_trgm"
+      and rerun this migration.
+      ''' % e)
+    return
+  for table, column in searchTables(apps):
+    cursor.execute("drop index if exists %s_search" % table)
+    cursor.execute(
+      "create index %s_search on %s using gin (%s gin_trgm_ops)"
+      % (table, table, column)
+      )
+
+
+def DropSearchIndexes(apps, schema_editor):
+  cursor = schema_editor.connection.cursor()
+  for table, column in searchTables(apps):
+    cursor.execute("drop index if exists %s_search" % table)
+
+
+class Migration(migrations.Migration):
+
+  dependencies = [
+    ('common', '0002_defaultuser'),
+    ('input', '0004_non_nullable_fields'),
+  ]
+
+  operations = [
+    migrations.RunPython(CreateSearchIndexes, DropSearchIndexes),
+  ]
@@ -0,0 +1,57 @@
+#
+# Copyright (C) 2016 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.db import migrations, models
+
+
+def hierarchyTables(apps):
+  for m in apps.get_app_config('input').get_models():
+    if 'rght' in [ f.name for f in m._meta.fields ] and 'owner' in [ f.name for f in m._meta.fields ]:
+      yield m._meta.db_table, m._meta.get_field('owner').column
+
+
+def CreateOwnerIndexes(apps, schema_editor):
+  # Index to find the last child of an owner when adding a node
+  cursor = schema_editor.connection.cursor()
+  for table, column in hierarchyTables(apps):
+    cursor.execute(
+      "create index %s_owner_rght on %s (%s, rght)" % (table, table, column)
+      )
+
+
+def DropOwnerIndexes(apps, schema_editor):
+  cursor = schema_editor.connection.cursor()
+  for table, column in hierarchyTables(apps):
+    cursor.execute("drop index if exists %s_owner_rght" % table)
+
+
+class Migration(migrations.Migration):
+
+  dependencies = [
+    ('input', '0005_search_index'),
+  ]
+
+  operations = [
+    migrations.AlterField(
+      model_name=model,
+      name='rght',
+      field=models.PositiveIntegerField(db_index=True, editable=False, null=True, blank=True),
+      )
+    for model in ('buffer', 'customer', 'demand', 'item', 'location', 'resource', 'supplier')
+    ] + [
+    migrations.RunPython(CreateOwnerIndexes, DropOwnerIndexes),
+  ]
@@ -14,13 +14,16 @@
 # You should have received a copy of the GNU Affero General Public
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import json
 import tempfile
+from urllib.parse import quote
 
 from django.conf import settings
 from django.test import TestCase
 from django.test.utils import override_settings
 
-from freppledb.input.models import Location
+from freppledb.input.models import Buffer, Flow, Item, Location
+from freppledb.input.views import SupplyChainGraph
 
 
 @override_settings(INSTALLED_APPS=settings.INSTALLED_APPS + ('django.contrib.sessions',))
@@ -81,3 +84,118 @@ class DataLoadTest(TestCase):
       [(i.name, i.category or u'') for i in Location.objects.order_by('name')],
       [(u'factory 1', u''), (u'factory 2', u''), (u'factory 3', u'cat1'), (u'factory 4', u'')]
       )
+
+  def test_csv_upload_update(self):
+    try:
+      data = tempfile.TemporaryFile(mode='w+b')
+      data.write(b'name,category,owner\n')
+      data.write(b'factory 1,cat2,\n')
+      data.write(b'factory 5,cat3,factory 1\n')
+      data.write(b'factory 6,,unknown\n')
+      data.write(b'factory 7,,factory 5\n')
+      data.seek(0)
+      response = self.client.post('/data/input/location/', {'csv_file': data})
+      messages = b''.join(response.streaming_content).decode('utf-8')
+      self.assertEqual(response.status_code, 200)
+    finally:
+      data.close()
+    self.assertIn('Row 4 field owner', messages)
+    self.assertIn('changed 1 and added 2 records', messages)
+    self.assertEqual(
+      [(i.name, i.category or u'', i.owner_id) for i in Location.objects.order_by('name')],
+      [
+        (u'factory 1', u'cat2', None), (u'factory 2', u'', None),
+        (u'factory 5', u'cat3', u'factory 1'), (u'factory 7', u'', u'factory 5')
+      ]
+      )
+
+  def test_csv_upload_unique(self):
+    flow = Flow.objects.all().order_by('id')[0]
+    try:
+      data = tempfile.TemporaryFile(mode='w+b')
+      data.write(b'operation,thebuffer,quantity\n')
+      data.write(('%s,%s,2\n' % (flow.operation_id, flow.thebuffer_id)).encode('utf-8'))
+      data.seek(0)
+      response = self.client.post('/data/input/flow/', {'csv_file': data})
+      messages = b''.join(response.streaming_content).decode('utf-8')
+      self.assertEqual(response.status_code, 200)
+    finally:
+      data.close()
+    # The duplicate is reported with the validation message, not the database error
+    self.assertIn('Row 2: ', messages)
+    self.assertIn('already exists', messages)
+
+  def test_supply_path_graph(self):
+    graph = SupplyChainGraph.get()
+    self.assertIs(graph, SupplyChainGraph.get())
+    self.assertEqual(len(graph.buffers), 8)
+    it = Item.objects.all().order_by('name')[0]
+    it.description = 'changed'
+    it.save()
+    # The version isn't checked again within the check interval
+    self.assertIs(graph, SupplyChainGraph.get())
+    graph.checked -= SupplyChainGraph.checkInterval
+    self.assertIsNot(graph, SupplyChainGraph.get())
+    for b in Buffer.objects.all():
+      response = self.client.get('/supplypath/buffer/%s/?format=json' % quote(b.name))
+      self.assertEqual(response.status_code, 200)
+
+  def test_search(self):
+    response = self.client.get('/search/?term=factory')
+    self.assertEqual(response.status_code, 200)
+    result = json.loads(response.content.decode('utf-8'))
+    self.assertIn({'url': '/data/input/location/', 'value': 'factory 1'}, result)
+    self.assertIn({'value': None, 'label': 'Location - 2 matches'}, result)
+    response = self.client.get('/search/?term=%25')
+    self.assertEqual(json.loads(response.content.decode('utf-8')), [])
+    # Short terms only match the start of the names
+    response = self.client.get('/search/?term=fa')
+    result = json.loads(response.content.decode('utf-8'))
+    self.assertIn({'url': '/data/input/location/', 'value': 'factory 1'}, result)
+    response = self.client.get('/search/?term=ct')
+    self.assertNotIn({'url': '/data/input/location/', 'value': 'factory 1'}, json.loads(response.content.decode('utf-8')))
+
+  def test_hierarchy(self):
+    def checkHierarchy():
+      # Intervals of children are nested in the interval of their owner,
+      # and intervals of other nodes don't overlap
+      stack = []
+      for i in Item.objects.all().order_by('lft'):
+        self.assertIsNotNone(i.lft)
+        while stack and stack[-1].rght < i.lft:
+          stack.pop()
+        if i.owner_id:
+          self.assertEqual(stack[-1].name, i.owner_id)
+          self.assertTrue(i.rght < stack[-1].rght)
+          self.assertEqual(i.lvl, stack[-1].lvl + 1)
+        else:
+          self.assertEqual(stack, [])
+          self.assertEqual(i.lvl, 0)
+        stack.append(i)
+
+    Item.rebuildHierarchy()
+    top = Item.objects.create(name='top')
+    child = Item.objects.create(name='child', owner=top)
+    Item.objects.create(name='grandchild', owner=child)
+    top2 = Item.objects.create(name='top2')
+    checkHierarchy()
+    # Move a subtree
+    child.owner = top2
+    child.save()
+    checkHierarchy()
+    # Add more children than the free numbers reserved in the owner
+    for i in range(Item.hierarchyGap):
+      Item.objects.create(name='leaf %s' % i, owner=top)
+    checkHierarchy()
+    # Edits keep the position
+    child.description = 'changed'
+    child.save()
+    checkHierarchy()
+    # Nodes added and moved with a bulk operation
+    Item.objects.bulk_create([
+      Item(name='bulk child', owner=top2), Item(name='bulk grandchild', owner_id='bulk child')
+      ])
+    Item.objects.filter(name='child').update(owner=top)
+    Item.placeNodes(['bulk grandchild', 'bulk child', 'child'])
+    checkHierarchy()
+    self.assertEqual(Item.objects.get(name='grandchild').lvl, 2)
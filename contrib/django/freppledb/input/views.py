@@ -15,11 +15,15 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from collections import defaultdict, OrderedDict
+from copy import copy
 import json
+from threading import Lock
+from time import time
 
 from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
-from django.db.models import Q
+from django.db import connections, DEFAULT_DB_ALIAS
 from django.http import HttpResponse, Http404
 from django.db.models.fields import CharField
 from django.utils.translation import ugettext_lazy as _
@@ -39,28 +43,93 @@ from freppledb.common.report import GridFieldChoice, GridFieldDuration
 from freppledb.admin import data_site
 
 
+# Maximum number of matches returned per model by the search box
+SEARCH_RESULTS = 10
+
+# Matches beyond this limit aren't counted exactly by the search box
+SEARCH_COUNT_LIMIT = 1000
+
+# Shorter terms only match the start of a name
+SEARCH_MIN_LENGTH = 3
+
+
 @staff_member_required
 def search(request):
-  term = request.GET.get('term')
+  '''
+  Search all models with a text primary key for a term.
+
+  All models are searched in a single query. For each model, the best
+  matches are selected in order of relevance: the exact match through the
+  primary key index, then the names starting with the term, and finally the
+  names containing the term. Each of these subqueries stops after a few
+  records. The number of matches is counted separately, up to a limit.
+  The primary key columns have a trigram index (see the migration
+  input.0005_search_index), which allows PostgreSQL to resolve the "ilike"
+  filters from the index. Trigrams don't help for terms shorter than 3
+  characters, and these only match the start of the names.
+  '''
+  term = request.GET.get('term', '')
   result = []
 
   # Loop over all models in the data_site
   # We are interested in models satisfying these criteria:
   #  - primary key is of type text
   #  - user has change permissions
+  models = {}
+  sql = []
+  args = []
+  pattern = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+  short = len(term) < SEARCH_MIN_LENGTH
   for cls, admn in data_site._registry.items():
     if request.user.has_perm("%s.view_%s" % (cls._meta.app_label, cls._meta.object_name.lower())) and isinstance(cls._meta.pk, CharField):
-      query = cls.objects.using(request.database).filter(pk__icontains=term).order_by('pk').values_list('pk')
-      count = len(query)
-      if count > 0:
-        result.append( {'value': None, 'label': (ungettext(
+      key = "%s.%s" % (cls._meta.app_label, cls._meta.object_name.lower())
+      models[key] = cls
+      pk = connections[request.database].ops.quote_name(cls._meta.pk.column)
+      table = connections[request.database].ops.quote_name(cls._meta.db_table)
+      subqueries = [
+        "(select %s as pk, 0 as rank from %s where %s = %%s)" % (pk, table, pk),
+        "(select %s, 1 from %s where %s ilike %%s and %s <> %%s order by %s limit %d)" % (
+          pk, table, pk, pk, pk, SEARCH_RESULTS
+          )
+        ]
+      args.extend([key, '%s%%' % pattern if short else '%%%s%%' % pattern, term, '%s%%' % pattern, term])
+      if not short:
+        subqueries.append(
+          "(select %s, 2 from %s where %s ilike %%s and %s not ilike %%s order by %s limit %d)" % (
+            pk, table, pk, pk, pk, SEARCH_RESULTS
+            ))
+        args.extend(['%%%s%%' % pattern, '%s%%' % pattern])
+      sql.append('''
+        (select %%s, pk, (
+          select count(*) from (select 1 from %s where %s ilike %%s limit %d) counter
+          )
+        from (%s) matches
+        order by rank, pk
+        limit %d)
+        ''' % (table, pk, SEARCH_COUNT_LIMIT + 1, ' union all '.join(subqueries), SEARCH_RESULTS))
+
+  if sql and term:
+    cursor = connections[request.database].cursor()
+    cursor.execute(' union all '.join(sql), args)
+    matches = defaultdict(list)
+    counts = {}
+    for key, pk, count in cursor.fetchall():
+      matches[key].append(pk)
+      counts[key] = count
+    for key in sorted(matches.keys(), key=lambda k: force_text(models[k]._meta.verbose_name)):
+      cls = models[key]
+      count = counts[key]
+      if count > SEARCH_COUNT_LIMIT:
+        label = _('%(name)s - more than %(count)d matches') % {'name': force_text(cls._meta.verbose_name), 'count': SEARCH_COUNT_LIMIT}
+      else:
+        label = ungettext(
            '%(name)s - %(count)d match',
-           '%(name)s - %(count)d matches', count) % {'name': force_text(cls._meta.verbose_name), 'count': count}).capitalize()
-           })
-        result.extend([ {
-          'url': "/data/%s/%s/" % (cls._meta.app_label, cls._meta.object_name.lower()),
-          'value': i[0]
-          } for i in query[:10] ])
+           '%(name)s - %(count)d matches', count) % {'name': force_text(cls._meta.verbose_name), 'count': count}
+      result.append( {'value': None, 'label': force_text(label).capitalize()} )
+      result.extend([ {
+        'url': "/data/%s/%s/" % (cls._meta.app_label, cls._meta.object_name.lower()),
+        'value': i
+        } for i in matches[key] ])
 
   # Construct reply
   return HttpResponse(
@@ -69,6 +138,173 @@ def search(request):
      )
 
 
+class SupplyChainGraph:
+  '''
+  An in-memory copy of the supply chain model of a scenario.
+
+  The supply path reports walk the model one entity at a time. Running a
+  database query at each step makes them very slow on models with deep
+  bills of material. Instead, we load all entities required for the walk
+  with a handful of queries and link them in memory.
+
+  The graph is kept per process and database, and is reloaded when the
+  record count or last modification timestamp of any of its tables changes.
+  The version is checked at most once every 'checkInterval' seconds, and
+  only the graphs of the 'maxGraphs' most recently used scenarios are kept.
+  '''
+  _graphs = OrderedDict()
+  _lock = Lock()
+
+  # Minimum number of seconds between 2 checks of the version of a graph
+  checkInterval = 10
+
+  # Maximum number of graphs kept in memory
+  maxGraphs = 3
+
+  tables = [
+    Item, Location, Supplier, Operation, SubOperation, Buffer,
+    Flow, Resource, Load, ItemSupplier, ItemDistribution
+    ]
+
+
+  @classmethod
+  def getVersion(cls, database):
+    cursor = connections[database].cursor()
+    cursor.execute(' union all '.join([
+      "select '%s', count(*), max(lastmodified) from %s" % (t._meta.db_table, t._meta.db_table)
+      for t in cls.tables
+      ]))
+    return tuple(sorted(cursor.fetchall()))
+
+
+  @classmethod
+  def get(cls, database=DEFAULT_DB_ALIAS):
+    now = time()
+    with cls._lock:
+      graph = cls._graphs.pop(database, None)
+      if graph:
+        # Mark as most recently used
+        cls._graphs[database] = graph
+    if graph and now - graph.checked < cls.checkInterval:
+      return graph
+    version = cls.getVersion(database)
+    if not graph or graph.version != version:
+      graph = cls(database, version)
+    graph.checked = now
+    with cls._lock:
+      cls._graphs.pop(database, None)
+      cls._graphs[database] = graph
+      while len(cls._graphs) > cls.maxGraphs:
+        cls._graphs.popitem(last=False)
+    return graph
+
+
+  def __init__(self, database, version):
+    self.version = version
+    self.checked = 0
+    self.items = { i.name: i for i in Item.objects.using(database).only('name', 'owner', 'operation') }
+    self.locations = { i.name: i for i in Location.objects.using(database).only('name', 'owner') }
+    self.suppliers = { i.name: i for i in Supplier.objects.using(database).only('name') }
+    self.resources = set(Resource.objects.using(database).values_list('name', flat=True))
+    self.multipleLocations = len(self.locations) > 1
+
+    self.operations = {}
+    for i in Operation.objects.using(database).all():
+      i.location = self.locations.get(i.location_id, None)
+      self.operations[i.name] = i
+
+    self.buffers = {}
+    self.buffersByItem = defaultdict(list)
+    self.buffersByItemLocation = defaultdict(list)
+    for i in Buffer.objects.using(database).only('name', 'item', 'location', 'producing'):
+      i.item = self.items[i.item_id]
+      i.location = self.locations.get(i.location_id, None)
+      i.producing = self.operations.get(i.producing_id, None)
+      self.buffers[i.name] = i
+      self.buffersByItem[i.item_id].append(i)
+      self.buffersByItemLocation[(i.item_id, i.location_id)].append(i)
+
+    self.flows = defaultdict(list)
+    self.consumers = defaultdict(list)
+    for i in Flow.objects.using(database).only('operation', 'thebuffer', 'quantity'):
+      i.operation = self.operations[i.operation_id]
+      i.thebuffer = self.buffers[i.thebuffer_id]
+      self.flows[i.operation_id].append(i)
+      if i.quantity < 0:
+        self.consumers[i.thebuffer_id].append(i)
+
+    self.loads = defaultdict(list)
+    self.loadsByResource = defaultdict(list)
+    for i in Load.objects.using(database).only('operation', 'resource', 'quantity'):
+      i.operation = self.operations[i.operation_id]
+      self.loads[i.operation_id].append(i)
+      self.loadsByResource[i.resource_id].append(i)
+
+    self.suboperations = defaultdict(list)
+    self.superoperations = defaultdict(list)
+    for i in SubOperation.objects.using(database).only('operation', 'suboperation', 'priority').order_by("-priority"):
+      i.operation = self.operations[i.operation_id]
+      i.suboperation = self.operations[i.suboperation_id]
+      self.suboperations[i.operation_id].append(i)
+      self.superoperations[i.suboperation_id].append(i)
+
+    self.itemsuppliers = defaultdict(list)
+    for i in ItemSupplier.objects.using(database).all():
+      i.item = self.items[i.item_id]
+      i.location = self.locations.get(i.location_id, None)
+      i.supplier = self.suppliers[i.supplier_id]
+      self.itemsuppliers[i.item_id].append(i)
+
+    self.itemdistributions = defaultdict(list)
+    for i in ItemDistribution.objects.using(database).all():
+      i.item = self.items[i.item_id]
+      i.location = self.locations.get(i.location_id, None)
+      i.origin = self.locations.get(i.origin_id, None)
+      self.itemdistributions[i.item_id].append(i)
+
+
+  @staticmethod
+  def ancestors(entities, obj):
+    '''
+    Returns the names of an entity and all its parents in the hierarchy.
+    '''
+    result = set()
+    while obj and obj.name not in result:
+      result.add(obj.name)
+      obj = entities.get(obj.owner_id, None)
+    return result
+
+
+  def findItemSuppliers(self, item, location):
+    '''
+    Returns the item suppliers defined for the item (or one of its parents)
+    at the location (or one of its parents).
+    When the model has a single location the location is ignored.
+    '''
+    locations = self.ancestors(self.locations, location)
+    return [
+      i
+      for it in self.ancestors(self.items, item)
+      for i in self.itemsuppliers.get(it, [])
+      if not self.multipleLocations or not i.location_id or i.location_id in locations
+      ]
+
+
+  def findItemDistributions(self, item, location, field):
+    '''
+    Returns the item distributions defined for the item (or one of its
+    parents) with the destination or origin at the location (or one of its
+    parents).
+    '''
+    locations = self.ancestors(self.locations, location)
+    return [
+      i
+      for it in self.ancestors(self.items, item)
+      for i in self.itemdistributions.get(it, [])
+      if getattr(i, '%s_id' % field) in locations
+      ]
+
+
 class PathReport(GridReport):
   '''
   A report showing the upstream supply path or following downstream a
@@ -133,46 +369,39 @@ class PathReport(GridReport):
 
 
   @classmethod
-  def getRoot(reportclass, request, entity):
+  def getRoot(reportclass, request, entity, graph):
     raise Http404("invalid entity type")
 
 
   @classmethod
-  def findDeliveries(reportclass, item, location, db):
+  def findDeliveries(reportclass, item, location, graph):
     # Automatically detect delivery operations. This is done by looking for
     # a buffer for this item and location combination.
     buf = None
     # Find a buffer record
-    for b in Buffer.objects.using(db).filter(item=item, location=location):
+    for b in graph.buffersByItemLocation.get((item.name, location.name if location else None), []):
       buf = b
     if not buf:
       # Create a buffer record
-      buf = Buffer(
-        name='%s @ %s' % (item, location), 
-        item=Item.objects.using(db).get(name=item), 
-        location=Location.objects.using(db).get(name=location)
-        )
-    return reportclass.findReplenishment(buf, db, 0, 1, 0, False)
+      buf = Buffer(name='%s @ %s' % (item, location), item=item, location=location)
+    return reportclass.findReplenishment(buf, graph, 0, 1, 0, False)
 
 
   @classmethod
-  def findUsage(reportclass, buffer, db, level, curqty, realdepth, pushsuper):
+  def findUsage(reportclass, buffer, graph, level, curqty, realdepth, pushsuper):
     result = [
       (level + 1, None, i.operation, curqty, 0, None, realdepth, pushsuper, buffer.location.name if buffer.location else None)
-      for i in buffer.flows.filter(quantity__lt=0).only('operation').using(db)
+      for i in graph.consumers.get(buffer.name, [])
       ]
     result.extend([
       (level + 1, None, i, curqty, 0, None, realdepth, pushsuper, i.location.name if i.location else None)
-      for i in ItemDistribution.objects.using(db).filter(
-        item__lft__lte=buffer.item.lft, item__rght__gt=buffer.item.lft,
-        origin__lft__lte=buffer.location.lft, origin__rght__gt=buffer.location.lft
-        )
+      for i in graph.findItemDistributions(buffer.item, buffer.location, 'origin')
       ])
     return result
 
 
   @classmethod
-  def findReplenishment(reportclass, buffer, db, level, curqty, realdepth, pushsuper):
+  def findReplenishment(reportclass, buffer, graph, level, curqty, realdepth, pushsuper):
     # If a producing operation is set on the buffer, we use that and skip the
     # automated search described below.
     # If no producing operation is set, we look for item distribution and
@@ -182,36 +411,21 @@ class PathReport(GridReport):
     if buffer.producing:
       return [ (level, None, buffer.producing, curqty, 0, None, realdepth, pushsuper, buffer.producing.location.name if buffer.producing.location else None) ]
     result = []
-    if Location.objects.using(db).count() > 1:
-      # Multiple locations
-      for i in ItemSupplier.objects.using(db).filter(
-        Q(location__isnull=True) | (Q(location__lft__lte=buffer.location.lft) & Q(location__rght__gt=buffer.location.lft)),
-        item__lft__lte=buffer.item.lft, item__rght__gt=buffer.item.lft
-        ):
-          i.item = buffer.item
-          i.location = buffer.location
-          result.append(
-            (level, None, i, curqty, 0, None, realdepth, pushsuper, buffer.location.name if buffer.location else None)
-            )
+    for i in graph.findItemSuppliers(buffer.item, buffer.location):
+      i = copy(i)
+      i.item = buffer.item
+      i.location = buffer.location
+      result.append(
+        (level, None, i, curqty, 0, None, realdepth, pushsuper, buffer.location.name if buffer.location else None)
+        )
+    if graph.multipleLocations:
       # TODO if the itemdistribution is at an aggregate location level, we should loop over all child locations
-      for i in ItemDistribution.objects.using(db).filter(
-        item__lft__lte=buffer.item.lft, item__rght__gt=buffer.item.lft,
-        location__lft__lte=buffer.location.lft, location__rght__gt=buffer.location.lft
-        ):
-          i.item = buffer.item
-          i.location = buffer.location
-          result.append(
-            (level, None, i, curqty, 0, None, realdepth, pushsuper, i.location.name if i.location else None)
-            )
-    else:
-      # Single location, and itemdistributions obviously aren't defined here
-      for i in ItemSupplier.objects.using(db).filter(
-        item__lft__lte=buffer.item.lft, item__rght__gt=buffer.item.lft
-        ):
+      for i in graph.findItemDistributions(buffer.item, buffer.location, 'location'):
+        i = copy(i)
         i.item = buffer.item
-        i.location = buffer.location        
+        i.location = buffer.location
         result.append(
-          (level, None, i, curqty, 0, None, realdepth, pushsuper, buffer.location.name if buffer.location else None)
+          (level, None, i, curqty, 0, None, realdepth, pushsuper, i.location.name if i.location else None)
           )
     return result
 
@@ -221,13 +435,12 @@ class PathReport(GridReport):
     '''
     A function that recurses upstream or downstream in the supply chain.
     '''
-    # Update item and location hierarchies
-    Item.rebuildHierarchy(database=request.database)
-    Location.rebuildHierarchy(database=request.database)
+    # Get the supply chain model of this scenario
+    graph = SupplyChainGraph.get(request.database)
 
     entity = basequery.query.get_compiler(basequery.db).as_sql(with_col_aliases=False)[1]
     entity = entity[0]
-    root = reportclass.getRoot(request, entity)
+    root = reportclass.getRoot(request, entity, graph)
 
     # Recurse over all operations
     # TODO the current logic isn't generic enough. A lot of buffers may not be explicitly
@@ -246,7 +459,7 @@ class PathReport(GridReport):
       # and use only the parent
       if pushsuper and not isinstance(curoperation, (ItemSupplier, ItemDistribution)):
         hasParents = False
-        for x in curoperation.superoperations.using(request.database).only('operation').order_by("-priority"):
+        for x in graph.superoperations.get(curoperation.name, []):
           root.append( (level, parent, x.operation, curqty, issuboperation, parentoper, realdepth, False, location) )
           hasParents = True
         if hasParents:
@@ -272,12 +485,10 @@ class PathReport(GridReport):
           duration_per = None
           buffers = [ ("%s @ %s" % (curoperation.item.name, curoperation.location.name), 1), ]
           resources = None
-          try:
-            downstr = Buffer.objects.using(request.database).get(name="%s @ %s" % (curoperation.item.name, curoperation.location.name))
-            root.extend( reportclass.findUsage(downstr, request.database, level, curqty, realdepth + 1, False, location) )
-          except Buffer.DoesNotExist:
+          downstr = graph.buffers.get("%s @ %s" % (curoperation.item.name, curoperation.location.name), None)
+          if not downstr:
             downstr = Buffer(name="%s @ %s" % (curoperation.item.name, curoperation.location.name), item=curoperation.item, location=curoperation.location)
-            root.extend( reportclass.findUsage(downstr, request.database, level, curqty, realdepth + 1, False, location) )
+          root.extend( reportclass.findUsage(downstr, graph, level, curqty, realdepth + 1, False) )
         elif isinstance(curoperation, ItemDistribution):
           name = 'Ship %s from %s to %s' % (curoperation.item.name, curoperation.origin.name, curoperation.location.name)
           optype = "distribution"
@@ -293,14 +504,15 @@ class PathReport(GridReport):
           optype = curoperation.type
           duration = curoperation.duration
           duration_per = curoperation.duration_per
-          buffers = [ (x.thebuffer.name, float(x.quantity)) for x in curoperation.flows.only('thebuffer', 'quantity').using(request.database) ]
-          resources = [ (x.resource.name, float(x.quantity)) for x in curoperation.loads.only('resource', 'quantity').using(request.database) ]
-          for x in curoperation.flows.filter(quantity__gt=0).only('thebuffer').using(request.database):
-            curflows = x.thebuffer.flows.filter(quantity__lt=0).only('operation', 'quantity').using(request.database)
-            for y in curflows:
+          buffers = [ (x.thebuffer.name, float(x.quantity)) for x in graph.flows.get(curoperation.name, []) ]
+          resources = [ (x.resource_id, float(x.quantity)) for x in graph.loads.get(curoperation.name, []) ]
+          for x in graph.flows.get(curoperation.name, []):
+            if x.quantity <= 0:
+              continue
+            for y in graph.consumers.get(x.thebuffer.name, []):
               hasChildren = True
               root.append( (level - 1, curnode, y.operation, - curqty * y.quantity, subcount, None, realdepth - 1, pushsuper, x.thebuffer.location.name if x.thebuffer.location else None) )
-          for x in curoperation.suboperations.using(request.database).only('suboperation').order_by("-priority"):
+          for x in graph.suboperations.get(curoperation.name, []):
             subcount += curoperation.type == "routing" and 1 or -1
             root.append( (level - 1, curnode, x.suboperation, curqty, subcount, curoperation, realdepth, False, location) )
             hasChildren = True
@@ -323,24 +535,24 @@ class PathReport(GridReport):
             ("%s @ %s" % (curoperation.item.name, curoperation.location.name), 1)
             ]
           resources = None
-          try:
-            upstr = Buffer.objects.using(request.database).get(name="%s @ %s" % (curoperation.item.name, curoperation.origin.name))
-            root.extend( reportclass.findReplenishment(upstr, request.database, level + 2, curqty, realdepth + 1, False) )
-          except Buffer.DoesNotExist:
+          upstr = graph.buffers.get("%s @ %s" % (curoperation.item.name, curoperation.origin.name), None)
+          if not upstr:
             upstr = Buffer(name="%s @ %s" % (curoperation.item.name, curoperation.origin.name), item=curoperation.item, location=curoperation.origin)
-            root.extend( reportclass.findReplenishment(upstr, request.database, level + 2, curqty, realdepth + 1, False) )
+          root.extend( reportclass.findReplenishment(upstr, graph, level + 2, curqty, realdepth + 1, False) )
         else:
           curprodflow = None
           name = curoperation.name
           optype = curoperation.type
           duration = curoperation.duration
           duration_per = curoperation.duration_per
-          buffers = [ (x.thebuffer.name, float(x.quantity)) for x in curoperation.flows.only('thebuffer', 'quantity').using(request.database) ]
-          resources = [ (x.resource.name, float(x.quantity)) for x in curoperation.loads.only('resource', 'quantity').using(request.database) ]
-          for x in curoperation.flows.filter(quantity__gt=0).only('quantity').using(request.database):
-            curprodflow = x
-          curflows = curoperation.flows.filter(quantity__lt=0).only('thebuffer', 'quantity').using(request.database)
-          for y in curflows:
+          buffers = [ (x.thebuffer.name, float(x.quantity)) for x in graph.flows.get(curoperation.name, []) ]
+          resources = [ (x.resource_id, float(x.quantity)) for x in graph.loads.get(curoperation.name, []) ]
+          for x in graph.flows.get(curoperation.name, []):
+            if x.quantity > 0:
+              curprodflow = x
+          for y in graph.flows.get(curoperation.name, []):
+            if y.quantity >= 0:
+              continue
             if y.thebuffer.producing:
               hasChildren = True
               root.append( (
@@ -349,8 +561,8 @@ class PathReport(GridReport):
                 subcount, None, realdepth + 1, True, y.thebuffer.location
                 ) )
             else:
-              root.extend( reportclass.findReplenishment(y.thebuffer, request.database, level + 2, curqty, realdepth + 1, False) )
-          for x in curoperation.suboperations.using(request.database).only('suboperation').order_by("-priority"):
+              root.extend( reportclass.findReplenishment(y.thebuffer, graph, level + 2, curqty, realdepth + 1, False) )
+          for x in graph.suboperations.get(curoperation.name, []):
             subcount += curoperation.type == "routing" and 1 or -1
             root.append( (level + 1, curnode, x.suboperation, curqty, subcount, curoperation, realdepth, False, location) )
             hasChildren = True
@@ -382,7 +594,7 @@ class UpstreamDemandPath(PathReport):
   objecttype = Demand
 
   @classmethod
-  def getRoot(reportclass, request, entity):
+  def getRoot(reportclass, request, entity, graph):
     from django.core.exceptions import ObjectDoesNotExist
 
     try:
@@ -390,16 +602,16 @@ class UpstreamDemandPath(PathReport):
     except ObjectDoesNotExist:
       raise Http404("demand %s doesn't exist" % entity)
 
-    if dmd.operation:
+    if dmd.operation_id:
       # Delivery operation on the demand
-      return [ (0, None, dmd.operation, 1, 0, None, 0, False, None) ]
-    elif dmd.item.operation:
+      return [ (0, None, graph.operations[dmd.operation_id], 1, 0, None, 0, False, None) ]
+    elif graph.items[dmd.item_id].operation_id:
       # Delivery operation on the item
-      return [ (0, None, dmd.item.operation, 1, 0, None, 0, False, None) ]
+      return [ (0, None, graph.operations[graph.items[dmd.item_id].operation_id], 1, 0, None, 0, False, None) ]
     else:
       # Autogenerated delivery operation
       try:
-        return reportclass.findDeliveries(dmd.item, dmd.location, request.database)
+        return reportclass.findDeliveries(graph.items[dmd.item_id], graph.locations.get(dmd.location_id, None), graph)
       except:
         raise Http404("No supply path defined for demand %s" % entity)
 
@@ -409,28 +621,26 @@ class UpstreamItemPath(PathReport):
   objecttype = Item
 
   @classmethod
-  def getRoot(reportclass, request, entity):
-    from django.core.exceptions import ObjectDoesNotExist
-    try:
-      it = Item.objects.using(request.database).get(name=entity)
-      if reportclass.downstream:
-        # Find all buffers where the item is being stored and walk downstream
+  def getRoot(reportclass, request, entity, graph):
+    it = graph.items.get(entity, None)
+    if not it:
+      raise Http404("item %s doesn't exist" % entity)
+    if reportclass.downstream:
+      # Find all buffers where the item is being stored and walk downstream
+      result = []
+      for b in graph.buffersByItem.get(entity, []):
+        result.extend( reportclass.findUsage(b, graph, 0, 1, 0, False) )
+      return result
+    else:
+      if it.operation_id:
+        # Delivery operation on the item
+        return [ (0, None, graph.operations[it.operation_id], 1, 0, None, 0, False, None) ]
+      else:
+        # Find the supply path of all buffers of this item
         result = []
-        for b in Buffer.objects.filter(item=it).using(request.database):
-          result.extend( reportclass.findUsage(b, request.database, 0, 1, 0, False) )
+        for b in graph.buffersByItem.get(entity, []):
+          result.extend( reportclass.findReplenishment(b, graph, 0, 1, 0, False) )
         return result
-      else:
-        if it.operation:
-          # Delivery operation on the item
-          return [ (0, None, it.operation, 1, 0, None, 0, False, None) ]
-        else:
-          # Find the supply path of all buffers of this item
-          result = []
-          for b in Buffer.objects.filter(item=entity).using(request.database):
-            result.extend( reportclass.findReplenishment(b, request.database, 0, 1, 0, False) )
-          return result
-    except ObjectDoesNotExist:
-      raise Http404("item %s doesn't exist" % entity)
 
 
 class UpstreamBufferPath(PathReport):
@@ -438,16 +648,14 @@ class UpstreamBufferPath(PathReport):
   objecttype = Buffer
 
   @classmethod
-  def getRoot(reportclass, request, entity):
-    from django.core.exceptions import ObjectDoesNotExist
-    try:
-      buf = Buffer.objects.using(request.database).get(name=entity)
-      if reportclass.downstream:
-        return reportclass.findUsage(buf, request.database, 0, 1, 0, False)
-      else:
-        return reportclass.findReplenishment(buf, request.database, 0, 1, 0, False)
-    except ObjectDoesNotExist:
+  def getRoot(reportclass, request, entity, graph):
+    buf = graph.buffers.get(entity, None)
+    if not buf:
       raise Http404("buffer %s doesn't exist" % entity)
+    if reportclass.downstream:
+      return reportclass.findUsage(buf, graph, 0, 1, 0, False)
+    else:
+      return reportclass.findReplenishment(buf, graph, 0, 1, 0, False)
 
 
 class UpstreamResourcePath(PathReport):
@@ -455,15 +663,12 @@ class UpstreamResourcePath(PathReport):
   objecttype = Resource
 
   @classmethod
-  def getRoot(reportclass, request, entity):
-    from django.core.exceptions import ObjectDoesNotExist
-    try:
-      root = Resource.objects.using(request.database).get(name=entity)
-    except ObjectDoesNotExist:
+  def getRoot(reportclass, request, entity, graph):
+    if entity not in graph.resources:
       raise Http404("resource %s doesn't exist" % entity)
     return [
       (0, None, i.operation, 1, 0, None, 0, True, i.operation.location.name if i.operation.location else None)
-      for i in root.loads.using(request.database).all()
+      for i in graph.loadsByResource.get(entity, [])
       ]
 
 
@@ -472,13 +677,11 @@ class UpstreamOperationPath(PathReport):
   objecttype = Operation
 
   @classmethod
-  def getRoot(reportclass, request, entity):
-    from django.core.exceptions import ObjectDoesNotExist
-    try:
-      oper = Operation.objects.using(request.database).get(name=entity)
-      return [ (0, None, oper, 1, 0, None, 0, True, oper.location.name if oper.location else None) ]
-    except ObjectDoesNotExist:
+  def getRoot(reportclass, request, entity, graph):
+    oper = graph.operations.get(entity, None)
+    if not oper:
       raise Http404("operation %s doesn't exist" % entity)
+    return [ (0, None, oper, 1, 0, None, 0, True, oper.location.name if oper.location else None) ]
 
 
 class DownstreamItemPath(UpstreamItemPath):
@@ -18,6 +18,8 @@ import base64
 import email
 import os
 from datetime import datetime
+from queue import Queue, Empty
+from threading import Thread
 try:
   from urllib2 import urlopen, HTTPError, Request
 except:
@@ -35,6 +37,58 @@ from freppledb.execute.commands import printWelcome, logProgress, createPlan, ex
 import frepple
 
 
+class StreamPrefetcher(Thread):
+  '''
+  Reads a file-like object in a separate thread, so the download overlaps
+  with the processing of the data. At most 'blocks' blocks of data are kept
+  in memory.
+  '''
+  def __init__(self, stream, blocksize=1 << 16, blocks=16):
+    super(StreamPrefetcher, self).__init__()
+    self.daemon = True
+    self.stream = stream
+    self.blocksize = blocksize
+    self.queue = Queue(blocks)
+    self.buffer = b''
+    self.eof = False
+    self.stopped = False
+
+  def run(self):
+    try:
+      while not self.stopped:
+        data = self.stream.read(self.blocksize)
+        self.queue.put(data)
+        if not data:
+          break
+    except Exception as e:
+      self.queue.put(e)
+
+  def close(self):
+    '''
+    Stops the download when the data isn't read till the end.
+    '''
+    self.stopped = True
+    try:
+      while True:
+        self.queue.get_nowait()
+    except Empty:
+      pass
+
+  def read(self, size=-1):
+    if not self.buffer and not self.eof:
+      data = self.queue.get()
+      if isinstance(data, Exception):
+        raise data
+      if not data:
+        self.eof = True
+      self.buffer = data
+    if size < 0:
+      size = len(self.buffer)
+    data = self.buffer[:size]
+    self.buffer = self.buffer[size:]
+    return data
+
+
 def odoo_read(db=DEFAULT_DB_ALIAS):
   '''
   This function connects to a URL, authenticates itself using HTTP basic
@@ -69,6 +123,7 @@ def odoo_read(db=DEFAULT_DB_ALIAS):
     print("Missing or invalid parameter odoo.company")
     ok = False
   odoo_language = Parameter.getValue("odoo.language", db, 'en_US')
+  odoo_prefetch = Parameter.getValue("odoo.prefetch", db, '0')
   if not ok:
     raise Exception("Odoo connector not configured correctly")
 
@@ -76,7 +131,8 @@ def odoo_read(db=DEFAULT_DB_ALIAS):
   f = None
   try:
     request = Request("%sfrepple/xml/?%s" % (odoo_url, urlencode({
-      'database': odoo_db, 'language': odoo_language, 'company': odoo_company
+      'database': odoo_db, 'language': odoo_language, 'company': odoo_company,
+      'prefetch': odoo_prefetch
       })))
     encoded = base64.encodestring(('%s:%s' % (odoo_user, odoo_password)).encode('utf-8'))[:-1]
     request.add_header("Authorization", "Basic %s" % encoded.decode('ascii'))
@@ -85,10 +141,14 @@ def odoo_read(db=DEFAULT_DB_ALIAS):
     print("Error connecting to odoo", e)
     raise e
 
-  # Download and parse XML data
+  # Download and parse XML data.
+  # The data is processed block by block while it is downloaded.
+  stream = StreamPrefetcher(f)
   try:
-    frepple.readXMLdata(f.read().decode('utf-8'), False, False)
+    stream.start()
+    frepple.readXMLstream(stream, False, False)
   finally:
+    stream.close()
     if f: f.close()
 
 
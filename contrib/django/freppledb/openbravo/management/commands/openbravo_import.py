@@ -16,10 +16,9 @@
 from optparse import make_option
 from datetime import datetime, timedelta, date
 from time import time
-from xml.etree.cElementTree import iterparse
-from xml.etree.ElementTree import ParseError
+import os
+import shutil
 import urllib
-from io import StringIO
 
 from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction, connections, DEFAULT_DB_ALIAS
@@ -27,7 +26,7 @@ from django.conf import settings
 
 from freppledb.common.models import Parameter
 from freppledb.execute.models import Task
-from freppledb.openbravo.utils import get_data as get_data_base
+from freppledb.openbravo.utils import DataFetcher
 
 
 class Command(BaseCommand):
@@ -51,6 +50,10 @@ class Command(BaseCommand):
       '--task', dest='task', type='int',
       help='Task identifier (generated automatically if not provided)'
       ),
+    make_option(
+      '--resume', action='store_true', dest='resume', default=False,
+      help='Continue a failed import, reusing the data it already retrieved'
+      ),
     )
 
   requires_system_checks = False
@@ -88,6 +91,7 @@ class Command(BaseCommand):
     self.openbravo_host = Parameter.getValue("openbravo.host", self.database)
     self.openbravo_pagesize = int(Parameter.getValue("openbravo.pagesize", self.database, default='1000'))
     self.openbravo_dateformat = Parameter.getValue("openbravo.date_format", self.database, default='%Y-%m-%d')
+    self.openbravo_concurrency = int(Parameter.getValue("openbravo.concurrency", self.database, default='4'))
     if not self.openbravo_user:
       raise CommandError("Missing or invalid  openbravo_user")
     if not self.openbravo_password:
@@ -104,6 +108,7 @@ class Command(BaseCommand):
 
     now = datetime.now()
     task = None
+    self.fetcher = None
     try:
       # Initialize the task
       if 'task' in options and options['task']:
@@ -138,6 +143,17 @@ class Command(BaseCommand):
       self.date = datetime.now()
       self.delta = (date.today() - timedelta(days=self.delta)).strftime(self.openbravo_dateformat)
 
+      # All data retrieved from openbravo is saved in a checkpoint directory,
+      # until the import is complete.
+      checkpoint = os.path.join(settings.FREPPLE_LOGDIR, 'openbravo_%s' % self.database)
+      if not options.get('resume', False) and os.path.isdir(checkpoint):
+        shutil.rmtree(checkpoint)
+      self.fetcher = DataFetcher(
+        self.openbravo_host, self.openbravo_user, self.openbravo_password,
+        pagesize=self.openbravo_pagesize, concurrency=self.openbravo_concurrency,
+        checkpoint=checkpoint, verbosity=self.verbosity
+        )
+
       # Pick up the current date
       try:
         cursor.execute("SELECT value FROM common_ where name='currentdate'")
@@ -162,6 +178,7 @@ class Command(BaseCommand):
       # Log success
       task.status = 'Done'
       task.finished = datetime.now()
+      shutil.rmtree(checkpoint, ignore_errors=True)
 
     except Exception as e:
       if task:
@@ -171,41 +188,14 @@ class Command(BaseCommand):
       raise e
 
     finally:
+      if self.fetcher:
+        self.fetcher.close()
       if task:
         task.save(using=self.database)
       settings.DEBUG = tmp_debug
 
   def get_data(self, url, callback):
-    firstResult = 0
-    # Retrieve openbravo data page per page
-    while True:
-      # Send the request
-      if '?' in url:
-        url2 = "%s&firstResult=%d&maxResult=%d" % (url, firstResult, self.openbravo_pagesize)
-      else:
-        url2 = "%s?firstResult=%d&maxResult=%d" % (url, firstResult, self.openbravo_pagesize)
-      if self.verbosity > 1:
-        print('Request: ', url2)
-
-      data = get_data_base(url2, self.openbravo_host, self.openbravo_user, self.openbravo_password).replace("&#0;","").replace("&#22;","").replace("\xcc","")
-      if self.verbosity == 1:
-        print('.', end="")
-      elif self.verbosity > 2:
-        print('Response content: ', data)
-      conn = iterparse(StringIO(data), events=('start', 'end'))
-      try:
-        count = callback(conn)
-      except ParseError:
-        print ("Error parsing Openbravo XML document")
-        count = self.openbravo_pagesize
-      if count < self.openbravo_pagesize:
-        # No more records to be expected
-        if self.verbosity == 1:
-          print('')
-        return firstResult + count
-      else:
-        # Prepare for the next loop
-        firstResult += self.openbravo_pagesize
+    return self.fetcher.get_data(url, callback)
 
 
   def importData(self, task, cursor):
@@ -0,0 +1,194 @@
+#
+# Copyright (C) 2016 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import shutil
+import tempfile
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from time import sleep
+from urllib.parse import urlparse, parse_qs
+
+from django.test import SimpleTestCase
+
+from freppledb.openbravo.utils import DataFetcher
+
+
+class MockDALHandler(BaseHTTPRequestHandler):
+  '''
+  Answers requests like the Openbravo DAL web service, with a list of
+  organizations.
+  '''
+  protocol_version = 'HTTP/1.1'
+
+  def setup(self):
+    super(MockDALHandler, self).setup()
+    with self.server.lock:
+      self.server.connections += 1
+
+  def do_GET(self):
+    args = parse_qs(urlparse(self.path).query)
+    first = int(args['firstResult'][0])
+    size = int(args['maxResult'][0])
+    with self.server.lock:
+      self.server.requests.append(first)
+      fail = first == self.server.failAt
+      self.server.inflight += 1
+      self.server.peak = max(self.server.peak, self.server.inflight)
+    try:
+      if fail:
+        self.send_error(500, 'Simulated failure')
+        return
+      sleep(self.server.latency)
+    finally:
+      with self.server.lock:
+        self.server.inflight -= 1
+    body = ['<?xml version="1.0" encoding="UTF-8"?>\n<ob:Openbravo xmlns:ob="http://www.openbravo.com">']
+    for i in range(first, min(first + size, self.server.records)):
+      body.append(
+        '<Organization id="%s"><searchKey>Org&#0;%s\xcc</searchKey></Organization>' % (i, i)
+        )
+    if first != self.server.corruptAt:
+      body.append('</ob:Openbravo>')
+    data = '\n'.join(body).encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/xml; charset=UTF-8')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, format, *args):
+    pass
+
+
+class MockDALServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+  def __init__(self, records, latency=0.0, failAt=None, corruptAt=None):
+    super(MockDALServer, self).__init__(('127.0.0.1', 0), MockDALHandler)
+    self.records = records
+    self.latency = latency
+    self.failAt = failAt
+    self.corruptAt = corruptAt
+    self.requests = []
+    self.connections = 0
+    self.inflight = 0
+    self.peak = 0
+    self.lock = threading.Lock()
+    self.thread = threading.Thread(target=self.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def handle_error(self, request, client_address):
+    # Connections for pages beyond the last one are closed by the client
+    pass
+
+  @property
+  def host(self):
+    return '127.0.0.1:%s' % self.server_address[1]
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+
+class DataFetcherTest(SimpleTestCase):
+
+  def setUp(self):
+    self.checkpoint = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.checkpoint, ignore_errors=True)
+
+  def fetch(self, server, concurrency=4, checkpoint=None):
+    organizations = []
+
+    def parse(conn):
+      records = 0
+      root = None
+      for event, elem in conn:
+        if not root:
+          root = elem
+          continue
+        if event != 'end' or elem.tag != 'Organization':
+          continue
+        records += 1
+        organizations.append((elem.get('id'), elem.find('searchKey').text))
+        root.clear()
+      return records
+
+    fetcher = DataFetcher(
+      server.host, 'Openbravo', 'openbravo', pagesize=100,
+      concurrency=concurrency, checkpoint=checkpoint
+      )
+    try:
+      count = fetcher.get_data('/openbravo/ws/dal/Organization?includeChildren=false', parse)
+    finally:
+      fetcher.close()
+    return count, organizations
+
+  def test_fetch(self):
+    server = MockDALServer(1050)
+    try:
+      count, organizations = self.fetch(server)
+    finally:
+      server.stop()
+    self.assertEqual(count, 1050)
+    self.assertEqual(organizations, [ (str(i), 'Org%s' % i) for i in range(1050) ])
+    # Connections are reused
+    self.assertLessEqual(server.connections, 4)
+
+  def test_resume(self):
+    server = MockDALServer(1050, failAt=500)
+    try:
+      with self.assertRaises(Exception):
+        self.fetch(server, checkpoint=self.checkpoint)
+      server.failAt = None
+      server.requests = []
+      count, organizations = self.fetch(server, checkpoint=self.checkpoint)
+    finally:
+      server.stop()
+    self.assertEqual(count, 1050)
+    self.assertEqual(len(organizations), 1050)
+    # Only the pages from the failed one onwards are requested again
+    self.assertEqual(min(server.requests), 500)
+
+  def test_corrupt_page(self):
+    server = MockDALServer(1050, corruptAt=500)
+    try:
+      count, organizations = self.fetch(server, checkpoint=self.checkpoint)
+    finally:
+      server.stop()
+    self.assertEqual(count, 1050)
+    # The page that couldn't be parsed isn't saved in the checkpoint
+    fetcher = DataFetcher(server.host, 'Openbravo', 'openbravo', pagesize=100, checkpoint=self.checkpoint)
+    url = '/openbravo/ws/dal/Organization?includeChildren=false'
+    self.assertTrue(os.path.exists(fetcher.getCheckpoint(url, 400)))
+    self.assertFalse(os.path.exists(fetcher.getCheckpoint(url, 500)))
+    self.assertFalse(os.path.exists(fetcher.getCheckpoint(url, 500) + '.tmp'))
+
+  def test_concurrency(self):
+    server = MockDALServer(2000, latency=0.1)
+    try:
+      count, organizations = self.fetch(server, concurrency=4)
+    finally:
+      server.stop()
+    self.assertEqual(count, 2000)
+    self.assertEqual(organizations, [ (str(i), 'Org%s' % i) for i in range(2000) ])
+    # Pages are requested in parallel
+    self.assertGreaterEqual(server.peak, 2)
@@ -16,7 +16,14 @@
 #
 
 import base64
+import codecs
+import hashlib
 import http.client
+import os
+import queue
+import threading
+from xml.etree.cElementTree import iterparse
+from xml.etree.ElementTree import ParseError
 
 
 def get_data(url, host, user, password):
@@ -89,3 +96,236 @@ def delete_data(url, host, user, password):
     raise Exception(response.reason)
   return response.read().decode("utf-8")
 
+
+
+class PageReader:
+  '''
+  File-like wrapper around a response of the Openbravo web service.
+
+  The data is decoded and cleaned from characters that aren't valid in XML
+  while it is read, so the XML parser can process the response incrementally.
+  When a checkpoint file is passed, the raw data is also copied to it.
+  '''
+
+  # Character references Openbravo sometimes puts in its data
+  junk = ("&#0;", "&#22;", "\xcc")
+
+  def __init__(self, source, checkpoint=None):
+    self.source = source
+    self.checkpoint = checkpoint
+    self.decoder = codecs.getincrementaldecoder("utf-8")()
+    self.pending = ''
+    self.eof = False
+
+  def read(self, size=16384):
+    while not self.eof:
+      data = self.source.read(size)
+      if self.checkpoint and data:
+        self.checkpoint.write(data)
+      self.eof = not data
+      text = self.pending + self.decoder.decode(data, final=self.eof)
+      for j in self.junk:
+        text = text.replace(j, '')
+      # Hold back an incomplete character reference at the end
+      self.pending = ''
+      if not self.eof:
+        pos = text.rfind('&', max(0, len(text) - 4))
+        if pos >= 0:
+          self.pending = text[pos:]
+          text = text[:pos]
+      if text:
+        return text
+    return ''
+
+
+class DataFetcher:
+  '''
+  Reads all pages of a query on the Openbravo web service.
+
+  A bounded pool of worker threads requests the next pages while the current
+  page is being parsed. Each worker keeps its HTTP connection open between
+  requests. The pages are always passed to the callback in sequence, and each
+  page is parsed incrementally while it is received.
+
+  When a checkpoint directory is given, every page is also saved in it. A
+  later run with the same checkpoint directory reads those pages from disk,
+  and only requests the pages that weren't read yet.
+  '''
+
+  def __init__(self, host, user, password, pagesize=1000, concurrency=4, checkpoint=None, verbosity=0):
+    self.host = host
+    self.authorization = "Basic %s" % base64.b64encode(
+      ('%s:%s' % (user, password)).encode("utf-8")
+      ).decode("utf-8")
+    self.pagesize = pagesize
+    self.concurrency = max(1, concurrency)
+    self.checkpoint = checkpoint
+    self.verbosity = verbosity
+    self.connections = queue.Queue()
+    if checkpoint and not os.path.isdir(checkpoint):
+      os.makedirs(checkpoint)
+
+
+  def close(self):
+    '''
+    Closes all open connections.
+    '''
+    while True:
+      try:
+        self.connections.get_nowait().close()
+      except queue.Empty:
+        return
+
+
+  def getCheckpoint(self, url, firstResult):
+    return os.path.join(
+      self.checkpoint,
+      "%s_%08d.xml" % (hashlib.sha1(url.encode("utf-8")).hexdigest(), firstResult)
+      )
+
+
+  def request(self, conn, url, firstResult):
+    '''
+    Sends the request for a page, and returns the response.
+    A connection closed by the server is opened again once.
+    '''
+    if '?' in url:
+      url2 = "%s&firstResult=%d&maxResult=%d" % (url, firstResult, self.pagesize)
+    else:
+      url2 = "%s?firstResult=%d&maxResult=%d" % (url, firstResult, self.pagesize)
+    if self.verbosity > 1:
+      print('Request: ', url2)
+    for attempt in (1, 2):
+      try:
+        conn.request("GET", url2, headers={
+          "User-Agent": "frePPLe-Openbravo connector",
+          "Content-type": "text/html; charset=\"UTF-8\"",
+          "Authorization": self.authorization
+          })
+        response = conn.getresponse()
+        break
+      except (http.client.HTTPException, OSError):
+        conn.close()
+        if attempt == 2:
+          raise
+    if response.status != http.client.OK:
+      response.read()
+      raise Exception(response.reason)
+    return response
+
+
+  def parse(self, reader, callback):
+    '''
+    Passes a page to the callback function, and returns the number of records
+    and whether the page was parsed without errors.
+    '''
+    conn = iterparse(reader, events=('start', 'end'))
+    try:
+      return callback(conn), True
+    except ParseError:
+      print("Error parsing Openbravo XML document")
+      return self.pagesize, False
+
+
+  def get_data(self, url, callback):
+    '''
+    Passes all pages of the url to the callback function, and returns the
+    total number of records.
+    '''
+    firstResult = 0
+    total = 0
+
+    # Read the pages saved during a previous run
+    while self.checkpoint and os.path.exists(self.getCheckpoint(url, firstResult)):
+      with open(self.getCheckpoint(url, firstResult), 'rb') as f:
+        count = self.parse(PageReader(f), callback)[0]
+      total += count
+      if count < self.pagesize:
+        return total
+      firstResult += self.pagesize
+
+    # Fetch the remaining pages
+    cond = threading.Condition()
+    state = {'next': firstResult, 'stop': False}
+    ready = {}
+
+    def worker():
+      try:
+        conn = self.connections.get_nowait()
+      except queue.Empty:
+        conn = http.client.HTTPConnection(self.host)
+      try:
+        while True:
+          with cond:
+            if state['stop']:
+              break
+            offset = state['next']
+            state['next'] += self.pagesize
+          try:
+            response = self.request(conn, url, offset)
+          except Exception as e:
+            with cond:
+              ready[offset] = e
+              cond.notify_all()
+            conn.close()
+            break
+          done = threading.Event()
+          with cond:
+            if state['stop']:
+              # Page beyond the last one
+              conn.close()
+              break
+            ready[offset] = (response, done)
+            cond.notify_all()
+          done.wait()
+          if not response.isclosed():
+            # Response wasn't read completely
+            conn.close()
+      finally:
+        self.connections.put(conn)
+
+    workers = [ threading.Thread(target=worker) for i in range(self.concurrency) ]
+    for w in workers:
+      w.daemon = True
+      w.start()
+    try:
+      while True:
+        with cond:
+          while firstResult not in ready:
+            cond.wait()
+          page = ready.pop(firstResult)
+        if isinstance(page, Exception):
+          raise page
+        response, done = page
+        try:
+          if self.checkpoint:
+            tmp = self.getCheckpoint(url, firstResult) + '.tmp'
+            with open(tmp, 'wb') as f:
+              count, ok = self.parse(PageReader(response, f), callback)
+            if ok:
+              os.replace(tmp, self.getCheckpoint(url, firstResult))
+            else:
+              # A page that can't be parsed is requested again in the next run
+              os.remove(tmp)
+          else:
+            count = self.parse(PageReader(response), callback)[0]
+        finally:
+          done.set()
+        if self.verbosity == 1:
+          print('.', end="")
+        total += count
+        if count < self.pagesize:
+          # No more records to be expected
+          if self.verbosity == 1:
+            print('')
+          return total
+        firstResult += self.pagesize
+    finally:
+      with cond:
+        state['stop'] = True
+        for page in ready.values():
+          if not isinstance(page, Exception):
+            page[1].set()
+        ready.clear()
+      for w in workers:
+        w.join()
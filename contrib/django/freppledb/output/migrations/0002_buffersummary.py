@@ -0,0 +1,51 @@
+#
+# Copyright (C) 2016 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+  dependencies = [
+    ('output', '0001_initial'),
+  ]
+
+  operations = [
+    migrations.CreateModel(
+      name='BufferSummary',
+      fields=[
+        ('id', models.AutoField(auto_created=True, verbose_name='ID', serialize=False, primary_key=True)),
+        ('thebuffer', models.CharField(verbose_name='buffer', max_length=300)),
+        ('bucket', models.CharField(verbose_name='bucket', max_length=300)),
+        ('startdate', models.DateTimeField(verbose_name='startdate')),
+        ('enddate', models.DateTimeField(verbose_name='enddate')),
+        ('produced', models.DecimalField(verbose_name='produced', max_digits=15, decimal_places=4)),
+        ('consumed', models.DecimalField(verbose_name='consumed', max_digits=15, decimal_places=4)),
+        ('startoh', models.DecimalField(verbose_name='start inventory', max_digits=15, decimal_places=4)),
+        ('endoh', models.DecimalField(verbose_name='end inventory', max_digits=15, decimal_places=4)),
+      ],
+      options={
+        'db_table': 'out_inventory',
+        'ordering': ['thebuffer', 'bucket', 'startdate'],
+        'verbose_name_plural': 'buffer summaries',
+        'verbose_name': 'buffer summary',
+      },
+    ),
+    migrations.AlterUniqueTogether(
+      name='buffersummary',
+      unique_together=set([('thebuffer', 'bucket', 'startdate')]),
+    ),
+  ]
@@ -16,9 +16,11 @@
 #
 
 from django.utils.translation import ugettext_lazy as _
-from django.db import models
+from django.db import models, DEFAULT_DB_ALIAS
 from django.conf import settings
 
+from freppledb.common.models import Parameter
+
 
 class OperationPlan(models.Model):
   # Database fields
@@ -100,6 +102,97 @@ class ResourceSummary(models.Model):
     verbose_name = 'resource summary'  # No need to translate these since only used internally
     verbose_name_plural = 'resource summaries'
 
+  @staticmethod
+  def densified(database=DEFAULT_DB_ALIAS, startdate=None, enddate=None, resources=None):
+    '''
+    Returns a SQL expression to use instead of the out_resourceplan table.
+
+    When the plan is exported in sparse mode (parameter plan.resourceSparse),
+    a record is only stored when the resource plan changes. This expression
+    expands these records again to a record for every bucket of the calendar
+    used during the export, as recorded by the export in the parameter
+    plan.resourceExport.
+    Only the buckets between startdate and enddate are expanded. The argument
+    resources is a list of resource names, or a function returning it, to
+    expand only the plan of these resources. The function is only called
+    for a sparse plan.
+    '''
+    export = Parameter.getValue('plan.resourceExport', database, 'dense').split(' ', 1)
+    if export[0] != 'sparse':
+      return 'out_resourceplan'
+    bucket = export[1] if len(export) > 1 else ''
+
+    def literal(value):
+      return "'%s'" % str(value).replace("'", "''")
+
+    runs = '''
+      select theresource, startdate, available, unavailable, setup, load, free,
+        lead(startdate) over (partition by theresource order by startdate) as nextdate
+      from out_resourceplan
+      '''
+    if callable(resources):
+      resources = resources()
+    if resources is not None:
+      runs += "where theresource in (%s)" % (','.join([ literal(i) for i in resources ]) or 'null')
+    runs = "(%s) runs" % runs
+    # Runs overlapping the requested dates
+    window = ''
+    if startdate:
+      window += "and runs.nextdate > %s " % literal(startdate)
+    if enddate:
+      window += "and runs.startdate < %s " % literal(enddate)
+    if bucket:
+      return '''(
+        select runs.theresource, d.startdate, runs.available, runs.unavailable,
+          runs.setup, runs.load, runs.free
+        from %s
+        inner join common_bucketdetail d
+        on d.bucket_id = %s
+        and d.startdate >= runs.startdate
+        and d.startdate < runs.nextdate
+        %s%s%s
+        )''' % (
+          runs, literal(bucket), window,
+          ("and d.startdate >= %s " % literal(startdate)) if startdate else '',
+          ("and d.startdate < %s " % literal(enddate)) if enddate else ''
+          )
+    else:
+      return '''(
+        select theresource,
+          generate_series(%s, %s - interval '1 microsecond', interval '1 day') as startdate,
+          available, unavailable, setup, load, free
+        from %s
+        where runs.nextdate is not null %s
+        )''' % (
+          ("greatest(runs.startdate, date_trunc('day', %s::timestamp))" % literal(startdate)) if startdate else 'runs.startdate',
+          ("least(runs.nextdate, %s::timestamp)" % literal(enddate)) if enddate else 'runs.nextdate',
+          runs, window
+          )
+
+
+class BufferSummary(models.Model):
+  '''
+  The inventory profile of a buffer in every time bucket. The quantities
+  include all buffers of the hierarchy below the buffer.
+  The table is computed after the plan is exported. Only buckets with
+  material movements are stored.
+  '''
+  thebuffer = models.CharField(_('buffer'), max_length=300)
+  bucket = models.CharField(_('bucket'), max_length=300)
+  startdate = models.DateTimeField(_('startdate'))
+  enddate = models.DateTimeField(_('enddate'))
+  produced = models.DecimalField(_('produced'), max_digits=15, decimal_places=4)
+  consumed = models.DecimalField(_('consumed'), max_digits=15, decimal_places=4)
+  startoh = models.DecimalField(_('start inventory'), max_digits=15, decimal_places=4)
+  endoh = models.DecimalField(_('end inventory'), max_digits=15, decimal_places=4)
+
+  class Meta:
+    db_table = 'out_inventory'
+    ordering = ['thebuffer', 'bucket', 'startdate']
+    unique_together = (('thebuffer', 'bucket', 'startdate'),)
+    verbose_name = 'buffer summary'  # No need to translate these since only used internally
+    verbose_name_plural = 'buffer summaries'
+
 
 class LoadPlan(models.Model):
   # Database fields
@@ -15,10 +15,16 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from datetime import datetime
+
 from django.conf import settings
+from django.db import connection, DEFAULT_DB_ALIAS
 from django.test import TestCase
 from django.test.utils import override_settings
 
+from freppledb.common.models import Parameter
+from freppledb.output.models import ResourceSummary
+
 
 @override_settings(INSTALLED_APPS=settings.INSTALLED_APPS + ('django.contrib.sessions',))
 class OutputTest(TestCase):
@@ -44,6 +50,12 @@ class OutputTest(TestCase):
     self.assertEqual(response.status_code, 200)
     self.assertTrue(response.__getitem__('Content-Type').startswith('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'))
 
+  def test_output_buffer_aggregated(self):
+    # The report reads the precomputed inventory when the export aggregated it
+    Parameter.objects.update_or_create(name='plan.inventoryExport', defaults={'value': 'aggregated'})
+    response = self.client.get('/buffer/?format=json')
+    self.assertEqual(response.status_code, 200)
+    self.assertContains(response, '"records":8,')
 
   # Resource
   def test_output_resource(self):
@@ -57,6 +69,23 @@ class OutputTest(TestCase):
     self.assertEqual(response.status_code, 200)
     self.assertTrue(response.__getitem__('Content-Type').startswith('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'))
 
+  def test_resource_densified(self):
+    # A sparse resource plan is expanded to daily records in the requested dates
+    ResourceSummary.objects.all().delete()
+    ResourceSummary(theresource='res', startdate=datetime(2016, 1, 1), available=8, load=4).save()
+    ResourceSummary(theresource='res', startdate=datetime(2016, 1, 10), available=0, load=0).save()
+    ResourceSummary(theresource='other', startdate=datetime(2016, 1, 1), available=8, load=4).save()
+    ResourceSummary(theresource='other', startdate=datetime(2016, 1, 10), available=0, load=0).save()
+    Parameter.objects.update_or_create(name='plan.resourceExport', defaults={'value': 'sparse'})
+    cursor = connection.cursor()
+    cursor.execute(
+      "select theresource, startdate, load from %s x order by startdate" %
+      ResourceSummary.densified(DEFAULT_DB_ALIAS, datetime(2016, 1, 3), datetime(2016, 1, 5, 12), ['res'])
+      )
+    self.assertEqual(cursor.fetchall(), [
+      ('res', datetime(2016, 1, 3), 4), ('res', datetime(2016, 1, 4), 4), ('res', datetime(2016, 1, 5), 4)
+      ])
+
   # Demand
   def test_output_demand(self):
     response = self.client.get('/demand/')
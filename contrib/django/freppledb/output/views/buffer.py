@@ -23,7 +23,8 @@ from django.utils.encoding import force_text
 from freppledb.input.models import Buffer
 from freppledb.output.models import FlowPlan
 from freppledb.common.db import sql_max, sql_min, python_date, string_agg
-from freppledb.common.report import GridReport, GridPivot, GridFieldText, GridFieldNumber
+from freppledb.common.models import Parameter
+from freppledb.common.report import GridReport, GridPivot, GridFieldText, GridFieldNumber, chunkedCursor
 from freppledb.common.report import GridFieldDateTime, GridFieldBool, GridFieldInteger
 
 
@@ -64,89 +65,137 @@ class OverviewReport(GridPivot):
     cursor = connections[request.database].cursor()
     basesql, baseparams = basequery.query.get_compiler(basequery.db).as_sql(with_col_aliases=False)
 
-    # Assure the item hierarchy is up to date
-    Buffer.rebuildHierarchy(database=basequery.db)
+    # The inventory profile is precomputed in the table out_inventory, unless
+    # the parameter plan.aggregateInventory was false during the last export.
+    aggregated = Parameter.getValue('plan.inventoryExport', request.database, 'none') == 'aggregated'
 
-    # Execute a query  to get the onhand value at the start of our horizon
+    # Execute a query to get the onhand value at the start of our horizon
     startohdict = {}
-    query = '''
-      select buffers.name, sum(oh.onhand)
-      from (%s) buffers
-      inner join buffer
-      on buffer.lft between buffers.lft and buffers.rght
-      inner join (
-      select out_flowplan.thebuffer as thebuffer, out_flowplan.onhand as onhand
-      from out_flowplan,
-        (select thebuffer, max(id) as id
-         from out_flowplan
-         where flowdate < '%s'
-         group by thebuffer
-        ) maxid
-      where maxid.thebuffer = out_flowplan.thebuffer
-      and maxid.id = out_flowplan.id
-      ) oh
-      on oh.thebuffer = buffer.name
-      group by buffers.name
-      ''' % (basesql, request.report_startdate)
+    if aggregated:
+      query = '''
+        select buffers.name, coalesce(
+          (select endoh from out_inventory
+           where thebuffer = buffers.name and bucket = '%s' and enddate <= '%s'
+           order by startdate desc limit 1),
+          (select startoh from out_inventory
+           where thebuffer = buffers.name and bucket = '%s' and enddate > '%s'
+           order by startdate limit 1),
+          0)
+        from (%s) buffers
+        ''' % (
+          request.report_bucket, request.report_startdate,
+          request.report_bucket, request.report_startdate, basesql
+        )
+    else:
+      # Assure the buffer hierarchy is up to date
+      Buffer.rebuildHierarchy(database=basequery.db)
+      query = '''
+        select buffers.name, sum(oh.onhand)
+        from (%s) buffers
+        inner join buffer
+        on buffer.lft between buffers.lft and buffers.rght
+        inner join (
+        select out_flowplan.thebuffer as thebuffer, out_flowplan.onhand as onhand
+        from out_flowplan,
+          (select thebuffer, max(id) as id
+           from out_flowplan
+           where flowdate < '%s'
+           group by thebuffer
+          ) maxid
+        where maxid.thebuffer = out_flowplan.thebuffer
+        and maxid.id = out_flowplan.id
+        ) oh
+        on oh.thebuffer = buffer.name
+        group by buffers.name
+        ''' % (basesql, request.report_startdate)
     cursor.execute(query, baseparams)
     for row in cursor.fetchall():
       startohdict[row[0]] = float(row[1])
 
     # Execute the actual query
-    query = '''
-      select buf.name as row1, buf.item_id as row2, buf.location_id as row3,
-             d.bucket as col1, d.startdate as col2, d.enddate as col3,
-             coalesce(sum(%s),0.0) as consumed,
-             coalesce(-sum(%s),0.0) as produced
-        from (%s) buf
-        -- Multiply with buckets
-        cross join (
-             select name as bucket, startdate, enddate
-             from common_bucketdetail
-             where bucket_id = '%s' and enddate > '%s' and startdate < '%s'
-             ) d
-        -- Include child buffers
-        inner join buffer
-        on buffer.lft between buf.lft and buf.rght
-        -- Consumed and produced quantities
-        left join out_flowplan
-        on buffer.name = out_flowplan.thebuffer
-        and d.startdate <= out_flowplan.flowdate
-        and d.enddate > out_flowplan.flowdate
-        and out_flowplan.flowdate >= '%s'
-        and out_flowplan.flowdate < '%s'
-        -- Grouping and sorting
-        group by buf.name, buf.item_id, buf.location_id, buf.onhand, d.bucket, d.startdate, d.enddate
-        order by %s, d.startdate
-      ''' % (
-        sql_max('out_flowplan.quantity', '0.0'), sql_min('out_flowplan.quantity', '0.0'),
-        basesql, request.report_bucket, request.report_startdate, request.report_enddate,
-        request.report_startdate, request.report_enddate, sortsql
-      )
-    cursor.execute(query, baseparams)
+    if aggregated:
+      query = '''
+        select buf.name as row1, buf.item_id as row2, buf.location_id as row3,
+               d.bucket as col1, d.startdate as col2, d.enddate as col3,
+               coalesce(out_inventory.produced, 0.0) as produced,
+               coalesce(out_inventory.consumed, 0.0) as consumed
+          from (%s) buf
+          -- Multiply with buckets
+          cross join (
+               select name as bucket, startdate, enddate
+               from common_bucketdetail
+               where bucket_id = '%s' and enddate > '%s' and startdate < '%s'
+               ) d
+          -- Consumed and produced quantities, including child buffers
+          left join out_inventory
+          on out_inventory.thebuffer = buf.name
+          and out_inventory.bucket = '%s'
+          and out_inventory.startdate = d.startdate
+          -- Sorting
+          order by %s, d.startdate
+        ''' % (
+          basesql, request.report_bucket, request.report_startdate, request.report_enddate,
+          request.report_bucket, sortsql
+        )
+    else:
+      query = '''
+        select buf.name as row1, buf.item_id as row2, buf.location_id as row3,
+               d.bucket as col1, d.startdate as col2, d.enddate as col3,
+               coalesce(sum(%s),0.0) as produced,
+               coalesce(-sum(%s),0.0) as consumed
+          from (%s) buf
+          -- Multiply with buckets
+          cross join (
+               select name as bucket, startdate, enddate
+               from common_bucketdetail
+               where bucket_id = '%s' and enddate > '%s' and startdate < '%s'
+               ) d
+          -- Include child buffers
+          inner join buffer
+          on buffer.lft between buf.lft and buf.rght
+          -- Consumed and produced quantities
+          left join out_flowplan
+          on buffer.name = out_flowplan.thebuffer
+          and d.startdate <= out_flowplan.flowdate
+          and d.enddate > out_flowplan.flowdate
+          and out_flowplan.flowdate >= '%s'
+          and out_flowplan.flowdate < '%s'
+          -- Grouping and sorting
+          group by buf.name, buf.item_id, buf.location_id, buf.onhand, d.bucket, d.startdate, d.enddate
+          order by %s, d.startdate
+        ''' % (
+          sql_max('out_flowplan.quantity', '0.0'), sql_min('out_flowplan.quantity', '0.0'),
+          basesql, request.report_bucket, request.report_startdate, request.report_enddate,
+          request.report_startdate, request.report_enddate, sortsql
+        )
+    cursor = chunkedCursor(request.database)
+    try:
+      cursor.execute(query, baseparams)
 
-    # Build the python result
-    prevbuf = None
-    for row in cursor.fetchall():
-      if row[0] != prevbuf:
-        prevbuf = row[0]
-        startoh = startohdict.get(prevbuf, 0)
-        endoh = startoh + float(row[6] - row[7])
-      else:
-        startoh = endoh
-        endoh += float(row[6] - row[7])
-      yield {
-        'buffer': row[0],
-        'item': row[1],
-        'location': row[2],
-        'bucket': row[3],
-        'startdate': python_date(row[4]),
-        'enddate': python_date(row[5]),
-        'startoh': round(startoh, 1),
-        'produced': round(row[6], 1),
-        'consumed': round(row[7], 1),
-        'endoh': round(endoh, 1),
-        }
+      # Build the python result
+      prevbuf = None
+      for row in cursor:
+        if row[0] != prevbuf:
+          prevbuf = row[0]
+          startoh = startohdict.get(prevbuf, 0)
+          endoh = startoh + float(row[6] - row[7])
+        else:
+          startoh = endoh
+          endoh += float(row[6] - row[7])
+        yield {
+          'buffer': row[0],
+          'item': row[1],
+          'location': row[2],
+          'bucket': row[3],
+          'startdate': python_date(row[4]),
+          'enddate': python_date(row[5]),
+          'startoh': round(startoh, 1),
+          'produced': round(row[6], 1),
+          'consumed': round(row[7], 1),
+          'endoh': round(endoh, 1),
+          }
+    finally:
+      cursor.close()
 
 
 class DetailReport(GridReport):
@@ -21,10 +21,10 @@ from django.utils.translation import ugettext_lazy as _
 from django.utils.text import capfirst
 
 from freppledb.input.models import Resource
-from freppledb.output.models import LoadPlan
+from freppledb.output.models import LoadPlan, ResourceSummary
 from freppledb.common.models import Parameter
 from freppledb.common.db import python_date, sql_max, string_agg
-from freppledb.common.report import GridReport, GridPivot
+from freppledb.common.report import GridReport, GridPivot, chunkedCursor
 from freppledb.common.report import GridFieldText, GridFieldNumber, GridFieldDateTime, GridFieldBool, GridFieldInteger
 
 
@@ -88,8 +88,22 @@ class OverviewReport(GridPivot):
     # Assure the item hierarchy is up to date
     Resource.rebuildHierarchy(database=basequery.db)
 
+    # Resource plan, expanded to all buckets when exported in sparse mode.
+    # Only the resources of the page are expanded, in the report horizon.
+    def pageResources():
+      cursor = connections[basequery.db].cursor()
+      cursor.execute('''
+        select distinct res2.name
+        from (%s) res
+        inner join %s res2
+        on res2.lft between res.lft and res.rght
+        ''' % (basesql, connections[basequery.db].ops.quote_name('resource')), baseparams)
+      return [ i[0] for i in cursor.fetchall() ]
+    resources = ResourceSummary.densified(
+      request.database, request.report_startdate, request.report_enddate, pageResources
+      )
+
     # Execute the query
-    cursor = connections[request.database].cursor()
     query = '''
       select res.name as row1, res.location_id as row2,
              coalesce(max(plan_summary.avg_util),0) as avgutil,
@@ -109,7 +123,7 @@ class OverviewReport(GridPivot):
       inner join %s res2
       on res2.lft between res.lft and res.rght
       -- Utilization info
-      left join out_resourceplan
+      left join %s out_resourceplan
       on res2.name = out_resourceplan.theresource
       and d.startdate <= out_resourceplan.startdate
       and d.enddate > out_resourceplan.startdate
@@ -121,7 +135,7 @@ class OverviewReport(GridPivot):
                   theresource,
                   ( coalesce(sum(out_resourceplan.load),0) + coalesce(sum(out_resourceplan.setup),0) )
                    * 100.0 / coalesce(%s,1) as avg_util
-                from out_resourceplan
+                from %s out_resourceplan
                 where out_resourceplan.startdate >= '%s'
                 and out_resourceplan.startdate < '%s'
                 group by theresource
@@ -135,30 +149,34 @@ class OverviewReport(GridPivot):
         basesql, request.report_bucket, request.report_startdate,
         request.report_enddate,
         connections[basequery.db].ops.quote_name('resource'),
-        request.report_startdate, request.report_enddate,
+        resources, request.report_startdate, request.report_enddate,
         sql_max('sum(out_resourceplan.available)', '0.0001'),
-        request.report_startdate, request.report_enddate, sortsql
+        resources, request.report_startdate, request.report_enddate, sortsql
       )
-    cursor.execute(query, baseparams)
-
-    # Build the python result
-    for row in cursor.fetchall():
-      if row[5] != 0:
-        util = row[7] * 100 / row[5]
-      else:
-        util = 0
-      yield {
-        'resource': row[0],
-        'location': row[1],
-        'avgutil': round(row[2], 2),
-        'bucket': row[3],
-        'startdate': python_date(row[4]),
-        'available': round(row[5], 1),
-        'unavailable': round(row[6], 1),
-        'load': round(row[7], 1),
-        'setup': round(row[8], 1),
-        'utilization': round(util, 2)
-        }
+    cursor = chunkedCursor(request.database)
+    try:
+      cursor.execute(query, baseparams)
+
+      # Build the python result
+      for row in cursor:
+        if row[5] != 0:
+          util = row[7] * 100 / row[5]
+        else:
+          util = 0
+        yield {
+          'resource': row[0],
+          'location': row[1],
+          'avgutil': round(row[2], 2),
+          'bucket': row[3],
+          'startdate': python_date(row[4]),
+          'available': round(row[5], 1),
+          'unavailable': round(row[6], 1),
+          'load': round(row[7], 1),
+          'setup': round(row[8], 1),
+          'utilization': round(util, 2)
+          }
+    finally:
+      cursor.close()
 
 
 class DetailReport(GridReport):
@@ -32,7 +32,7 @@ from freppledb.common.models import Parameter
 from freppledb.common.dashboard import Dashboard, Widget
 from freppledb.common.report import GridReport
 from freppledb.input.models import PurchaseOrder, DistributionOrder
-from freppledb.output.models import LoadPlan, Problem
+from freppledb.output.models import LoadPlan, Problem, ResourceSummary
 
 
 class LateOrdersWidget(Widget):
@@ -41,6 +41,8 @@ class LateOrdersWidget(Widget):
   tooltip = _("Shows orders that will be delivered after their due date")
   permissions = (("view_problem_report", "Can view problem report"),)
   asynchronous = True
+  cacheable = True
+  inputtables = ('demand',)
   url = '/problem/?entity=demand&name=late&sord=asc&sidx=startdate'
   exporturl = True
   limit = 20
@@ -95,6 +97,8 @@ class ShortOrdersWidget(Widget):
   tooltip = _("Shows orders that are not planned completely")
   permissions = (("view_problem_report", "Can view problem report"),)
   asynchronous = True
+  cacheable = True
+  inputtables = ('demand',)
   # Note the gte filter lets pass "short" and "unplanned", and filters out
   # "late" and "early".
   url = '/problem/?entity=demand&name__gte=short&sord=asc&sidx=startdate'
@@ -149,6 +153,8 @@ class ManufacturingOrderWidget(Widget):
   tooltip = _("Shows manufacturing orders by start date")
   permissions = (("view_problem_report", "Can view problem report"),)
   asynchronous = True
+  cacheable = True
+  inputtables = ('operationplan', 'common_parameter', 'common_bucketdetail')
   url = '/data/input/operationplan/?sord=asc&sidx=startdate&status__in=proposed,confirmed'
   exporturl = True
   fence1 = 7
@@ -341,6 +347,8 @@ class DistributionOrderWidget(Widget):
   tooltip = _("Shows distribution orders by start date")
   permissions = (("view_problem_report", "Can view problem report"),)
   asynchronous = True
+  cacheable = True
+  inputtables = ('distribution_order', 'item', 'common_parameter', 'common_bucketdetail')
   url = '/data/input/distributionorder/?sord=asc&sidx=startdate&status__in=proposed,confirmed'
   exporturl = True
   fence1 = 7
@@ -541,6 +549,8 @@ class PurchaseOrderWidget(Widget):
   tooltip = _("Shows purchase orders by ordering date")
   permissions = (("view_problem_report", "Can view problem report"),)
   asynchronous = True
+  cacheable = True
+  inputtables = ('purchase_order', 'item', 'common_parameter', 'common_bucketdetail')
   url = '/data/input/purchaseorder/?sord=asc&sidx=startdate&status__in=proposed,confirmed'
   exporturl = True
   fence1 = 7
@@ -752,6 +762,8 @@ class PurchaseQueueWidget(Widget):
   tooltip = _("Display a list of new purchase orders")
   permissions = (("view_purchaseorder", "Can view purchase orders"),)
   asynchronous = True
+  cacheable = True
+  inputtables = ('purchase_order',)
   url = '/data/input/purchaseorder/?status=proposed&sidx=startdate&sord=asc'
   exporturl = True
   limit = 20
@@ -793,6 +805,8 @@ class DistributionQueueWidget(Widget):
   tooltip = _("Display a list of new distribution orders")
   permissions = (("view_distributionorder", "Can view distribution orders"),)
   asynchronous = True
+  cacheable = True
+  inputtables = ('distribution_order',)
   url = '/data/input/distributionorder/?status=proposed&sidx=startdate&sord=asc'
   exporturl = True
   limit = 20
@@ -833,6 +847,8 @@ class ShippingQueueWidget(Widget):
   tooltip = _("Display a list of new distribution orders")
   permissions = (("view_distributionorder", "Can view distribution orders"),)
   asynchronous = True
+  cacheable = True
+  inputtables = ('distribution_order',)
   url = '/data/input/distributionorder/?sidx=plandate&sord=asc'
   exporturl = True
   limit = 20
@@ -874,6 +890,7 @@ class ResourceQueueWidget(Widget):
   tooltip = _("Display planned activities for the resources")
   permissions = (("view_resource_report", "Can view resource report"),)
   asynchronous = True
+  cacheable = True
   url = '/loadplan/?sidx=startdate&sord=asc'
   exporturl = True
   limit = 20
@@ -914,6 +931,8 @@ class PurchaseAnalysisWidget(Widget):
   tooltip = _("Analyse the urgency of existing purchase orders")
   permissions = (("view_purchaseorder", "Can view purchase orders"),)
   asynchronous = True
+  cacheable = True
+  inputtables = ('purchase_order',)
   url = '/data/input/purchaseorder/?status=confirmed&sidx=criticality&sord=asc'
   limit = 20
 
@@ -951,6 +970,7 @@ class AlertsWidget(Widget):
   tooltip = _("Overview of all alerts in the plan")
   permissions = (("view_problem_report", "Can view problem report"),)
   asynchronous = True
+  cacheable = True
   url = '/problem/'
   entities = 'material,capacity,demand,operation'
 
@@ -1021,6 +1041,8 @@ class ResourceLoadWidget(Widget):
   tooltip = _("Shows the resources with the highest utilization")
   permissions = (("view_resource_report", "Can view resource report"),)
   asynchronous = True
+  cacheable = True
+  inputtables = ('common_bucketdetail',)
   url = '/resource/'
   exporturl = True
   limit = 5
@@ -1095,12 +1117,15 @@ class ResourceLoadWidget(Widget):
                    * 100.0 / coalesce(sum(out_resourceplan.available)+0.000001,1) as avg_util,
                   coalesce(sum(out_resourceplan.load),0) + coalesce(sum(out_resourceplan.setup),0),
                   coalesce(sum(out_resourceplan.free),0)
-                from out_resourceplan
+                from %s out_resourceplan
                 where out_resourceplan.startdate >= '%s'
                   and out_resourceplan.startdate < '%s'
                 group by theresource
                 order by 2 desc
-              ''' % (request.report_startdate, request.report_enddate)
+              ''' % (
+                ResourceSummary.densified(request.database, request.report_startdate, request.report_enddate),
+                request.report_startdate, request.report_enddate
+                )
     cursor.execute(query)
     for res in cursor.fetchall():
       limit -= 1
@@ -1122,6 +1147,8 @@ class InventoryByLocationWidget(Widget):
   title = _("Inventory by location")
   tooltip = _("Display the locations with the highest inventory value")
   asynchronous = True
+  cacheable = True
+  inputtables = ('buffer', 'item')
   limit = 5
 
   def args(self):
@@ -1216,6 +1243,8 @@ class InventoryByItemWidget(Widget):
   title = _("Inventory by item")
   tooltip = _("Display the items with the highest inventory value")
   asynchronous = True
+  cacheable = True
+  inputtables = ('buffer', 'item')
   limit = 20
 
   def args(self):
@@ -1307,6 +1336,7 @@ class DeliveryPerformanceWidget(Widget):
   title = _("Delivery performance")
   tooltip = _("Shows the percentage of demands that are planned to be shipped completely on time")
   asynchronous = True
+  cacheable = True
   green = 90
   yellow = 80
 
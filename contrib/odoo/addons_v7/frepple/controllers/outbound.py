@@ -27,6 +27,9 @@ logger = logging.getLogger(__name__)
 
 class exporter(object):
 
+  # Maximum number of records read in a single call
+  chunksize = 1000
+
   def __init__(self, req, **kwargs):
     self.req = req
     self.database = kwargs.get('database', None)
@@ -487,7 +490,16 @@ class exporter(object):
       'product_qty', 'product_uom', 'date_start', 'date_stop', 'product_id',
       'routing_id', 'type', 'sub_products', 'product_rounding'
       ]
-    for i in m.read(ids, fields, self.req.session.context):
+    boms = m.read(ids, fields, self.req.session.context)
+
+    # Read the lines of all boms at once, rather than per bom
+    ids = [ j for i in boms for j in i['bom_lines'] ]
+    bom_lines = {}
+    for k in range(0, len(ids), self.chunksize):
+      for j in m.read(ids[k:k + self.chunksize], fields2, self.req.session.context):
+        bom_lines[j['id']] = j
+
+    for i in boms:
       # Determine the location
       if i['routing_id']:
         location = mrp_routings.get(i['routing_id'][0], None) or self.mfg_location
@@ -523,7 +535,7 @@ class exporter(object):
       # Build consuming flows. If the same component is consumed multiple times in the same
       # BOM we sum up all quantities in a single flow.
       fl = {}
-      for j in m.read(i['bom_lines'], fields2, self.req.session.context):
+      for j in ( bom_lines[k] for k in i['bom_lines'] if k in bom_lines ):
         product = self.product_product.get(j['product_id'][0], None)
         if not product:
           continue
@@ -16,6 +16,8 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 import logging
+import Queue
+import threading
 from xml.sax.saxutils import quoteattr
 from datetime import datetime, timedelta
 from operator import itemgetter
@@ -26,6 +28,47 @@ logger = logging.getLogger(__name__)
 
 
 class exporter(object):
+
+    # Maximum number of records read in a single call
+    chunksize = 1000
+
+    # Models read as a whole, independent of any other data.
+    # They are read with the method search_read, and can be read upfront in
+    # parallel threads. See the method prefetch.
+    queries = {
+        'mrp.workcenter': ([], ['name', 'costs_hour', 'capacity_per_cycle', 'time_cycle']),
+        'product.template': ([], ['purchase_ok', 'route_ids', 'produce_delay', 'list_price', 'uom_id']),
+        'stock.location.route': ([], ['name']),
+        'product.product': ([], ['name', 'code', 'product_tmpl_id']),
+        'mrp.routing': ([], ['location_id']),
+        'mrp.routing.workcenter': ([], ['routing_id', 'workcenter_id', 'sequence', 'cycle_nbr', 'hour_nbr']),
+        'mrp.bom': ([], [
+            'name', 'product_qty', 'product_uom', 'date_start', 'date_stop',
+            'product_efficiency', 'product_tmpl_id', 'routing_id', 'type',
+            'product_rounding', 'bom_line_ids'
+            ]),
+        'mrp.bom.line': ([], [
+            'product_qty', 'product_uom', 'date_start', 'date_stop', 'product_id',
+            'routing_id', 'type', 'product_rounding'
+            ]),
+        'sale.order.line': (
+            [('state', '=', 'confirmed')],
+            ['state', 'type', 'product_id', 'product_uom_qty', 'product_uom', 'order_id']
+            ),
+        'purchase.order.line': (
+            [('state', '=', 'confirmed')],
+            ['name', 'date_planned', 'product_id', 'product_qty', 'product_uom', 'order_id']
+            ),
+        'mrp.production': (
+            ['|', ('state', '=', 'in_production'), ('state', '=', 'confirmed')],
+            ['bom_id', 'date_start', 'date_planned', 'name', 'state', 'product_qty', 'product_uom',
+             'location_dest_id', 'product_id']
+            ),
+        'stock.warehouse.orderpoint': (
+            [], ['warehouse_id', 'product_id', 'product_min_qty', 'product_max_qty', 'product_uom', 'qty_multiple']
+            ),
+        }
+
     def __init__(self, req, **kwargs):
         self.req = req
         self.database = kwargs.get('database', None)
@@ -42,12 +85,21 @@ class exporter(object):
             # If not set we use the default language of the user
             self.req.session.context['lang'] = kwargs['language']
         self.company = kwargs.get('company', None)
+        # Number of threads to read the independent models upfront.
+        # 0 reads every model only when it is needed.
+        try:
+            self.threads = int(kwargs.get('prefetch', 0))
+        except ValueError:
+            self.threads = 0
+        self.prefetched = {}
 
 
     def run(self):
         # Load some auxiliary data in memory
         self.load_company()
         self.load_uom()
+        if self.threads > 0:
+            self.prefetch()
 
         # Header.
         # The source attribute is set to 'odoo', such that all objects created or
@@ -88,6 +140,57 @@ class exporter(object):
         yield '</plan>\n'
 
 
+    def read(self, model, ids, fields):
+        '''
+Reads a list of records, in chunks of limited size.
+'''
+        m = self.req.session.model(model)
+        result = []
+        for i in range(0, len(ids), self.chunksize):
+            result.extend(m.read(ids[i:i + self.chunksize], fields, self.req.session.context))
+        return result
+
+
+    def search_read(self, model):
+        '''
+Returns all records of one of the models in the queries dictionary.
+'''
+        if model in self.prefetched:
+            return self.prefetched.pop(model)
+        domain, fields = self.queries[model]
+        ids = self.req.session.model(model).search(domain, context=self.req.session.context)
+        return self.read(model, ids, fields)
+
+
+    def prefetch(self):
+        '''
+Reads all models in the queries dictionary in parallel threads.
+
+Every call to Odoo runs in its own transaction, so the models can be read
+concurrently. A model that fails to load is read again when it is needed.
+'''
+        todo = Queue.Queue()
+        for model in self.queries:
+            todo.put(model)
+
+        def worker():
+            while True:
+                try:
+                    model = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self.prefetched[model] = self.search_read(model)
+                except Exception as e:
+                    logger.warning("Can't prefetch model '%s': %s" % (model, e))
+
+        threads = [threading.Thread(target=worker) for i in range(min(self.threads, len(self.queries)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+
     def load_company(self):
         m = self.req.session.model('res.company')
         ids = m.search([('name', '=', self.company)], context=self.req.session.context)
@@ -329,13 +432,11 @@ mrp.workcenter.costs_hour -> resource.cost
 mrp.workcenter.capacity_per_cycle / mrp.workcenter.time_cycle -> resource.maximum
 '''
         self.map_workcenters = {}
-        m = self.req.session.model('mrp.workcenter')
-        ids = m.search([], context=self.req.session.context)
-        fields = ['name', 'costs_hour', 'capacity_per_cycle', 'time_cycle']
-        if ids:
+        data = self.search_read('mrp.workcenter')
+        if data:
             yield '<!-- workcenters -->\n'
             yield '<resources>\n'
-            for i in m.read(ids, fields, self.req.session.context):
+            for i in data:
                 name = i['name']
                 self.map_workcenters[i['id']] = name
                 yield '<resource name=%s maximum="%s" cost="%f"><location name=%s/></resource>\n' % (
@@ -365,30 +466,20 @@ product.product.product_tmpl_id.produce_delay -> buffer.leadtime
         self.product_product = {}
         self.product_template_product = {}
         self.procured_buffers = set()
-        m = self.req.session.model('product.template')
-        # fields = ['purchase_ok', 'procure_method', 'supply_method', 'produce_delay', 'list_price', 'uom_id']
-        fields = ['purchase_ok', 'route_ids', 'produce_delay', 'list_price', 'uom_id']
-        ids = m.search([], context=self.req.session.context)
         self.product_templates = {}
-        for i in m.read(ids, fields, self.req.session.context):
+        for i in self.search_read('product.template'):
             self.product_templates[i['id']] = i
 
         # Read the stock location routes
-        rts = self.req.session.model('stock.location.route')
-        fields = ['name']
-        ids = rts.search([], context=self.req.session.context)
         stock_location_routes = {}
-        for i in rts.read(ids, fields, self.req.session.context):
+        for i in self.search_read('stock.location.route'):
             stock_location_routes[i['id']] = i
 
         # Read the products
-        m = self.req.session.model('product.product')
-        ids = m.search([], context=self.req.session.context)
-        if ids:
+        data = self.search_read('product.product')
+        if data:
             yield '<!-- products -->\n'
             yield '<items>\n'
-            fields = ['name', 'code', 'product_tmpl_id']
-            data = [i for i in m.read(ids, fields, self.req.session.context)]
             for i in data:
                 tmpl = self.product_templates[i['product_tmpl_id'][0]]
                 if i['code']:
@@ -435,38 +526,25 @@ Mapping:
         self.operations = set()
 
         # Read all active manufacturing routings
-        m = self.req.session.model('mrp.routing')
-        ids = m.search([], context=self.req.session.context)
-        fields = ['location_id']
         mrp_routings = {}
-        for i in m.read(ids, fields, self.req.session.context):
+        for i in self.search_read('mrp.routing'):
             mrp_routings[i['id']] = i['location_id']
 
         # Read all workcenters of all routings
         mrp_routing_workcenters = {}
-        m = self.req.session.model('mrp.routing.workcenter')
-        ids = m.search([], context=self.req.session.context)
-        fields = ['routing_id', 'workcenter_id', 'sequence', 'cycle_nbr', 'hour_nbr']
-        for i in m.read(ids, fields, self.req.session.context):
+        for i in self.search_read('mrp.routing.workcenter'):
             if i['routing_id'][0] in mrp_routing_workcenters:
                 mrp_routing_workcenters[i['routing_id'][0]].append((i['workcenter_id'][1], i['cycle_nbr'],))
             else:
                 mrp_routing_workcenters[i['routing_id'][0]] = [(i['workcenter_id'][1], i['cycle_nbr'],)]
 
+        # Read all bom lines at once, rather than per bom
+        mrp_bom_lines = {}
+        for i in self.search_read('mrp.bom.line'):
+            mrp_bom_lines[i['id']] = i
+
         # Loop over all "producing" bom records
-        m = self.req.session.model('mrp.bom')
-        m_lines = self.req.session.model('mrp.bom.line')
-        ids = m.search([], context=self.req.session.context)
-        fields = [
-            'name', 'product_qty', 'product_uom', 'date_start', 'date_stop',
-            'product_efficiency', 'product_tmpl_id', 'routing_id', 'type',
-            'product_rounding', 'bom_line_ids'
-        ]
-        fields2 = [
-            'product_qty', 'product_uom', 'date_start', 'date_stop', 'product_id',
-            'routing_id', 'type', 'product_rounding'
-        ]
-        for i in m.read(ids, fields, self.req.session.context):
+        for i in self.search_read('mrp.bom'):
             # Determine the location
             if i['routing_id']:
                 location = mrp_routings.get(i['routing_id'][0], None) or self.mfg_location
@@ -502,7 +580,7 @@ Mapping:
             # Build consuming flows. If the same component is consumed multiple times in the same
             # BOM we sum up all quantities in a single flow.
             fl = {}
-            for j in m_lines.read(i['bom_line_ids'], fields2, self.req.session.context):
+            for j in (mrp_bom_lines[k] for k in i['bom_line_ids'] if k in mrp_bom_lines):
                 product = self.product_product.get(j['product_id'][0], None)
                 if not product:
                     continue
@@ -573,19 +651,15 @@ product.product.name @ stock.warehouse.name -> buffer.name
         #     shops[i['id']] = i['warehouse_id'][1]
 
         # Get all sales order lines
-        m = self.req.session.model('sale.order.line')
-        ids = m.search([('state', '=', 'confirmed')], context=self.req.session.context)
-        fields = ['state', 'type', 'product_id', 'product_uom_qty', 'product_uom', 'order_id']
-        so_line = [i for i in m.read(ids, fields, self.req.session.context)]
+        so_line = self.search_read('sale.order.line')
 
         # Get all sales orders
-        m = self.req.session.model('sale.order')
-        ids = [i['order_id'][0] for i in so_line]
+        ids = list(set(i['order_id'][0] for i in so_line))
         fields = ['partner_id', 'requested_date', 'date_order', 'picking_policy', 'warehouse_id']
         # for python 2.7:
-        # so = { j['id']: j for j in m.read(ids, fields, self.req.session.context) }
+        # so = { j['id']: j for j in self.read('sale.order', ids, fields) }
         so = {}
-        for i in m.read(ids, fields, self.req.session.context):
+        for i in self.read('sale.order', ids, fields):
             so[i['id']] = i
 
         # Generate the demand records
@@ -640,19 +714,15 @@ purchase.order.date_planned -> operationplan.end
 purchase.order.date_planned -> operationplan.start
 '1' -> operationplan.locked
 '''
-        m = self.req.session.model('purchase.order.line')
-        ids = m.search([('state', '=', 'confirmed')], context=self.req.session.context)
-        fields = ['name', 'date_planned', 'product_id', 'product_qty', 'product_uom', 'order_id']
-        po_line = [i for i in m.read(ids, fields, self.req.session.context)]
+        po_line = self.search_read('purchase.order.line')
 
         # Get all purchase orders
-        m = self.req.session.model('purchase.order')
-        ids = [i['order_id'][0] for i in po_line]
+        ids = list(set(i['order_id'][0] for i in po_line))
         fields = ['name', 'location_id', 'partner_id', 'state', 'shipped']
         # for python 2.7:
-        # po = { j['id']: j for j in m.read(ids, fields, self.req.session.context) }
+        # po = { j['id']: j for j in self.read('purchase.order', ids, fields) }
         po = {}
-        for i in m.read(ids, fields, self.req.session.context):
+        for i in self.read('purchase.order', ids, fields):
             po[i['id']] = i
 
         # Create purchasing operations
@@ -703,12 +773,7 @@ mrp.production.date_planned -> operationplan.start
 '''
         yield '<!-- manufacturing orders in progress -->\n'
         yield '<operationplans>\n'
-        m = self.req.session.model('mrp.production')
-        ids = m.search(['|', ('state', '=', 'in_production'), ('state', '=', 'confirmed')],
-                       context=self.req.session.context)
-        fields = ['bom_id', 'date_start', 'date_planned', 'name', 'state', 'product_qty', 'product_uom',
-                  'location_dest_id', 'product_id']
-        for i in m.read(ids, fields, self.req.session.context):
+        for i in self.search_read('mrp.production'):
             if i['state'] in ('in_production', 'confirmed', 'ready') and i['bom_id']:
                 # Open orders
                 location = self.map_locations.get(i['location_dest_id'][0], None)
@@ -739,13 +804,11 @@ convert stock.warehouse.orderpoint.product_min_qty -> buffer.mininventory
 convert stock.warehouse.orderpoint.product_max_qty -> buffer.maxinventory
 convert stock.warehouse.orderpoint.qty_multiple -> buffer->size_multiple
 '''
-        m = self.req.session.model('stock.warehouse.orderpoint')
-        ids = m.search([], context=self.req.session.context)
-        fields = ['warehouse_id', 'product_id', 'product_min_qty', 'product_max_qty', 'product_uom', 'qty_multiple']
-        if ids:
+        data = self.search_read('stock.warehouse.orderpoint')
+        if data:
             yield '<!-- order points -->\n'
             yield '<buffers>\n'
-            for i in m.read(ids, fields, self.req.session.context):
+            for i in data:
                 item = self.product_product.get(i['product_id'] and i['product_id'][0] or 0, None)
                 if not item:
                     continue
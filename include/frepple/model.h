@@ -9229,6 +9229,22 @@ DECLARE_EXPORT PyObject* readXMLfile(PyObject*, PyObject*);
 DECLARE_EXPORT PyObject* readXMLdata(PyObject *, PyObject *);
 
 
+/** @brief This Python function is used for processing XML input data read
+  * from a file-like object.
+  *
+  * The data is read and processed in blocks, so the document is never
+  * completely in memory.
+  * The function takes up to three arguments:
+  *   - Object with a method read(size) returning bytes
+  *   - Optional validate flag, defining whether or not the input data needs to be
+  *     validated against the XML schema definition.
+  *     The validation is switched ON by default.
+  *   - Optional validate_only flag, which allows us to validate the data but
+  *     skip any processing.
+  */
+DECLARE_EXPORT PyObject* readXMLstream(PyObject *, PyObject *);
+
+
 /** @brief This Python function writes the dynamic part of the plan to an text file.
   *
   * This saved information covers the buffer flowplans, operationplans,
@@ -519,6 +519,8 @@ class NonCopyable
   *     Dynamically load a module in memory.
   *   - <b>readXMLdata(string [,bool] [,bool])</b>:<br>
   *     Processes an XML string passed as argument.
+  *   - <b>readXMLstream(object [,bool] [,bool])</b>:<br>
+  *     Processes XML data read in blocks from a file-like object.
   *   - <b>log(string)</b>:<br>
   *     Prints a string to the frePPLe log file.<br>
   *     This is used for redirecting the stdout and stderr of Python.
@@ -40,6 +40,8 @@
 #include <xercesc/framework/LocalFileInputSource.hpp>
 #include <xercesc/framework/StdInInputSource.hpp>
 #include <xercesc/framework/URLInputSource.hpp>
+#include <xercesc/sax/InputSource.hpp>
+#include <xercesc/util/BinInputStream.hpp>
 #include <xercesc/util/XMLException.hpp>
 #endif
 
@@ -269,6 +271,31 @@ class XMLInputString : public XMLInput
 };
 
 
+/** @brief This class reads XML data from a Python file-like object.
+  *
+  * The data is pulled in blocks with the read() method of the object while
+  * the parser processes them. The size of the document thus doesn't
+  * influence the memory used, and the data can be parsed while it is still
+  * being downloaded.<br>
+  * The object must return bytes. The Python interpreter lock is only held
+  * while reading a block.
+  */
+class XMLInputStream : public XMLInput
+{
+  public:
+    /** Constructor. The caller is responsible for keeping a reference to
+      * the Python object while the data is parsed. */
+    XMLInputStream(PyObject* s) : stream(s) {};
+
+    /** Parse the data read from the stream. */
+    DECLARE_EXPORT void parse(Object* pRoot, bool v = false);
+
+  private:
+    /** Python object to read from. */
+    PyObject* stream;
+};
+
+
 /** @brief This class reads XML data from a file system.
   *
   * The filename argument can be the name of a file or a directory.
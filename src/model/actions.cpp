@@ -118,6 +118,49 @@ DECLARE_EXPORT PyObject* readXMLdata(PyObject *self, PyObject *args)
 }
 
 
+//
+// READ XML INPUT STREAM
+//
+
+
+DECLARE_EXPORT PyObject* readXMLstream(PyObject *self, PyObject *args)
+{
+  // Pick up arguments
+  PyObject *stream;
+  int validate(1), validate_only(0);
+  PyObject *userexit = NULL;
+  int ok = PyArg_ParseTuple(args, "O|iiO:readXMLstream",
+    &stream, &validate, &validate_only, &userexit);
+  if (!ok) return NULL;
+  Py_INCREF(stream);
+
+  // Free Python interpreter for other threads.
+  // The stream reclaims it while reading a block of data.
+  Py_BEGIN_ALLOW_THREADS
+
+  // Execute and catch exceptions
+  try
+  {
+    XMLInputStream p(stream);
+    if (userexit) p.setUserExit(userexit);
+    if (validate_only!=0)
+      p.parse(NULL, true);
+    else
+      p.parse(&Plan::instance(), validate!=0);
+  }
+  catch (...)
+  {
+    Py_BLOCK_THREADS;
+    Py_DECREF(stream);
+    PythonType::evalException();
+    return NULL;
+  }
+  Py_END_ALLOW_THREADS   // Reclaim Python interpreter
+  Py_DECREF(stream);
+  return Py_BuildValue("");
+}
+
+
 //
 // SAVE MODEL TO XML
 //
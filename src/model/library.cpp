@@ -112,6 +112,9 @@ void LibraryModel::initialize()
   PythonInterpreter::registerGlobalMethod(
     "readXMLdata", readXMLdata, METH_VARARGS,
     "Processes a XML string passed as argument.");
+  PythonInterpreter::registerGlobalMethod(
+    "readXMLstream", readXMLstream, METH_VARARGS,
+    "Processes XML data read from a file-like object.");
   PythonInterpreter::registerGlobalMethod(
     "readXMLfile", readXMLfile, METH_VARARGS,
     "Read an XML file.");
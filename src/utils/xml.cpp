@@ -1196,5 +1196,98 @@ DECLARE_EXPORT void XMLInputFile::parse(Object *pRoot, bool validate)
   }
 }
 
+
+/** @brief Xerces input stream reading blocks from a Python file-like object. */
+class PythonBinInputStream : public xercesc::BinInputStream
+{
+  public:
+    PythonBinInputStream(PyObject* s) : stream(s), pos(0) {}
+
+    XMLFilePos curPos() const
+    {
+      return pos;
+    }
+
+    const XMLCh* getContentType() const
+    {
+      return NULL;
+    }
+
+    XMLSize_t readBytes(XMLByte* const toFill, const XMLSize_t maxToRead)
+    {
+      PyGILState_STATE pythonstate = PyGILState_Ensure();
+      PyObject* data = PyObject_CallMethod(
+        stream, const_cast<char*>("read"), const_cast<char*>("n"),
+        static_cast<Py_ssize_t>(maxToRead)
+        );
+      if (!data)
+      {
+        // Pass the message of the Python exception
+        string msg = "Error reading XML data";
+        PyObject *type, *value, *traceback;
+        PyErr_Fetch(&type, &value, &traceback);
+        if (value)
+        {
+          PyObject* str = PyObject_Str(value);
+          if (str)
+          {
+            msg += string(": ") + PyUnicode_AsUTF8(str);
+            Py_DECREF(str);
+          }
+        }
+        Py_XDECREF(type);
+        Py_XDECREF(value);
+        Py_XDECREF(traceback);
+        PyGILState_Release(pythonstate);
+        throw RuntimeException(msg);
+      }
+      char* buffer;
+      Py_ssize_t size;
+      if (!PyBytes_Check(data)
+        || PyBytes_AsStringAndSize(data, &buffer, &size)
+        || static_cast<XMLSize_t>(size) > maxToRead)
+      {
+        Py_DECREF(data);
+        PyErr_Clear();
+        PyGILState_Release(pythonstate);
+        throw DataException("XML stream must return bytes");
+      }
+      memcpy(toFill, buffer, size);
+      Py_DECREF(data);
+      PyGILState_Release(pythonstate);
+      pos += size;
+      return static_cast<XMLSize_t>(size);
+    }
+
+  private:
+    PyObject* stream;
+    XMLFilePos pos;
+};
+
+
+/** @brief Xerces input source reading from a Python file-like object. */
+class PythonInputSource : public xercesc::InputSource
+{
+  public:
+    PythonInputSource(PyObject* s) : stream(s) {}
+
+    xercesc::BinInputStream* makeStream() const
+    {
+      return new PythonBinInputStream(stream);
+    }
+
+  private:
+    PyObject* stream;
+};
+
+
+DECLARE_EXPORT void XMLInputStream::parse(Object *pRoot, bool validate)
+{
+  if (!stream)
+    throw DataException("Missing input stream");
+  PythonInputSource in(stream);
+  XMLInput::parse(in, pRoot, validate);
+}
+
 } // end namespace
 } // end namespace